@@ -1,5 +1,8 @@
-module_path = os.path.abspath(os.path.join('..', 'c0_preprocessing'))
+import os
+import sys
+
+module_path = os.path.dirname(os.path.abspath(__file__))
 if module_path not in sys.path:
     sys.path.append(module_path)
     
-from c0 import connect_db
\ No newline at end of file
+from c0 import connect_db
@@ -3,35 +3,69 @@ This package builds the ValidProt database from learn2therm.
 
 Functions:
     connect_df: Establishes connection to DuckDB database using local or
-                remote input path. Reports time to connection.
+                remote input path. Reports time to connection. Connections can be opened
+                read-only and shared across calls within a process.
+
+    close_shared: Closes shared connections opened by connect_db.
 
     build_validprot: Constructs validprot database from learn2therm database.
 
     sankey_plots: Optional function run by calling build_validprot with plots = True.
                   Generates Sankey plots showing the fate of samples as they pass from
                   learn2therm tables to ValidProt tables.
+
+    resource_profile: Builds DuckDB memory, thread and spill settings, defaulting to values
+                      detected from the machine.
+
+    apply_resource_profile: Applies a resource profile to a DuckDB connection.
+
+    export_parquet: Writes vp_final as a hive-partitioned Parquet dataset and returns a manifest
+                    of per-file row counts and min/max statistics.
 '''
 
+import datetime
+import glob
+import hashlib
+import json
+import multiprocessing
 import os
+import shutil
+import threading
 import time
+import uuid
 
 import numpy as np
+import pandas as pd
 
 import duckdb
+import psutil
 
-# Dependencies for Sankey plots.
-import plotly.graph_objects as go
-import plotly.io as pio
-pio.kaleido.scope.default_format = "png"
 
+# Shared connections handed out by connect_db, keyed by absolute database path.
+_SHARED_CONNECTIONS = {}
+_SHARED_LOCK = threading.Lock()
 
-def connect_db(path: str):
+
+def connect_db(path: str, profile: dict = None, read_only: bool = False, shared: bool = False,
+               check_schema: bool = True):
     '''
     Runs duckdb.connect() function on database path. Returns a
     duckdb.DuckDBPyConnection object and prints execution time.
 
+    Read-only connections do not take DuckDB's write lock, so any number of processes can query a
+    built database at once. With shared=True the connection is cached for the life of the process
+    and later calls with the same path return it without reconnecting. Shared connections should
+    not be closed by the caller; use close_shared instead. Threads that query a shared connection
+    concurrently should each take their own con.cursor().
+
     Args:
         path (str): Path to DuckDB database file containing learn2therm.
+        profile (dict): Optional resource profile from resource_profile() to apply to the
+        connection. DuckDB defaults are used when None.
+        read_only (bool): Open the database read-only.
+        shared (bool): Reuse a cached connection to path, opening and caching one if needed.
+        check_schema (bool): Check that the database contains tables. Skipping the check saves
+        a query against INFORMATION_SCHEMA on every new connection.
 
     Returns:
         con (duckdb.DuckDBPyConnection): A DuckDB connection object linking script to
@@ -40,7 +74,29 @@ def connect_db(path: str):
     Raises:
         VersionError: DuckDB installation is not one of 0.6.0 or 0.6.1.
         AttributeError: Input database contains no tables.
+        ValueError: A shared connection to path is already open with a different read_only mode.
     '''
+    key = os.path.abspath(path)
+
+    if shared:
+
+        with _SHARED_LOCK:
+            cached = _SHARED_CONNECTIONS.get(key)
+
+        # Cache hits skip the version check and schema probe, which already ran on first open.
+        if cached is not None:
+
+            con, cached_read_only = cached
+
+            if cached_read_only != read_only:
+                raise ValueError(f'A shared connection to {path} is already open with '
+                                 f'read_only={cached_read_only}.')
+
+            if profile is not None:
+                apply_resource_profile(con, profile)
+
+            return con
+
     s_time = time.time()
 
     version = duckdb.__version__
@@ -58,14 +114,25 @@ def connect_db(path: str):
         print(f'Finished with VersionError. Execution time: {elapsed_time} seconds')
 
     print('Connecting to database...')
-    con = duckdb.connect(path)
+    con = duckdb.connect(path, read_only=read_only)
 
-    tables = con.execute("""SELECT TABLE_NAME
-                            FROM INFORMATION_SCHEMA.TABLES
-                            WHERE TABLE_TYPE='BASE TABLE'""").df()
-    
-    if tables.shape[0] < 1:
-        raise AttributeError('Input database is empty.')
+    if check_schema:
+
+        tables = con.execute("""SELECT TABLE_NAME
+                                FROM INFORMATION_SCHEMA.TABLES
+                                WHERE TABLE_TYPE='BASE TABLE'""").df()
+
+        if tables.shape[0] < 1:
+            con.close()
+            raise AttributeError('Input database is empty.')
+
+    if profile is not None:
+        apply_resource_profile(con, profile)
+
+    if shared:
+
+        with _SHARED_LOCK:
+            _SHARED_CONNECTIONS[key] = (con, read_only)
     
     e_time = time.time()
     elapsed_time = e_time - s_time
@@ -73,12 +140,346 @@ def connect_db(path: str):
     return con
 
 
+def close_shared(path: str = None):
+    '''
+    Closes shared connections opened by connect_db and removes them from the cache. Needed before
+    a process writes to a database it has open read-only, e.g. to rebuild it.
+
+    Args:
+        path (str): Database path whose shared connection to close. Closes all of them when None.
+    '''
+    with _SHARED_LOCK:
+
+        if path is None:
+            keys = list(_SHARED_CONNECTIONS)
+        else:
+            keys = [key for key in [os.path.abspath(path)] if key in _SHARED_CONNECTIONS]
+
+        for key in keys:
+            con, _ = _SHARED_CONNECTIONS.pop(key)
+            con.close()
+
+
+# DuckDB settings that make up a resource profile.
+PROFILE_SETTINGS = ['memory_limit', 'threads', 'temp_directory', 'preserve_insertion_order']
+
+
+def resource_profile(memory_limit: str = None, threads: int = None, temp_directory: str = None,
+                     preserve_insertion_order: bool = None, workers: int = 1):
+    '''
+    Builds a DuckDB resource profile. Settings that are not given are picked from the detected
+    machine size so large joins spill to disk instead of running out of memory: DuckDB gets 60%
+    of system memory, one thread per 2 GB of that budget up to the core count, and insertion
+    order is not preserved. When several worker processes share the machine, the memory budget
+    and cores are split evenly between them.
+
+    Args:
+        memory_limit (str): DuckDB memory limit, e.g. '8GB'.
+        threads (int): Number of DuckDB worker threads.
+        temp_directory (str): Directory DuckDB spills to. DuckDB's default of <database>.tmp is
+                              kept when None.
+        preserve_insertion_order (bool): Whether DuckDB must keep insertion order in results
+                                         without ORDER BY. Disabling it lets more operators
+                                         stream and spill.
+        workers (int): Number of processes the detected memory and cores are shared between.
+
+    Returns:
+        profile (dict): Setting name to value for each entry of PROFILE_SETTINGS.
+
+    Raises:
+        ValueError: threads must be positive.
+        ValueError: workers must be positive.
+    '''
+    if threads is not None and threads < 1:
+        raise ValueError('threads must be positive.')
+
+    if workers < 1:
+        raise ValueError('workers must be positive.')
+
+    budget_gb = max(1, int(0.6 * psutil.virtual_memory().total / workers / 1024 ** 3))
+
+    if memory_limit is None:
+        memory_limit = f'{budget_gb}GB'
+
+    if threads is None:
+        threads = max(1, min((os.cpu_count() or 1) // workers, budget_gb // 2))
+
+    if preserve_insertion_order is None:
+        preserve_insertion_order = False
+
+    return {'memory_limit': memory_limit,
+            'threads': threads,
+            'temp_directory': temp_directory,
+            'preserve_insertion_order': preserve_insertion_order}
+
+
+def apply_resource_profile(con, profile: dict):
+    '''
+    Applies a resource profile to a DuckDB connection. Settings set to None are left unchanged.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        profile (dict): Resource profile from resource_profile(), or any subset of its keys.
+
+    Returns:
+        None. Connection settings are modified in place.
+
+    Raises:
+        ValueError: profile contains a setting that is not in PROFILE_SETTINGS.
+    '''
+    unknown = [key for key in profile if key not in PROFILE_SETTINGS]
+
+    if unknown:
+        raise ValueError(f'Unknown resource settings {unknown}. Expected any of: '
+                         f'{PROFILE_SETTINGS}')
+
+    for key, value in profile.items():
+
+        if value is None:
+            continue
+
+        if isinstance(value, str):
+            con.execute(f"SET {key} = '{value}'")
+        else:
+            con.execute(f'SET {key} = {value}')
+
+
+# learn2therm source tables and the column used to key each of them.
+L2T_TABLES = {'proteins': 'protein_int_index',
+              'protein_pairs': 'prot_pair_index',
+              'taxa': 'taxa_index',
+              'taxa_pairs': 'taxa_pair_index'}
+
+# Ordered ValidProt build stages. Each entry is the output table, the tables it reads and the
+# build parameters that change its contents.
+VP_STAGES = [('vp_taxa_pairs', ['taxa_pairs'], []),
+             ('vp_taxa', ['taxa', 'taxa_pairs'], []),
+             ('vp_ogt_taxa_pairs', ['vp_taxa_pairs', 'vp_taxa'], ['min_ogt_diff', 'min_16s']),
+             ('vp_protein_pairs', ['protein_pairs', 'vp_ogt_taxa_pairs'], []),
+             ('vp_proteins', ['proteins', 'protein_pairs'], []),
+             ('vp_sequences', ['vp_proteins'], []),
+             ('vp_protein_refs', ['vp_proteins', 'vp_sequences'], []),
+             ('vp_protein_features', ['vp_proteins'], []),
+             ('vp_final', ['vp_protein_pairs', 'vp_proteins'],
+              ['normalize_sequences', 'sequence_features']),
+             ('vp_protein_lookup', ['vp_final'], []),
+             ('vp_taxa_pair_lookup', ['vp_final'], [])]
+
+# Stages only built when sequences are normalized out of vp_final.
+SEQUENCE_STAGES = ['vp_sequences', 'vp_protein_refs']
+
+# Stages only built when sequence features are added to vp_final.
+FEATURE_STAGES = ['vp_protein_features']
+
+# Stages keyed by taxa pair on the way to vp_final. Shard workers cut them down to the taxa pairs
+# of their shard.
+TAXA_PAIR_STAGES = ['vp_taxa_pairs', 'vp_ogt_taxa_pairs', 'vp_protein_pairs']
+
+# Per-protein features computed in DuckDB from the residue counts n_<amino acid> and the
+# sequence length n, a DOUBLE. vp_final carries each as m_<name> and t_<name>.
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+SEQUENCE_FEATURES = {**{f'frac_{aa}': f'n_{aa} / n' for aa in AMINO_ACIDS},
+                     'frac_charged': '(n_D + n_E + n_K + n_R) / n',
+                     'frac_hydrophobic': '(n_A + n_F + n_I + n_L + n_M + n_V + n_W) / n',
+                     # The IVYWREL fraction tracks optimal growth temperature. Thermophiles also
+                     # favour charged over polar uncharged residues and E and K over Q and H.
+                     'frac_ivywrel': '(n_I + n_V + n_Y + n_W + n_R + n_E + n_L) / n',
+                     'cvp_bias': '(n_D + n_E + n_K + n_R - n_N - n_Q - n_S - n_T) / n',
+                     'ek_qh_ratio': 'CAST(n_E + n_K AS DOUBLE) / NULLIF(n_Q + n_H, 0)'}
+
+# Small tables over vp_final that turn per-protein and per-taxa pair lookups into range scans on
+# prot_pair_index. Built in every mode.
+LOOKUP_STAGES = ['vp_protein_lookup', 'vp_taxa_pair_lookup']
+
+# Stages written in sorted order. DuckDB keeps min/max statistics per row group, so filters on the
+# sort key skip every row group outside the requested range.
+SORTED_STAGES = ['vp_final'] + LOOKUP_STAGES
+
+# Rebuilds the original vp_final layout from a normalized vp_final.
+WIDE_VIEW_SELECT = """SELECT vp_final.* EXCLUDE (m_seq_id, t_seq_id, m_protein_len, t_protein_len),
+                       seq_m.protein_seq AS m_protein_seq,
+                       seq_t.protein_seq AS t_protein_seq,
+                       refs_m.protein_desc AS m_protein_desc,
+                       refs_t.protein_desc AS t_protein_desc,
+                       vp_final.m_protein_len,
+                       vp_final.t_protein_len
+                       FROM vp_final
+                       JOIN vp_sequences AS seq_m ON (vp_final.m_seq_id = seq_m.seq_id)
+                       JOIN vp_sequences AS seq_t ON (vp_final.t_seq_id = seq_t.seq_id)
+                       JOIN vp_protein_refs AS refs_m
+                       ON (vp_final.meso_protein_int_index = refs_m.protein_int_index)
+                       JOIN vp_protein_refs AS refs_t
+                       ON (vp_final.thermo_protein_int_index = refs_t.protein_int_index)"""
+
+# Supported build_validprot execution modes.
+BUILD_MODES = ['staged', 'fused', 'sharded']
+
+# Table recording the fingerprint and status of each completed or attempted build stage.
+META_TABLE = 'vp_build_meta'
+
+# Table of per-stage metrics, one row per stage per build, for tracking build regressions.
+METRICS_TABLE = 'vp_build_metrics'
+
+# Columns of METRICS_TABLE and of the DataFrame returned by build_validprot.
+METRICS_COLUMNS = {'build_id': 'VARCHAR',
+                   'source_fingerprint': 'VARCHAR',
+                   'stage': 'VARCHAR',
+                   'status': 'VARCHAR',
+                   'started_at': 'TIMESTAMP',
+                   'wall_time_s': 'DOUBLE',
+                   'rows': 'BIGINT',
+                   'rows_per_s': 'DOUBLE',
+                   'bytes_written': 'BIGINT',
+                   'peak_memory_bytes': 'BIGINT',
+                   'spill_bytes': 'BIGINT',
+                   'memory_limit': 'VARCHAR',
+                   'threads': 'INTEGER'}
+
+# Table recording the highest key, the fingerprint and a checksum of the rows at or below the
+# highest key of each learn2therm table as of the last build or update. update_validprot treats
+# rows above the watermark as new and uses the checksum to catch rows edited in place.
+WATERMARK_TABLE = 'vp_build_watermarks'
+
+# Incremental update plan. Each stage deletes and rebuilds the rows whose key is in the delta,
+# reading the listed inputs restricted to their delta keys. Delta keys are held in temp tables
+# named vp_delta_<key column>.
+DELTA_STAGES = {'vp_taxa_pairs': ('taxa_pair_index', [('taxa_pairs', 'taxa_pair_index')]),
+                'vp_taxa': ('taxa_index', [('taxa', 'taxa_index')]),
+                'vp_ogt_taxa_pairs': ('taxa_pair_index', [('taxa_pairs', 'taxa_pair_index'),
+                                                          ('vp_taxa_pairs', 'taxa_pair_index')]),
+                'vp_protein_pairs': ('prot_pair_index', [('protein_pairs', 'prot_pair_index')]),
+                'vp_proteins': ('protein_int_index', [('proteins', 'protein_int_index')]),
+                'vp_protein_features': ('protein_int_index', [('proteins', 'protein_int_index'),
+                                                              ('vp_proteins',
+                                                               'protein_int_index')]),
+                'vp_final': ('prot_pair_index', [('protein_pairs', 'prot_pair_index'),
+                                                 ('vp_protein_pairs', 'prot_pair_index'),
+                                                 ('proteins', 'protein_int_index'),
+                                                 ('vp_proteins', 'protein_int_index'),
+                                                 ('vp_protein_features', 'protein_int_index')]),
+                'vp_protein_lookup': ('prot_pair_index', [('vp_final', 'prot_pair_index')]),
+                'vp_taxa_pair_lookup': ('taxa_pair_index', [('vp_final', 'taxa_pair_index')])}
+
+# Table of row counts describing the fate of learn2therm rows, read by sankey_plots.
+STATS_TABLE = 'vp_build_stats'
+
+# Flags each learn2therm taxon by the role it plays in taxa pairs and whether any of its pairs
+# made it into ValidProt. Shared by the statistics queries below.
+TAXA_ROLES_CTE = """taxa_roles AS (
+    SELECT taxa_index,
+    bool_or(role = 'meso' AND NOT is_pair) AS meso_no_pair,
+    bool_or(role = 'thermo' AND NOT is_pair) AS thermo_no_pair,
+    bool_or(role = 'meso' AND is_pair) AS meso_16s_pair,
+    bool_or(role = 'thermo' AND is_pair) AS thermo_16s_pair,
+    bool_or(role = 'meso' AND in_validprot) AS meso_validprot,
+    bool_or(role = 'thermo' AND in_validprot) AS thermo_validprot
+    FROM (SELECT meso_index AS taxa_index, 'meso' AS role, is_pair, taxa_pair_index
+          FROM taxa_pairs
+          UNION ALL
+          SELECT thermo_index AS taxa_index, 'thermo' AS role, is_pair, taxa_pair_index
+          FROM taxa_pairs) AS pair_roles
+    LEFT JOIN (SELECT taxa_pair_index, True AS in_validprot
+               FROM vp_ogt_taxa_pairs) AS validprot_pairs
+    USING (taxa_pair_index)
+    GROUP BY taxa_index)"""
+
+# One aggregation pass per stage, run right after the stage is built. Together they hold every
+# count shown in the Sankey plots.
+STAGE_STATS = {'vp_ogt_taxa_pairs': """SELECT *
+                                        FROM (SELECT COUNT(*) AS tp_l2t,
+                                              COUNT(*) FILTER (WHERE NOT is_pair) AS tp_no_pair,
+                                              COUNT(*) FILTER (WHERE is_pair) AS tp_16s_pair,
+                                              COUNT(*) FILTER (WHERE taxa_pair_index IN
+                                                  (SELECT taxa_pair_index
+                                                   FROM vp_ogt_taxa_pairs)) AS tp_validprot,
+                                              COUNT(DISTINCT meso_index) AS t_meso,
+                                              COUNT(DISTINCT thermo_index) AS t_thermo
+                                              FROM taxa_pairs),
+                                             (SELECT COUNT(*) AS t_l2t,
+                                              COUNT(*) FILTER (WHERE meso_no_pair) AS tm_no_pair,
+                                              COUNT(*) FILTER (WHERE thermo_no_pair) AS tt_no_pair,
+                                              COUNT(*) FILTER (WHERE meso_16s_pair) AS tm_16s_pair,
+                                              COUNT(*) FILTER (WHERE thermo_16s_pair) AS tt_16s_pair,
+                                              COUNT(*) FILTER (WHERE meso_validprot) AS tm_validprot,
+                                              COUNT(*) FILTER (WHERE thermo_validprot)
+                                                  AS tt_validprot
+                                              FROM taxa
+                                              LEFT JOIN taxa_roles USING (taxa_index))""",
+               'vp_protein_pairs': """SELECT COUNT(*) AS pp_l2t,
+                                       COUNT(*) FILTER (WHERE taxa_pair_index IN
+                                           (SELECT taxa_pair_index
+                                            FROM vp_ogt_taxa_pairs)) AS pp_validprot,
+                                       COUNT(DISTINCT meso_protein_int_index) AS p_meso,
+                                       COUNT(DISTINCT thermo_protein_int_index) AS p_thermo
+                                       FROM protein_pairs""",
+               'vp_proteins': """SELECT COUNT(*) AS p_l2t,
+                                  COUNT(*) FILTER (WHERE meso_no_pair) AS pm_no_pair,
+                                  COUNT(*) FILTER (WHERE thermo_no_pair) AS pt_no_pair,
+                                  COUNT(*) FILTER (WHERE meso_16s_pair) AS pm_16s_pair,
+                                  COUNT(*) FILTER (WHERE thermo_16s_pair) AS pt_16s_pair,
+                                  COUNT(*) FILTER (WHERE meso_validprot) AS pm_validprot,
+                                  COUNT(*) FILTER (WHERE thermo_validprot) AS pt_validprot,
+                                  COUNT(*) FILTER (WHERE null_ogt) AS p_null
+                                  FROM proteins
+                                  LEFT JOIN taxa_roles USING (taxa_index)
+                                  LEFT JOIN (SELECT taxa_index, True AS null_ogt
+                                             FROM taxa
+                                             WHERE ogt IS NULL) AS null_taxa
+                                  USING (taxa_index)"""}
+
+
 def build_validprot(con, min_ogt_diff: int = 20, min_16s: int = 1300,
-                    plots: bool = False):
+                    plots: bool = False, force: bool = False, checksums: bool = True,
+                    mode: str = 'staged', keep: list = None,
+                    normalize_sequences: bool = False, sequence_features: bool = False,
+                    profile: dict = None, stage_profiles: dict = None,
+                    persist_metrics: bool = True,
+                    metrics_json: str = None, n_shards: int = 16, workers: int = None,
+                    shard_dir: str = None, merge_shards: bool = True):
     '''
     Converts learn2therm DuckDB database into a DuckDB database for ValidProt by adding filtered and
-    constructed tables. Ensure at lease 100 GB of free disk space and 30 GB of system memory are 
-    available before running on the full database.
+    constructed tables. Ensure at lease 100 GB of free disk space is available before running on
+    the full database. Memory is bounded by the resource profile: DuckDB spills to its temp
+    directory instead of running out of memory, so smaller machines trade time for disk.
+
+    Each stage records a fingerprint of its parameters and input tables in vp_build_meta. On a
+    rerun, stages whose fingerprint is unchanged are skipped and the build restarts from the first
+    stale or failed stage. The memory limit, thread count, peak process memory and peak spill
+    volume of each stage are recorded alongside.
+
+    Every call returns a table of per-stage metrics: wall time, output rows, rows per second,
+    bytes written, peak process memory and spill volume. Skipped and inlined stages are listed
+    with their status and no measurements. The same rows are appended to vp_build_metrics under a
+    fresh build_id so builds can be compared over time.
+
+    In 'fused' mode the whole chain is compiled into one DuckDB query and only vp_final, plus any
+    intermediates named in keep, is written to disk. This avoids the intermediate tables' disk
+    writes and lowers the free space needed on the full database.
+
+    'sharded' mode builds like 'fused' up to vp_final, which is split into n_shards by a hash of
+    taxa_pair_index. Each shard's protein pairs and vp_final rows are built in a separate worker
+    process with its own small resource profile and written to its own Parquet file in
+    shard_dir. Workers join only their own taxa pairs and the proteins of those pairs. The
+    shards are then merged into vp_final, or with merge_shards=False exposed through a vp_final
+    view over the shard files. Each shard records its own fingerprint in vp_build_meta, so a
+    rerun after a failure only rebuilds the shards that did not finish.
+
+    vp_final is written sorted by prot_pair_index, so range filters on it only read the row groups
+    they need. vp_protein_lookup and vp_taxa_pair_lookup map proteins and taxa pairs to their
+    prot_pair_index values for the same kind of range scan.
+
+    With normalize_sequences each unique protein sequence is stored once in vp_sequences, keyed by
+    its md5 hash and a compact integer seq_id. vp_protein_refs maps each protein to its seq_id and
+    description, vp_final holds only m_seq_id and t_seq_id in place of the sequence and
+    description columns, and the vp_final_wide view rebuilds the original layout on demand.
+
+    With sequence_features the composition and thermostability features in SEQUENCE_FEATURES are
+    computed once per protein inside DuckDB into vp_protein_features, from residue counts taken
+    with vectorized string functions. vp_final carries them as REAL columns m_<feature> and
+    t_<feature>, so readers get them without touching the sequences.
+
+    The highest key of each learn2therm table is recorded in vp_build_watermarks, so rows added
+    upstream later can be brought in with update_validprot instead of a full rebuild.
 
     Args:
         con (duckdb.DuckDBPyConnection): DuckDB connection object. Links script to DuckDB SQL 
@@ -88,15 +489,50 @@ def build_validprot(con, min_ogt_diff: int = 20, min_16s: int = 1300,
         min_16s (int): Cutoff for minimum 16S read length for taxa. Default 1300 bp. Filters out 
         organisms with poor or incomplete 16S sequencing.
         plots (bool): Boolean to determine whether the user wants Sankey plots diagramming the fate
-        of learn2therm samples during validprot construction to be saved in ./plots.
+        of learn2therm samples during validprot construction to be saved in ./plots. The images
+        are exported in a separate process that is joined before returning.
+        force (bool): Rebuild every stage regardless of recorded fingerprints.
+        checksums (bool): Include a checksum over every row of the learn2therm source tables in
+        the fingerprints. When False only row counts are compared, which is faster on the full
+        database but will not notice in-place edits.
+        mode (str): One of ['staged', 'fused', 'sharded']. 'staged' materializes every
+        intermediate table, 'fused' materializes only vp_final and the tables in keep and
+        'sharded' additionally builds vp_final in parallel shards.
+        keep (list): Only applies to fused and sharded modes. Intermediate stage tables to
+        materialize as well, e.g. ['vp_ogt_taxa_pairs'].
+        normalize_sequences (bool): Store sequences once in vp_sequences and keep only ids in
+        vp_final. The wide layout is available from the vp_final_wide view.
+        sequence_features (bool): Add the per-protein sequence features to vp_final.
+        profile (dict): Resource profile from resource_profile() applied to every stage.
+        Defaults to resource_profile() with settings detected from the machine.
+        stage_profiles (dict): Maps stage names to profile settings that override profile for
+        that stage only, e.g. {'vp_final': {'threads': 2}}.
+        persist_metrics (bool): Append the stage metrics to vp_build_metrics.
+        metrics_json (str): Optional path to also write the stage metrics to as JSON records.
+        n_shards (int): Only applies to sharded mode. Number of taxa pair hash shards.
+        workers (int): Only applies to sharded mode. Number of worker processes. Defaults to the
+        smaller of n_shards and the core count. Each worker gets resource_profile(workers=workers)
+        overridden by stage_profiles['vp_final'].
+        shard_dir (str): Only applies to sharded mode. Directory for the shard files. Defaults to
+        <database>.shards next to the database file.
+        merge_shards (bool): Only applies to sharded mode. Copy the shards into a vp_final table.
+        When False vp_final is a view over the shard files.
 
     Returns:
-        None. Database object is modified in place.
+        metrics (pandas.DataFrame): One row per stage with the columns of METRICS_COLUMNS.
+        Database object is modified in place. con is committed and closed on return in every
+        mode, so reconnect with connect_db to read the tables. Sharded mode already closes con
+        before starting the workers, which need the database file to themselves.
 
     Raises:
         ValueError: Optimal growth temperature difference must be positive.
         ValueError: Minimum 16S sequence read is 1 bp.
+        ValueError: mode must be one of ['staged', 'fused', 'sharded'].
+        ValueError: keep may only name intermediate ValidProt stages.
+        ValueError: n_shards and workers must be positive.
+        ValueError: Sharded builds need a database file.
         AttributeError: Database must be in the learn2therm format.
+        RuntimeError: One or more vp_final shards failed to build.
     '''
     
     if min_ogt_diff < 0:
@@ -104,178 +540,1385 @@ def build_validprot(con, min_ogt_diff: int = 20, min_16s: int = 1300,
      
     if min_16s < 1:
         raise ValueError('16S must have at least 1 bp read.')
+
+    if mode not in BUILD_MODES:
+        raise ValueError(f'Invalid argument passed to mode. Expected one of: {BUILD_MODES}')
+
+    stage_names = [stage for stage, _, _ in VP_STAGES]
+    intermediates = [stage for stage in stage_names[:stage_names.index('vp_final')]
+                     if stage not in SEQUENCE_STAGES + FEATURE_STAGES]
+    keep = [] if keep is None else list(keep)
+
+    if not all(stage in intermediates for stage in keep):
+        raise ValueError(f'keep may only contain intermediate stages: {intermediates}')
+
+    if n_shards < 1:
+        raise ValueError('n_shards must be positive.')
+
+    workers = min(n_shards, os.cpu_count() or 1) if workers is None else workers
+
+    if workers < 1:
+        raise ValueError('workers must be positive.')
+
+    profile = resource_profile() if profile is None else profile
+    stage_profiles = {} if stage_profiles is None else stage_profiles
+
+    # Shard workers open the database file themselves, so in-memory databases cannot be sharded.
+    if mode == 'sharded':
+
+        db_path = con.execute('PRAGMA database_list').fetchone()[2]
+
+        if db_path in [None, '', ':memory:']:
+            raise ValueError('Sharded builds need a database file.')
+
+        if shard_dir is None:
+            shard_dir = f'{db_path}.shards'
         
     tables = con.execute("""SELECT TABLE_NAME
                             FROM INFORMATION_SCHEMA.TABLES
                             WHERE TABLE_TYPE='BASE TABLE'""").df()
     
     # Check if proper tables exist in database. If they do not, raise an error.
-    if (item in tables for item in ['proteins', 'protein_pairs', 'taxa', 'taxa_pairs']):      
+    if not all(item in tables['table_name'].values for item in L2T_TABLES):
+        raise AttributeError('Database is not formatted for learn2therm.')
+
+    s_time = time.perf_counter()
+    params = {'min_ogt_diff': min_ogt_diff, 'min_16s': min_16s,
+              'normalize_sequences': normalize_sequences, 'sequence_features': sequence_features}
+
+    con.execute(f"""CREATE TABLE IF NOT EXISTS {META_TABLE} (stage VARCHAR,
+                                                            fingerprint VARCHAR,
+                                                            status VARCHAR,
+                                                            started_at TIMESTAMP,
+                                                            finished_at TIMESTAMP)""")
+
+    # Resource columns were added after the first builds, so older tables are extended in place.
+    for column, dtype in [('memory_limit', 'VARCHAR'), ('threads', 'INTEGER'),
+                          ('peak_memory_bytes', 'BIGINT'), ('spill_bytes', 'BIGINT')]:
+        con.execute(f'ALTER TABLE {META_TABLE} ADD COLUMN IF NOT EXISTS {column} {dtype}')
+    con.execute(f"""CREATE TABLE IF NOT EXISTS {STATS_TABLE} (stage VARCHAR,
+                                                             fingerprint VARCHAR,
+                                                             stat VARCHAR,
+                                                             value BIGINT)""")
+    recorded = _read_build_meta(con)
+    recorded_stats = dict(con.execute(f"""SELECT DISTINCT stage, fingerprint
+                                         FROM {STATS_TABLE}""").fetchall())
+
+    # Fingerprints of learn2therm tables, then of each stage as it is reached.
+    fingerprints = {table: _table_fingerprint(con, table, checksums) for table in L2T_TABLES}
+    materialized = []
+    metrics = []
+
+    for stage, sources, stage_params in VP_STAGES:
+
+        if stage in SEQUENCE_STAGES and not normalize_sequences:
+            continue
+
+        if stage in FEATURE_STAGES and not sequence_features:
+            continue
+
+        fingerprint = _stage_fingerprint(stage, {key: params[key] for key in stage_params},
+                                         [fingerprints[source] for source in sources])
+        fingerprints[stage] = fingerprint
+
+        # Stage fingerprints include those of upstream stages, so anything downstream of a
+        # stale or failed stage is stale as well. An unmerged sharded vp_final is a view, which is
+        # always recreated, but its shards are still skipped individually.
+        if not force and recorded.get(stage) == (fingerprint, 'complete') and \
+           stage in tables['table_name'].values and \
+           not (mode == 'sharded' and stage == 'vp_final' and not merge_shards):
+            print(f'Skipping {stage}, inputs unchanged since last build.')
+            materialized.append(stage)
+            metrics.append({'stage': stage, 'status': 'skipped'})
+
+        # Fused and sharded builds only write vp_final, the sequence store, the sequence features
+        # and the intermediates the caller asked for. Everything else is inlined as a CTE.
+        elif mode != 'staged' and stage in intermediates and stage not in keep:
+            metrics.append({'stage': stage, 'status': 'inlined'})
+
+        # Workers need the database to themselves, so the connection is handed over and reopened.
+        elif mode == 'sharded' and stage == 'vp_final':
+
+            stage_profile = {**stage_profiles.get(stage, {}), 'preserve_insertion_order': True}
+            con, shard_metrics = _build_shards(con, db_path, fingerprint, materialized, recorded,
+                                               force, params, n_shards, workers, shard_dir,
+                                               merge_shards, {**profile, **stage_profile},
+                                               {**resource_profile(workers=workers),
+                                                **stage_profile})
+            metrics.extend(shard_metrics)
+            materialized.append(stage)
+
+        else:
+
+            # A previous unmerged sharded build leaves vp_final as a view.
+            if stage == 'vp_final' and _relation_type(con, stage) == 'VIEW':
+                con.execute('DROP VIEW vp_final')
+
+            # Lookup stages only read vp_final, which is always materialized by then.
+            if mode != 'staged' and stage not in LOOKUP_STAGES:
+                cmd = _fused_sql(stage, materialized, **params)
+            else:
+                cmd = f'CREATE OR REPLACE TABLE {stage} AS {_stage_select(stage, **params)}'
+
+            # Sorted stages rely on DuckDB writing rows in ORDER BY order.
+            stage_profile = stage_profiles.get(stage, {})
+            if stage in SORTED_STAGES:
+                stage_profile = {**stage_profile, 'preserve_insertion_order': True}
+
+            apply_resource_profile(con, {**profile, **stage_profile})
+            metrics.append(_run_stage(con, stage, fingerprint, cmd))
+            materialized.append(stage)
+
+        # Counts for the Sankey plots are refreshed whenever their stage or the ogt filter changes.
+        # They read learn2therm tables and vp_ogt_taxa_pairs, which is inlined if not materialized.
+        if stage in STAGE_STATS:
+
+            stats_fingerprint = _stage_fingerprint(f'{stage}_stats', {},
+                                                   [fingerprint, fingerprints['vp_ogt_taxa_pairs']])
+
+            if force or recorded_stats.get(stage) != stats_fingerprint:
+                _record_stats(con, stage, stats_fingerprint,
+                              _fused_ctes('vp_protein_pairs', materialized, **params))
+
+    # The wide view only makes sense over a normalized vp_final.
+    if normalize_sequences:
+        con.execute(f'CREATE OR REPLACE VIEW vp_final_wide AS {WIDE_VIEW_SELECT}')
+    else:
+        con.execute('DROP VIEW IF EXISTS vp_final_wide')
+
+    # Counts are already in vp_build_stats, so only the image export is slow. It runs in a
+    # separate process alongside the commit and is waited for before returning.
+    sankey_process = None
+
+    if plots is True:
+
+        _, sankey_process = sankey_plots(con, min_ogt_diff, background=True)
+
+    else:
         pass
-    
-    else:       
+
+    _write_watermarks(con, fingerprints)
+    metrics = _metrics_frame(metrics, fingerprints)
+
+    if persist_metrics:
+        _write_metrics(con, metrics)
+
+    if metrics_json is not None:
+        metrics.to_json(metrics_json, orient='records', date_format='iso', indent=1)
+
+    print('Finishing up...')
+    con.commit()
+    con.close()
+
+    if sankey_process is not None:
+        sankey_process.join()
+
+        if sankey_process.exitcode != 0:
+            print(f'Sankey image export failed with exit code {sankey_process.exitcode}.')
+
+    elapsed_time = time.perf_counter() - s_time
+    print(f'Finished. Total execution time: {elapsed_time} seconds')
+
+    return metrics
+
+
+def update_validprot(con, min_ogt_diff: int = 20, min_16s: int = 1300, changed: dict = None,
+                     sequence_features: bool = False, checksums: bool = True,
+                     profile: dict = None, persist_metrics: bool = True,
+                     metrics_json: str = None):
+    '''
+    Brings the ValidProt tables up to date with rows added to learn2therm since the last build
+    or update, without rebuilding them. Rows with keys above those recorded in
+    vp_build_watermarks are new. Rows edited or deleted in place keep their key, so their keys
+    are passed in changed instead.
+
+    New and changed rows are traced downstream to the taxa, taxa pairs, protein pairs and
+    proteins they affect. Each materialized stage table deletes and rebuilds only those rows,
+    reading its inputs restricted to the affected keys, so the cost follows the size of the change
+    rather than the size of vp_final. Stage fingerprints in vp_build_meta are moved on as if
+    build_validprot had run, so a following build skips every stage.
+
+    Rebuilt vp_final rows are appended in prot_pair_index order. New learn2therm rows carry higher
+    keys and keep vp_final sorted, while changed rows are only moved back in place by the next
+    full build. The counts in vp_build_stats are refreshed by the next build_validprot call.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object. Links script to DuckDB SQL
+        database.
+        min_ogt_diff (int): Cutoff used by the last build. Default 20 deg C.
+        min_16s (int): Cutoff used by the last build. Default 1300 bp.
+        changed (dict): Maps learn2therm table names to the keys of rows edited or deleted since
+        the last build or update, e.g. {'taxa': [12], 'protein_pairs': [1004, 1005]}.
+        sequence_features (bool): Setting used by the last build.
+        checksums (bool): Include row checksums in the new source fingerprints, as in
+        build_validprot.
+        profile (dict): Resource profile from resource_profile() applied to every stage.
+        Defaults to resource_profile() with settings detected from the machine.
+        persist_metrics (bool): Append the stage metrics to vp_build_metrics.
+        metrics_json (str): Optional path to also write the stage metrics to as JSON records.
+
+    Returns:
+        metrics (pandas.DataFrame): One row per stage with the columns of METRICS_COLUMNS.
+        Updated stages count the rows they rebuilt and stages that are not materialized are
+        listed as inlined. Database object is modified in place.
+
+    Raises:
+        ValueError: changed may only name learn2therm tables.
+        ValueError: Database has no recorded build to update.
+        ValueError: Rows at or below the watermark of a table changed and changed does not name
+        the table.
+        ValueError: vp_final must be up to date with a build using the same parameters and
+        without normalized sequences.
+        AttributeError: Database must be in the learn2therm format.
+    '''
+
+    changed = {} if changed is None else changed
+
+    if not all(table in L2T_TABLES for table in changed):
+        raise ValueError(f'changed may only contain learn2therm tables: {list(L2T_TABLES)}')
+
+    tables = con.execute("""SELECT TABLE_NAME
+                            FROM INFORMATION_SCHEMA.TABLES
+                            WHERE TABLE_TYPE='BASE TABLE'""").df()
+
+    if not all(item in tables['table_name'].values for item in L2T_TABLES):
         raise AttributeError('Database is not formatted for learn2therm.')
-    
-    s_time = time.time()
-    print('Constructing vp_taxa_pairs...')
 
-    # Builds ValidProt taxa pair table using only paired taxa from learn2therm
-    taxa_pairs_cmd = """CREATE OR REPLACE TABLE vp_taxa_pairs AS
-                        SELECT *
-                        FROM taxa_pairs
-                        WHERE is_pair = True"""
-    con.execute(taxa_pairs_cmd)
+    if _relation_type(con, WATERMARK_TABLE) is None:
+        raise ValueError('No build recorded in vp_build_watermarks. Run build_validprot first.')
+
+    watermark_columns = [column[0] for column in con.execute(f"""SELECT *
+                                                                 FROM {WATERMARK_TABLE}
+                                                                 LIMIT 0""").description]
+    if 'base_checksum' not in watermark_columns:
+        raise ValueError('vp_build_watermarks was written by an older build without row '
+                         'checksums. Run build_validprot first.')
+
+    s_time = time.perf_counter()
+    profile = resource_profile() if profile is None else profile
+    params = {'min_ogt_diff': min_ogt_diff, 'min_16s': min_16s, 'normalize_sequences': False,
+              'sequence_features': sequence_features}
+
+    watermarks = {source: (watermark, fingerprint, base_checksum)
+                  for source, watermark, fingerprint, base_checksum in
+                  con.execute(f"""SELECT source, watermark, fingerprint, base_checksum
+                                  FROM {WATERMARK_TABLE}""").fetchall()}
+    recorded = _read_build_meta(con)
+
+    # _find_delta only sees rows above the watermark and the keys in changed. Rows edited or
+    # deleted in place without their keys in changed would be missed while the new fingerprints
+    # marked every stage current, so they are caught by the checksum of the rows below it.
+    edited = [table for table, column in L2T_TABLES.items()
+              if table not in changed
+              and _base_checksum(con, table, column, watermarks[table][0]) != watermarks[table][2]]
+
+    if edited:
+        raise ValueError(f'Rows at or below the watermark of {edited} changed since the last '
+                         'build or update. Pass their keys in changed or run build_validprot.')
+
+    # Stage fingerprints as of the last build, to tell which stage tables are current, and as
+    # they will be once the update is applied.
+    previous = {table: watermarks[table][1] for table in L2T_TABLES}
+    fingerprints = {table: _table_fingerprint(con, table, checksums) for table in L2T_TABLES}
+    stages = []
+
+    for stage, sources, stage_params in VP_STAGES:
+
+        if stage in SEQUENCE_STAGES or (stage in FEATURE_STAGES and not sequence_features):
+            continue
+
+        for chain in [previous, fingerprints]:
+            chain[stage] = _stage_fingerprint(stage, {key: params[key] for key in stage_params},
+                                              [chain[source] for source in sources])
+        stages.append(stage)
+
+    # Stage tables left over from an older build are stale and left for build_validprot.
+    materialized = [stage for stage in stages
+                    if recorded.get(stage) == (previous[stage], 'complete')
+                    and _relation_type(con, stage) == 'BASE TABLE']
+
+    if 'vp_final' not in materialized:
+        raise ValueError('vp_final is not up to date with a build using these parameters and '
+                         'normalize_sequences=False. Run build_validprot instead.')
+
+    print('Finding new and changed rows...')
+    apply_resource_profile(con, profile)
+    counts = _find_delta(con, {table: watermarks[table][0] for table in L2T_TABLES}, changed,
+                         materialized)
+    print(', '.join(f'{count} {column}' for column, count in counts.items()) + ' affected.')
+
+    metrics = []
+
+    for stage in stages:
+
+        if stage not in materialized:
+            metrics.append({'stage': stage, 'status': 'inlined'})
+            continue
+
+        stage_profile = {'preserve_insertion_order': True} if stage in SORTED_STAGES else {}
+        apply_resource_profile(con, {**profile, **stage_profile})
+        stage_metrics = _run_stage(con, stage, fingerprints[stage],
+                                   _delta_sql(stage, materialized, **params))
+
+        # _run_stage counts the whole table, the update is measured by the rows it rebuilt.
+        key, _ = DELTA_STAGES[stage]
+        rows = con.execute(f"""SELECT COUNT(*)
+                               FROM {stage}
+                               WHERE {key} IN (SELECT {key} FROM vp_delta_{key})""").fetchone()[0]
+        wall_time = stage_metrics['wall_time_s']
+        stage_metrics.update({'status': 'updated', 'rows': rows,
+                              'rows_per_s': rows / wall_time if wall_time > 0 else None})
+        metrics.append(stage_metrics)
+
+    _write_watermarks(con, fingerprints)
+    metrics = _metrics_frame(metrics, fingerprints)
+
+    if persist_metrics:
+        _write_metrics(con, metrics)
+
+    if metrics_json is not None:
+        metrics.to_json(metrics_json, orient='records', date_format='iso', indent=1)
 
-    e_time = time.time()
-    elapsed_time = e_time - s_time
-    print(f'Finished constructing vp_taxa_pairs. Execution time: {elapsed_time} seconds')
-    print('Constructing vp_taxa...')
+    print('Finishing up...')
+    con.commit()
+    con.close()
 
-    # Commands to identify all taxa that are implicated in learn2therm pairs.
-    meso_cmd = """SELECT DISTINCT meso_index
-                  FROM taxa_pairs
-                  WHERE is_pair = True"""
-    thermo_cmd = """SELECT DISTINCT thermo_index
+    elapsed_time = time.perf_counter() - s_time
+    print(f'Finished. Total execution time: {elapsed_time} seconds')
+
+    return metrics
+
+
+def _find_delta(con, watermarks: dict, changed: dict, materialized: list):
+    '''
+    Collects the keys an incremental update rebuilds into temp tables vp_delta_<key column>, one
+    per learn2therm key. Keys are gathered from the watermarks and changed rows outwards: taxa,
+    the taxa pairs they take part in, the protein pairs of those taxa pairs and finally the
+    proteins on either side of the protein pairs. Where a row may have moved, both the old
+    version in the ValidProt tables and the new one in learn2therm are followed.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        watermarks (dict): Maps learn2therm tables to the highest key seen by the last build.
+        changed (dict): Maps learn2therm tables to keys of rows changed in place.
+        materialized (list): Stage tables that are up to date with the last build.
+
+    Returns:
+        counts (dict): Number of affected keys per key column.
+    '''
+    for table, column in L2T_TABLES.items():
+        keys = pd.DataFrame({column: pd.Series(changed.get(table, []), dtype='int64')})
+        con.register(f'vp_changed_{table}', keys)
+
+    con.execute(f"""CREATE OR REPLACE TEMP TABLE vp_delta_taxa_index AS
+                    SELECT taxa_index FROM taxa WHERE taxa_index > {watermarks['taxa']}
+                    UNION SELECT taxa_index FROM vp_changed_taxa""")
+
+    con.execute(f"""CREATE OR REPLACE TEMP TABLE vp_delta_taxa_pair_index AS
+                    SELECT taxa_pair_index
                     FROM taxa_pairs
-                    WHERE is_pair = True"""
+                    WHERE taxa_pair_index > {watermarks['taxa_pairs']}
+                    OR meso_index IN (SELECT taxa_index FROM vp_delta_taxa_index)
+                    OR thermo_index IN (SELECT taxa_index FROM vp_delta_taxa_index)
+                    UNION SELECT taxa_pair_index FROM vp_changed_taxa_pairs""")
+
+    con.execute("""CREATE OR REPLACE TEMP TABLE vp_delta_protein_int_index AS
+                    SELECT protein_int_index FROM vp_changed_proteins""")
+
+    con.execute(f"""CREATE OR REPLACE TEMP TABLE vp_delta_prot_pair_index AS
+                    SELECT prot_pair_index
+                    FROM protein_pairs
+                    WHERE prot_pair_index > {watermarks['protein_pairs']}
+                    OR taxa_pair_index IN (SELECT taxa_pair_index FROM vp_delta_taxa_pair_index)
+                    OR meso_protein_int_index IN (SELECT protein_int_index
+                                                  FROM vp_delta_protein_int_index)
+                    OR thermo_protein_int_index IN (SELECT protein_int_index
+                                                    FROM vp_delta_protein_int_index)
+                    UNION SELECT prot_pair_index FROM vp_changed_protein_pairs""")
+
+    # Taxa on either side of the affected taxa pairs may join or leave vp_taxa.
+    for pairs in ['taxa_pairs'] + [stage for stage in ['vp_taxa_pairs'] if stage in materialized]:
+        for role in ['meso', 'thermo']:
+            con.execute(f"""INSERT INTO vp_delta_taxa_index
+                            SELECT {role}_index
+                            FROM {pairs}
+                            WHERE taxa_pair_index IN (SELECT taxa_pair_index
+                                                      FROM vp_delta_taxa_pair_index)""")
+
+    # Proteins of the affected protein pairs may join or leave vp_proteins, and the taxa pairs
+    # those pairs belong to change their span in vp_taxa_pair_lookup.
+    for pairs in ['protein_pairs', 'vp_final']:
+        for column in ['meso_protein_int_index', 'thermo_protein_int_index']:
+            con.execute(f"""INSERT INTO vp_delta_protein_int_index
+                            SELECT {column}
+                            FROM {pairs}
+                            WHERE prot_pair_index IN (SELECT prot_pair_index
+                                                      FROM vp_delta_prot_pair_index)""")
+
+        con.execute(f"""INSERT INTO vp_delta_taxa_pair_index
+                        SELECT taxa_pair_index
+                        FROM {pairs}
+                        WHERE prot_pair_index IN (SELECT prot_pair_index
+                                                  FROM vp_delta_prot_pair_index)""")
+
+    for table in L2T_TABLES:
+        con.unregister(f'vp_changed_{table}')
+
+    return {column: con.execute(f"""SELECT COUNT(DISTINCT {column})
+                                    FROM vp_delta_{column}""").fetchone()[0]
+            for column in L2T_TABLES.values()}
+
+
+def _delta_sql(stage: str, materialized: list, min_ogt_diff: int, min_16s: int,
+               normalize_sequences: bool = False, sequence_features: bool = False):
+    '''
+    Compiles the incremental update of one ValidProt stage. Temp views named after the stage's
+    inputs shadow the full tables with only their delta rows, since DuckDB resolves the temp schema
+    first. Rows whose key is in the stage's delta are then deleted and rebuilt with the stage's
+    SELECT, with upstream stages that are not materialized inlined from the shadowed tables as
+    in a fused build.
+
+    Args:
+        stage (str): Name of the stage table to update, a key of DELTA_STAGES.
+        materialized (list): Up to date stage tables that are read directly instead of as CTEs.
+        min_ogt_diff (int): Cutoff for minimum difference in optimal growth temperature.
+        min_16s (int): Cutoff for minimum 16S read length for taxa.
+        normalize_sequences (bool): Whether vp_final refers to vp_sequences by id.
+        sequence_features (bool): Whether vp_final carries the per-protein sequence features.
+
+    Returns:
+        cmd (str): Statements that shadow the inputs, update the stage and drop the shadows.
+    '''
+    params = {'min_ogt_diff': min_ogt_diff, 'min_16s': min_16s,
+              'normalize_sequences': normalize_sequences, 'sequence_features': sequence_features}
+    key, inputs = DELTA_STAGES[stage]
+    shadowed = [(table, column) for table, column in inputs
+                if table in L2T_TABLES or table in materialized]
+
+    views = [f"""CREATE OR REPLACE TEMP VIEW {table} AS
+                 SELECT *
+                 FROM main.{table}
+                 WHERE {column} IN (SELECT {column} FROM vp_delta_{column})"""
+             for table, column in shadowed]
+    ctes = _fused_ctes(stage, materialized, **params)
+    cte_cmd = 'WITH ' + ',\n'.join(ctes) if ctes else ''
+
+    update = [f"""DELETE FROM main.{stage} WHERE {key} IN (SELECT {key} FROM vp_delta_{key})""",
+              f"""INSERT INTO main.{stage}
+                  {cte_cmd}
+                  {_stage_select(stage, **params)}"""]
+    drops = [f'DROP VIEW temp.{table}' for table, _ in shadowed]
+
+    return ';\n'.join(views + update + drops)
+
+
+def _write_watermarks(con, fingerprints: dict):
+    '''
+    Records the highest key, the fingerprint and the checksum of the rows up to the highest key
+    of each learn2therm table in vp_build_watermarks.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        fingerprints (dict): Maps learn2therm tables to the fingerprints the build used.
+
+    Returns:
+        None. vp_build_watermarks is replaced.
+    '''
+    rows = []
+
+    for table, column in L2T_TABLES.items():
+        watermark = con.execute(f"""SELECT COALESCE(MAX({column}), -1)
+                                    FROM {table}""").fetchone()[0]
+        rows.append([table, watermark, fingerprints[table],
+                     _base_checksum(con, table, column, watermark)])
+
+    con.execute(f"""CREATE OR REPLACE TABLE {WATERMARK_TABLE} (source VARCHAR,
+                                                              watermark BIGINT,
+                                                              fingerprint VARCHAR,
+                                                              base_checksum VARCHAR)""")
+    con.executemany(f"""INSERT INTO {WATERMARK_TABLE} VALUES (?, ?, ?, ?)""", rows)
+
 
-    useful_thermo = con.execute(thermo_cmd).df()
-    useful_meso = con.execute(meso_cmd).df()
+def _base_checksum(con, table: str, column: str, watermark: int):
+    '''
+    Checksums the rows of a learn2therm table with keys at or below a watermark, so edits and
+    deletions of rows an earlier build already read change it.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        table (str): Name of the learn2therm table.
+        column (str): Key column of the table.
+        watermark (int): Highest key included.
 
-    # Generates tuple object containing all relevant taxa
-    useful_taxa = tuple(list(useful_meso['meso_index']) + list(useful_thermo['thermo_index']))
+    Returns:
+        checksum (str): Row count and order independent checksum joined as a string.
+    '''
+    count, checksum = con.execute(f"""SELECT COUNT(*), bit_xor(hash(t))
+                                      FROM {table} AS t
+                                      WHERE {column} <= ?""", [watermark]).fetchone()
+
+    return f'{count}:{checksum}'
+
+
+def _metrics_frame(metrics: list, fingerprints: dict):
+    '''
+    Collects stage metrics into the table returned by build_validprot and update_validprot.
+
+    Args:
+        metrics (list): Dicts with any of the keys of METRICS_COLUMNS, one per stage.
+        fingerprints (dict): Fingerprints of the learn2therm tables the build read.
+
+    Returns:
+        metrics (pandas.DataFrame): Stage metrics under a fresh build_id.
+    '''
+    metrics = pd.DataFrame(metrics, columns=list(METRICS_COLUMNS))
+    metrics['build_id'] = uuid.uuid4().hex
+    metrics['source_fingerprint'] = _stage_fingerprint('source', {},
+                                                       [fingerprints[t] for t in L2T_TABLES])
+
+    return metrics
+
+
+def _write_metrics(con, metrics: pd.DataFrame):
+    '''
+    Appends a build's stage metrics to vp_build_metrics, creating the table if needed.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        metrics (pandas.DataFrame): Stage metrics as returned by build_validprot.
+    '''
+    columns = ', '.join(f'{column} {dtype}' for column, dtype in METRICS_COLUMNS.items())
+    con.execute(f'CREATE TABLE IF NOT EXISTS {METRICS_TABLE} ({columns})')
 
-    # Builds ValidProt taxa table using only paired taxa from learn2therm.
-    taxa_cmd = f"""CREATE OR REPLACE TABLE vp_taxa AS
+    # Rows are passed as Python values so missing measurements are stored as NULL.
+    rows = metrics[list(METRICS_COLUMNS)].astype(object).where(metrics.notna(), None)
+    placeholders = ', '.join('?' for _ in METRICS_COLUMNS)
+    con.executemany(f'INSERT INTO {METRICS_TABLE} VALUES ({placeholders})',
+                    rows.values.tolist())
+
+
+def _build_shards(con, db_path: str, fingerprint: str, materialized: list, recorded: dict,
+                  force: bool, params: dict, n_shards: int, workers: int, shard_dir: str,
+                  merge: bool, profile: dict, worker_profile: dict):
+    '''
+    Builds vp_final as taxa pair hash shards in worker processes, then merges them into the
+    database or exposes them through a view. Each worker only joins its own taxa pairs and their
+    proteins, see _shard_setup. Shards whose fingerprint is unchanged and whose file exists are
+    reused. The connection is closed while the workers run and a new one is returned.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        db_path (str): Path of the database file behind con.
+        fingerprint (str): Fingerprint of vp_final.
+        materialized (list): Up to date stage tables that are read directly instead of as CTEs.
+        recorded (dict): Stage name to (fingerprint, status) from vp_build_meta.
+        force (bool): Rebuild every shard regardless of recorded fingerprints.
+        params (dict): Build parameters passed to _stage_select.
+        n_shards (int): Number of shards.
+        workers (int): Number of worker processes.
+        shard_dir (str): Directory for the shard files.
+        merge (bool): Copy the shards into a vp_final table instead of creating a view.
+        profile (dict): Resource profile applied to the reopened connection for the merge.
+        worker_profile (dict): Resource profile applied in each worker.
+
+    Returns:
+        con (duckdb.DuckDBPyConnection): New connection to the database.
+        metrics (list): Metrics dictionaries for every shard and for the merge.
+
+    Raises:
+        RuntimeError: One or more shards failed to build.
+    '''
+    os.makedirs(shard_dir, exist_ok=True)
+
+    paths = [os.path.abspath(os.path.join(shard_dir, f'shard_{shard:05d}.parquet'))
+             for shard in range(n_shards)]
+    metrics = []
+    tasks = []
+
+    # Files left over from a build with more shards would otherwise be merged too.
+    for path in glob.glob(os.path.join(shard_dir, 'shard_*.parquet')):
+        if os.path.abspath(path) not in paths:
+            os.remove(path)
+
+    for shard, path in enumerate(paths):
+
+        name = f'vp_final_shard_{shard}'
+        shard_fingerprint = _stage_fingerprint(name, {'n_shards': n_shards}, [fingerprint])
+
+        if not force and recorded.get(name) == (shard_fingerprint, 'complete') and \
+           os.path.exists(path):
+            print(f'Skipping {name}, inputs unchanged since last build.')
+            metrics.append({'stage': name, 'status': 'skipped'})
+            continue
+
+        # Every worker spills to its own directory so they do not share DuckDB temp files.
+        temp_directory = os.path.join(worker_profile['temp_directory'] or shard_dir,
+                                      f'tmp_{shard}')
+
+        tasks.append({'stage': name,
+                      'fingerprint': shard_fingerprint,
+                      'db_path': db_path,
+                      'path': path,
+                      'profile': {**worker_profile, 'temp_directory': temp_directory},
+                      'setup': _shard_setup(materialized, n_shards, shard, **params),
+                      'cmd': f"""COPY ({_stage_select('vp_final', **params)})
+                                TO '{path}.tmp' (FORMAT PARQUET, COMPRESSION ZSTD)"""})
+
+    if tasks:
+
+        print(f'Constructing {len(tasks)} vp_final shards with {workers} workers...')
+        con.commit()
+        con.close()
+
+        # Fresh spawned processes keep DuckDB's threads out of fork and return each shard's
+        # memory to the system when it finishes.
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(min(workers, len(tasks)), maxtasksperchild=1) as pool:
+            results = list(pool.imap_unordered(_build_shard, tasks))
+
+        con = duckdb.connect(db_path)
+        results = {result['stage']: result for result in results}
+
+        for task in tasks:
+            _record_shard(con, task['fingerprint'], results[task['stage']])
+            metrics.append(results[task['stage']])
+
+        failed = [result for result in results.values() if result['status'] == 'failed']
+
+        # Nothing holds the reopened connection if the build fails, so it is closed here.
+        if failed:
+            con.commit()
+            con.close()
+            raise RuntimeError(f'{len(failed)} of {n_shards} vp_final shards failed: ' +
+                               '; '.join(f"{result['stage']}: {result['error']}"
+                                         for result in failed))
+
+    apply_resource_profile(con, profile)
+    file_list = ', '.join(f"'{path}'" for path in paths)
+
+    # DuckDB will not replace a table with a view or the reverse. Shards are each sorted, but only
+    # a merged vp_final is sorted as a whole.
+    if merge:
+        if _relation_type(con, 'vp_final') == 'VIEW':
+            con.execute('DROP VIEW vp_final')
+        cmd = f"""CREATE OR REPLACE TABLE vp_final AS
                    SELECT *
-                   FROM taxa
-                   WHERE taxa_index IN {useful_taxa}"""
-    con.execute(taxa_cmd)
+                   FROM read_parquet([{file_list}])
+                   ORDER BY prot_pair_index"""
+    else:
+        if _relation_type(con, 'vp_final') == 'BASE TABLE':
+            con.execute('DROP TABLE vp_final')
+        cmd = f'CREATE OR REPLACE VIEW vp_final AS SELECT * FROM read_parquet([{file_list}])'
+
+    metrics.append(_run_stage(con, 'vp_final', fingerprint, cmd))
+
+    return con, metrics
+
+
+def _build_shard(task: dict):
+    '''
+    Worker process body for one vp_final shard. Opens the database read-only, writes the shard to
+    a temporary file and moves it into place only once complete, so a crashed worker never leaves
+    a file that looks finished. Errors are returned rather than raised so other shards carry on.
+
+    Args:
+        task (dict): Shard description built by _build_shards.
+
+    Returns:
+        metrics (dict): Stage metrics for the shard, with an error message if it failed.
+    '''
+    result = {'stage': task['stage'], 'started_at': datetime.datetime.now()}
+    temp_directory = task['profile']['temp_directory']
+
+    try:
+        con = duckdb.connect(task['db_path'], read_only=True)
+        apply_resource_profile(con, task['profile'])
+        memory_limit, threads = con.execute("""SELECT current_setting('memory_limit'),
+                                                current_setting('threads')""").fetchone()
+
+        monitor = _ResourceMonitor(temp_directory)
+        monitor.start()
+
+        try:
+            for cmd in task['setup'] + [task['cmd']]:
+                con.execute(cmd)
+        finally:
+            peak_memory, spill, bytes_written = monitor.stop()
 
-    e_time2 = time.time()
-    elapsed_time = e_time2 - e_time
-    print(f'Finished constructing vp_taxa. Execution time: {elapsed_time} seconds')
-    print('Filtering on ogt and 16S sequence parameters...')
+        os.replace(f"{task['path']}.tmp", task['path'])
+        rows = con.execute(f"""SELECT COUNT(*)
+                                FROM read_parquet('{task['path']}')""").fetchone()[0]
+        con.close()
+
+    except Exception as error:
+
+        if os.path.exists(f"{task['path']}.tmp"):
+            os.remove(f"{task['path']}.tmp")
+
+        return {**result, 'status': 'failed', 'error': repr(error),
+                'finished_at': datetime.datetime.now()}
+
+    finally:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+
+    wall_time = monitor.elapsed
+    print(f"Finished constructing {task['stage']}. Execution time: {wall_time} seconds")
+
+    return {**result,
+            'status': 'complete',
+            'finished_at': datetime.datetime.now(),
+            'wall_time_s': wall_time,
+            'rows': rows,
+            'rows_per_s': rows / wall_time if wall_time > 0 else None,
+            'bytes_written': bytes_written,
+            'peak_memory_bytes': peak_memory,
+            'spill_bytes': spill,
+            'memory_limit': memory_limit,
+            'threads': threads}
+
+
+def _record_shard(con, fingerprint: str, result: dict):
+    '''
+    Records the outcome of a shard worker in vp_build_meta.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        fingerprint (str): Fingerprint of the shard.
+        result (dict): Metrics returned by _build_shard.
+    '''
+    con.execute(f"""DELETE FROM {META_TABLE} WHERE stage = ?""", [result['stage']])
+    con.execute(f"""INSERT INTO {META_TABLE} (stage, fingerprint, status, started_at,
+                                              finished_at, memory_limit, threads,
+                                              peak_memory_bytes, spill_bytes)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [result['stage'], fingerprint, result['status'], result['started_at'],
+                 result['finished_at'], result.get('memory_limit'), result.get('threads'),
+                 result.get('peak_memory_bytes'), result.get('spill_bytes')])
+
+
+def _relation_type(con, name: str):
+    '''
+    Looks up whether a table or view exists under name.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        name (str): Table or view name.
+
+    Returns:
+        table_type (str): 'BASE TABLE', 'VIEW' or None if nothing is called name.
+    '''
+    row = con.execute("""SELECT TABLE_TYPE
+                          FROM INFORMATION_SCHEMA.TABLES
+                          WHERE TABLE_NAME = ?""", [name]).fetchone()
+
+    return None if row is None else row[0]
+
+
+def _hash_bucket(column: str, n_buckets: int):
+    '''
+    Returns a SQL expression assigning rows to one of n_buckets by a hash of column. The modulus
+    is cast to UBIGINT because DuckDB otherwise evaluates hash() % n in floating point, which
+    loses the low bits of the hash.
+
+    Args:
+        column (str): Column to hash.
+        n_buckets (int): Number of buckets.
+
+    Returns:
+        cmd (str): SQL expression evaluating to an INTEGER in [0, n_buckets).
+    '''
+    return f'CAST(hash({column}) % CAST({n_buckets} AS UBIGINT) AS INTEGER)'
+
+
+def _stage_select(stage: str, min_ogt_diff: int, min_16s: int,
+                  normalize_sequences: bool = False, sequence_features: bool = False):
+    '''
+    Returns the SELECT statement that produces one ValidProt stage table. Statements refer to
+    earlier stages by table name so they can be run against materialized tables or used as CTEs.
+
+    Args:
+        stage (str): Name of the stage table, one of the entries of VP_STAGES.
+        min_ogt_diff (int): Cutoff for minimum difference in optimal growth temperature.
+        min_16s (int): Cutoff for minimum 16S read length for taxa.
+        normalize_sequences (bool): Whether vp_final refers to vp_sequences by id.
+        sequence_features (bool): Whether vp_final carries the per-protein sequence features.
+
+    Returns:
+        cmd (str): SELECT statement for the stage.
+    '''
+
+    # Feature columns and joins appended to vp_final when sequence features are on.
+    feature_columns, feature_joins = '', ''
+
+    if sequence_features:
+
+        feature_columns = ''.join(f',\n{role}_features.{name} AS {role}_{name}'
+                                  for role in ['m', 't'] for name in SEQUENCE_FEATURES)
+        feature_joins = """
+                  JOIN vp_protein_features AS m_features
+                  ON (vp_protein_pairs.meso_protein_int_index = m_features.protein_int_index)
+                  JOIN vp_protein_features AS t_features
+                  ON (vp_protein_pairs.thermo_protein_int_index = t_features.protein_int_index)"""
+
+    # Builds ValidProt taxa pair table using only paired taxa from learn2therm
+    if stage == 'vp_taxa_pairs':
+
+        return """SELECT *
+                  FROM taxa_pairs
+                  WHERE is_pair = True"""
+
+    # Builds ValidProt taxa table using only paired taxa from learn2therm. Semi-joins against
+    # taxa_pairs so the taxa list never leaves the database.
+    if stage == 'vp_taxa':
+
+        return """SELECT *
+                  FROM taxa
+                  WHERE taxa_index IN (SELECT meso_index
+                                       FROM taxa_pairs
+                                       WHERE is_pair = True)
+                  OR taxa_index IN (SELECT thermo_index
+                                    FROM taxa_pairs
+                                    WHERE is_pair = True)"""
 
     # Builds ValidProt table containing taxa pairs and their associated optimal growth temperatures
     # (ogt). Excludes 16S sequences and ogt difference below cutoff values from function input.
-    ogt_pairs_cmd = f"""CREATE OR REPLACE TABLE vp_ogt_taxa_pairs AS SELECT vp_taxa_pairs.*,
-                        taxa_m.ogt AS meso_ogt,
-                        taxa_t.ogt AS thermo_ogt,
-                        taxa_t.ogt - taxa_m.ogt AS ogt_diff,
-                        taxa_m.len_16s AS meso_16s_len,
-                        taxa_t.len_16s AS thermo_16s_len
-                        FROM vp_taxa_pairs
-                        JOIN vp_taxa AS taxa_m ON (vp_taxa_pairs.meso_index = taxa_m.taxa_index)
-                        JOIN vp_taxa AS taxa_t ON (vp_taxa_pairs.thermo_index = taxa_t.taxa_index)
-                        WHERE ogt_diff >= {min_ogt_diff}
-                        AND meso_16s_len >= {min_16s}
-                        AND thermo_16s_len >= {min_16s}"""
-    con.execute(ogt_pairs_cmd)
-
-    e_time3 = time.time()
-    elapsed_time = e_time3 - e_time2
-    print(f'Finished filtering. Execution time: {elapsed_time} seconds')
-    print('Constructing vp_protein_pairs...')
+    if stage == 'vp_ogt_taxa_pairs':
+
+        return f"""SELECT vp_taxa_pairs.*,
+                   taxa_m.ogt AS meso_ogt,
+                   taxa_t.ogt AS thermo_ogt,
+                   taxa_t.ogt - taxa_m.ogt AS ogt_diff,
+                   taxa_m.len_16s AS meso_16s_len,
+                   taxa_t.len_16s AS thermo_16s_len
+                   FROM vp_taxa_pairs
+                   JOIN vp_taxa AS taxa_m ON (vp_taxa_pairs.meso_index = taxa_m.taxa_index)
+                   JOIN vp_taxa AS taxa_t ON (vp_taxa_pairs.thermo_index = taxa_t.taxa_index)
+                   WHERE ogt_diff >= {min_ogt_diff}
+                   AND meso_16s_len >= {min_16s}
+                   AND thermo_16s_len >= {min_16s}"""
 
     # Builds ValidProt table containing protein pairs
-    protein_pair_cmd = """CREATE OR REPLACE TABLE vp_protein_pairs AS
-                          SELECT protein_pairs.*,
-                          otp.local_gap_compressed_percent_id AS local_gap_compressed_percent_id_16s,
-                          otp.scaled_local_query_percent_id AS scaled_local_query_percent_id_16s,
-                          otp.scaled_local_symmetric_percent_id AS scaled_local_symmetric_percent_id_16s,
-                          otp.query_align_cov AS query_align_cov_16s,
-                          otp.subject_align_cov AS subject_align_cov_16s,
-                          otp.bit_score AS bit_score_16s,
-                          otp.meso_ogt AS m_ogt,
-                          otp.thermo_ogt AS t_ogt,
-                          otp.ogt_diff AS ogt_difference
-                          FROM protein_pairs
-                          INNER JOIN vp_ogt_taxa_pairs AS otp
-                          ON (protein_pairs.taxa_pair_index = otp.taxa_pair_index)"""
-    con.execute(protein_pair_cmd)
-
-    e_time4 = time.time()
-    elapsed_time = e_time4 - e_time3
-    print(f'Finished constructing vp_protein_pairs. Execution time: {elapsed_time} seconds')
-    print('Constructing vp_proteins...')
+    if stage == 'vp_protein_pairs':
+
+        return """SELECT protein_pairs.*,
+                  otp.local_gap_compressed_percent_id AS local_gap_compressed_percent_id_16s,
+                  otp.scaled_local_query_percent_id AS scaled_local_query_percent_id_16s,
+                  otp.scaled_local_symmetric_percent_id AS scaled_local_symmetric_percent_id_16s,
+                  otp.query_align_cov AS query_align_cov_16s,
+                  otp.subject_align_cov AS subject_align_cov_16s,
+                  otp.bit_score AS bit_score_16s,
+                  otp.meso_ogt AS m_ogt,
+                  otp.thermo_ogt AS t_ogt,
+                  otp.ogt_diff AS ogt_difference
+                  FROM protein_pairs
+                  INNER JOIN vp_ogt_taxa_pairs AS otp
+                  ON (protein_pairs.taxa_pair_index = otp.taxa_pair_index)"""
 
     # Builds ValidProt table containing proteins that belong to taxa from vp_taxa_pairs.
-    prot_filt_cmd = """CREATE OR REPLACE TABLE vp_proteins AS SELECT *
-                       FROM proteins
-                       WHERE protein_int_index IN (SELECT DISTINCT meso_protein_int_index FROM protein_pairs) OR
-                       protein_int_index IN (SELECT DISTINCT thermo_protein_int_index FROM protein_pairs)
-                    """
-    con.execute(prot_filt_cmd)
-
-    e_time5 = time.time()
-    elapsed_time = e_time5 - e_time4
-    print(f'Finished constructing vp_proteins. Execution time: {elapsed_time} seconds')
-    print('Constructing final dataset...')
+    if stage == 'vp_proteins':
+
+        return """SELECT *
+                  FROM proteins
+                  WHERE protein_int_index IN (SELECT DISTINCT meso_protein_int_index FROM protein_pairs) OR
+                  protein_int_index IN (SELECT DISTINCT thermo_protein_int_index FROM protein_pairs)
+               """
+
+    # Stores each unique protein sequence once with a compact integer id.
+    if stage == 'vp_sequences':
+
+        return """SELECT CAST(row_number() OVER (ORDER BY seq_hash) AS INTEGER) AS seq_id,
+                  seq_hash,
+                  protein_seq
+                  FROM (SELECT md5(protein_seq) AS seq_hash,
+                        first(protein_seq) AS protein_seq
+                        FROM vp_proteins
+                        GROUP BY seq_hash)"""
+
+    # Maps each ValidProt protein to its sequence id. Descriptions are kept once per protein.
+    if stage == 'vp_protein_refs':
+
+        return """SELECT vp_proteins.protein_int_index,
+                  vp_sequences.seq_id,
+                  vp_proteins.protein_desc,
+                  vp_proteins.protein_len
+                  FROM vp_proteins
+                  JOIN vp_sequences ON (md5(vp_proteins.protein_seq) = vp_sequences.seq_hash)"""
+
+    # Counts each amino acid by the length lost when it is removed, which DuckDB runs as
+    # vectorized string functions, then derives the features from the counts.
+    if stage == 'vp_protein_features':
+
+        counts = ',\n'.join(f"length(protein_seq) - length(replace(protein_seq, '{aa}', ''))"
+                            f" AS n_{aa}" for aa in AMINO_ACIDS)
+        features = ',\n'.join(f'CAST({expr} AS REAL) AS {name}'
+                              for name, expr in SEQUENCE_FEATURES.items())
+
+        return f"""SELECT protein_int_index,
+                   {features}
+                   FROM (SELECT protein_int_index,
+                         CAST(NULLIF(length(protein_seq), 0) AS DOUBLE) AS n,
+                         {counts}
+                         FROM vp_proteins) AS residue_counts"""
+
+    # Builds final ValidProt data table holding only sequence ids.
+    if stage == 'vp_final' and normalize_sequences:
+
+        return f"""SELECT vp_protein_pairs.*,
+                  refs_m.seq_id AS m_seq_id,
+                  refs_t.seq_id AS t_seq_id,
+                  refs_m.protein_len AS m_protein_len,
+                  refs_t.protein_len AS t_protein_len{feature_columns}
+                  FROM vp_protein_pairs
+                  JOIN vp_protein_refs AS refs_m
+                  ON (vp_protein_pairs.meso_protein_int_index = refs_m.protein_int_index)
+                  JOIN vp_protein_refs AS refs_t
+                  ON (vp_protein_pairs.thermo_protein_int_index = refs_t.protein_int_index)
+                  {feature_joins}
+                  ORDER BY vp_protein_pairs.prot_pair_index"""
 
     # Builds final ValidProt data table for downstream sampling.
-    big_table_cmd = """CREATE OR REPLACE TABLE vp_final AS
-                       SELECT vp_protein_pairs.*,
-                       proteins_m.protein_seq AS m_protein_seq,
-                       proteins_t.protein_seq AS t_protein_seq,
-                       proteins_m.protein_desc AS m_protein_desc,
-                       proteins_t.protein_desc AS t_protein_desc,
-                       proteins_m.protein_len AS m_protein_len,
-                       proteins_t.protein_len AS t_protein_len
-                       FROM vp_protein_pairs
-                       JOIN vp_proteins AS proteins_m
-                       ON (vp_protein_pairs.meso_protein_int_index = proteins_m.protein_int_index)
-                       JOIN vp_proteins AS proteins_t
-                       ON (vp_protein_pairs.thermo_protein_int_index =
-                           proteins_t.protein_int_index)"""
-    con.execute(big_table_cmd)
+    if stage == 'vp_final':
+
+        return f"""SELECT vp_protein_pairs.*,
+                  proteins_m.protein_seq AS m_protein_seq,
+                  proteins_t.protein_seq AS t_protein_seq,
+                  proteins_m.protein_desc AS m_protein_desc,
+                  proteins_t.protein_desc AS t_protein_desc,
+                  proteins_m.protein_len AS m_protein_len,
+                  proteins_t.protein_len AS t_protein_len{feature_columns}
+                  FROM vp_protein_pairs
+                  JOIN vp_proteins AS proteins_m
+                  ON (vp_protein_pairs.meso_protein_int_index = proteins_m.protein_int_index)
+                  JOIN vp_proteins AS proteins_t
+                  ON (vp_protein_pairs.thermo_protein_int_index =
+                      proteins_t.protein_int_index)
+                  {feature_joins}
+                  ORDER BY vp_protein_pairs.prot_pair_index"""
+
+    # Lists the pairs each protein takes part in, in either role, sorted by protein.
+    if stage == 'vp_protein_lookup':
+
+        return """SELECT protein_int_index, prot_pair_index
+                  FROM (SELECT meso_protein_int_index AS protein_int_index, prot_pair_index
+                        FROM vp_final
+                        UNION ALL
+                        SELECT thermo_protein_int_index AS protein_int_index, prot_pair_index
+                        FROM vp_final) AS roles
+                  ORDER BY protein_int_index, prot_pair_index"""
+
+    # Records the span of prot_pair_index values each taxa pair occupies in vp_final.
+    if stage == 'vp_taxa_pair_lookup':
+
+        return """SELECT taxa_pair_index,
+                  MIN(prot_pair_index) AS first_prot_pair_index,
+                  MAX(prot_pair_index) AS last_prot_pair_index,
+                  COUNT(*) AS n_pairs
+                  FROM vp_final
+                  GROUP BY taxa_pair_index
+                  ORDER BY taxa_pair_index"""
+
+    raise ValueError(f'Unknown ValidProt stage {stage}.')
+
+
+def _fused_sql(stage: str, materialized: list, min_ogt_diff: int, min_16s: int,
+               normalize_sequences: bool = False, sequence_features: bool = False):
+    '''
+    Compiles a ValidProt stage and everything upstream of it into one command. Upstream stages
+    that are not already materialized are inlined as CTEs so DuckDB plans the chain as a single
+    query.
 
-    if plots is True:
+    Args:
+        stage (str): Name of the stage table to build.
+        materialized (list): Up to date stage tables that are read directly instead of as CTEs.
+        min_ogt_diff (int): Cutoff for minimum difference in optimal growth temperature.
+        min_16s (int): Cutoff for minimum 16S read length for taxa.
+        normalize_sequences (bool): Whether vp_final refers to vp_sequences by id.
+        sequence_features (bool): Whether vp_final carries the per-protein sequence features.
+
+    Returns:
+        cmd (str): CREATE OR REPLACE TABLE command for the stage.
+    '''
+    params = {'min_ogt_diff': min_ogt_diff, 'min_16s': min_16s,
+              'normalize_sequences': normalize_sequences, 'sequence_features': sequence_features}
+    ctes = _fused_ctes(stage, materialized, **params)
+    cte_cmd = 'WITH ' + ',\n'.join(ctes) if ctes else ''
+
+    return f"""CREATE OR REPLACE TABLE {stage} AS
+               {cte_cmd}
+               {_stage_select(stage, **params)}"""
+
+
+def _fused_ctes(stage: str, materialized: list, min_ogt_diff: int, min_16s: int,
+                normalize_sequences: bool = False, sequence_features: bool = False):
+    '''
+    Returns CTE definitions for every stage upstream of stage that is not already materialized.
+
+    Args:
+        stage (str): Name of the stage the CTEs feed.
+        materialized (list): Up to date stage tables that are read directly instead of as CTEs.
+        min_ogt_diff (int): Cutoff for minimum difference in optimal growth temperature.
+        min_16s (int): Cutoff for minimum 16S read length for taxa.
+        normalize_sequences (bool): Whether vp_final refers to vp_sequences by id.
+        sequence_features (bool): Whether vp_final carries the per-protein sequence features.
+
+    Returns:
+        ctes (list): '<stage> AS (<select>)' strings in build order.
+    '''
+    params = {'min_ogt_diff': min_ogt_diff, 'min_16s': min_16s,
+              'normalize_sequences': normalize_sequences, 'sequence_features': sequence_features}
+    ctes = []
+
+    for upstream, _, _ in VP_STAGES[:[name for name, _, _ in VP_STAGES].index(stage)]:
+
+        if upstream in materialized or upstream in SEQUENCE_STAGES + FEATURE_STAGES:
+            continue
+
+        # The inner joins in vp_final already restrict proteins to those in vp_protein_pairs,
+        # so the unfiltered table is read directly rather than scanning protein_pairs again.
+        if upstream == 'vp_proteins' and stage == 'vp_final':
+            ctes.append("""vp_proteins AS (SELECT * FROM proteins)""")
+        else:
+            ctes.append(f"""{upstream} AS ({_stage_select(upstream, **params)})""")
+
+    return ctes
+
+
+def _shard_setup(materialized: list, n_shards: int, shard: int, min_ogt_diff: int, min_16s: int,
+                 normalize_sequences: bool = False, sequence_features: bool = False):
+    '''
+    Returns the commands a shard worker runs before building its part of vp_final. They create
+    TEMP relations named after the upstream stages, which DuckDB resolves ahead of the main
+    tables, so the vp_final select runs unchanged against the shard.
+
+    The bucket predicate is applied where taxa pairs enter the chain, which is the last
+    materialized stage of TAXA_PAIR_STAGES or else vp_taxa_pairs, so the later joins only see
+    the shard's pairs. The protein stages vp_final reads are copied into TEMP tables holding only
+    the proteins of those pairs. The full protein table is then scanned once per worker instead
+    of once per protein role, and the joins read the shard's proteins alone. Views are used for
+    the rest because DuckDB treats a CTE reading main.<its own name> as recursive.
+
+    Args:
+        materialized (list): Up to date stage tables that are read directly instead of as CTEs.
+        n_shards (int): Number of shards.
+        shard (int): Shard to select, in [0, n_shards).
+        min_ogt_diff (int): Cutoff for minimum difference in optimal growth temperature.
+        min_16s (int): Cutoff for minimum 16S read length for taxa.
+        normalize_sequences (bool): Whether vp_final refers to vp_sequences by id.
+        sequence_features (bool): Whether vp_final carries the per-protein sequence features.
+
+    Returns:
+        cmds (list): CREATE TEMP VIEW and CREATE TEMP TABLE commands in build order.
+    '''
+    params = {'min_ogt_diff': min_ogt_diff, 'min_16s': min_16s,
+              'normalize_sequences': normalize_sequences, 'sequence_features': sequence_features}
+    entry = ([stage for stage in TAXA_PAIR_STAGES if stage in materialized] or
+             TAXA_PAIR_STAGES[:1])[-1]
+    read = ['vp_protein_refs' if normalize_sequences else 'vp_proteins'] + \
+           (FEATURE_STAGES if sequence_features else [])
+    source = f'main.{entry}' if entry in materialized else f'({_stage_select(entry, **params)})'
+    cmds = [f"""CREATE TEMP VIEW {entry} AS
+                SELECT *
+                FROM {source} AS shard_rows
+                WHERE {_hash_bucket('taxa_pair_index', n_shards)} = {shard}"""]
+
+    # Stages past the entry are rebuilt over the shard. vp_ogt_taxa_pairs also reads vp_taxa.
+    for upstream in TAXA_PAIR_STAGES[TAXA_PAIR_STAGES.index(entry) + 1:]:
+        if upstream == 'vp_ogt_taxa_pairs' and 'vp_taxa' not in materialized:
+            cmds.append(f"CREATE TEMP VIEW vp_taxa AS {_stage_select('vp_taxa', **params)}")
+        cmds.append(f'CREATE TEMP VIEW {upstream} AS {_stage_select(upstream, **params)}')
+
+    # An unmaterialized vp_proteins reads proteins directly, as the ids already come from pairs.
+    for upstream in read:
+        source = 'proteins' if upstream not in materialized else f'main.{upstream}'
+        cmds.append(f"""CREATE TEMP TABLE {upstream} AS
+                        SELECT *
+                        FROM {source} AS shard_rows
+                        WHERE protein_int_index IN (SELECT unnest([meso_protein_int_index,
+                                                                   thermo_protein_int_index])
+                                                    FROM vp_protein_pairs)""")
+
+    return cmds
+
+
+def _record_stats(con, stage: str, fingerprint: str, ctes: list):
+    '''
+    Runs the single aggregation pass attached to a stage and stores its counts in vp_build_stats.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        stage (str): Name of the stage, a key of STAGE_STATS.
+        fingerprint (str): Fingerprint the counts are valid for.
+        ctes (list): CTE definitions for stage tables that are not materialized.
+
+    Returns:
+        None. vp_build_stats is modified in place.
+    '''
+    cte_cmd = 'WITH ' + ',\n'.join(ctes + [TAXA_ROLES_CTE])
+    cursor = con.execute(f"""{cte_cmd}
+                             {STAGE_STATS[stage]}""")
+    values = cursor.fetchone()
+    names = [column[0] for column in cursor.description]
+
+    con.execute(f"""DELETE FROM {STATS_TABLE} WHERE stage = ?""", [stage])
+    con.executemany(f"""INSERT INTO {STATS_TABLE} VALUES (?, ?, ?, ?)""",
+                    [[stage, fingerprint, name, int(value)] for name, value in zip(names, values)])
+
+
+def _run_stage(con, stage: str, fingerprint: str, cmd: str):
+    '''
+    Executes one build stage and records its fingerprint, status and resource use in
+    vp_build_meta. A stage that raises is recorded as failed before the error is passed on.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object with the stage's resource
+                                         profile applied.
+        stage (str): Name of the stage table.
+        fingerprint (str): Fingerprint of the stage inputs.
+        cmd (str): SQL command that builds the stage.
+
+    Returns:
+        metrics (dict): Stage metrics with the keys of METRICS_COLUMNS other than build_id and
+                        source_fingerprint.
+    '''
+    print(f'Constructing {stage}...')
+
+    memory_limit, threads, temp_directory = con.execute("""SELECT current_setting('memory_limit'),
+                                                           current_setting('threads'),
+                                                           current_setting('temp_directory')
+                                                           """).fetchone()
+
+    con.execute(f"""DELETE FROM {META_TABLE} WHERE stage = ?""", [stage])
+    con.execute(f"""INSERT INTO {META_TABLE} (stage, fingerprint, status, started_at,
+                                              memory_limit, threads)
+                    VALUES (?, ?, 'running', current_timestamp, ?, ?)""",
+                [stage, fingerprint, memory_limit, threads])
+
+    monitor = _ResourceMonitor(temp_directory)
+    monitor.start()
+
+    try:
+        con.execute(cmd)
+
+    except Exception:
+        peak_memory, spill, _ = monitor.stop()
+        con.execute(f"""UPDATE {META_TABLE}
+                        SET status = 'failed', finished_at = current_timestamp,
+                        peak_memory_bytes = ?, spill_bytes = ?
+                        WHERE stage = ?""", [peak_memory, spill, stage])
+        raise
+
+    peak_memory, spill, bytes_written = monitor.stop()
+    wall_time = monitor.elapsed
+    con.execute(f"""UPDATE {META_TABLE}
+                    SET status = 'complete', finished_at = current_timestamp,
+                    peak_memory_bytes = ?, spill_bytes = ?
+                    WHERE stage = ?""", [peak_memory, spill, stage])
+
+    rows = con.execute(f"""SELECT COUNT(*) FROM {stage}""").fetchone()[0]
+
+    print(f'Finished constructing {stage}. Execution time: {wall_time} seconds')
+    print(f'{rows} rows, peak memory {peak_memory / 1024 ** 2:.0f} MB, '
+          f'spilled {spill / 1024 ** 2:.0f} MB.')
+
+    return {'stage': stage,
+            'status': 'complete',
+            'started_at': monitor.started_at,
+            'wall_time_s': wall_time,
+            'rows': rows,
+            'rows_per_s': rows / wall_time if wall_time > 0 else None,
+            'bytes_written': bytes_written,
+            'peak_memory_bytes': peak_memory,
+            'spill_bytes': spill,
+            'memory_limit': memory_limit,
+            'threads': threads}
+
+
+class _ResourceMonitor:
+    '''
+    Times a stage and samples process memory and the size of DuckDB's temp directory on a
+    background thread while it runs. Peaks are sampled, so very short spikes between samples can
+    be missed. Bytes written are read from the operating system's I/O counters where available.
+    '''
+
+    def __init__(self, temp_directory: str, interval: float = 0.05):
+        self.temp_directory = temp_directory
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_memory = 0
+        self.peak_spill = 0
+        self.started_at = None
+        self.elapsed = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+
+    def start(self):
+        '''
+        Starts timing and sampling.
+        '''
+        self.started_at = datetime.datetime.now()
+        self._written = self._write_bytes()
+        self._start = time.perf_counter()
+        self._sample()
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops sampling and returns the peak process memory, spill volume and bytes written, all
+        in bytes. Bytes written is None where the platform has no I/O counters.
+        '''
+        self.elapsed = time.perf_counter() - self._start
+        self._done.set()
+        self._thread.join()
+        self._sample()
+
+        written = self._write_bytes()
+        bytes_written = None if written is None else written - self._written
+
+        return self.peak_memory, self.peak_spill, bytes_written
+
+    def _poll(self):
+        while not self._done.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        self.peak_memory = max(self.peak_memory, self.process.memory_info().rss)
+        self.peak_spill = max(self.peak_spill, _directory_size(self.temp_directory))
+
+    def _write_bytes(self):
+        # io_counters is not available on macOS.
+        if not hasattr(self.process, 'io_counters'):
+            return None
+
+        return self.process.io_counters().write_bytes
+
+
+def _directory_size(path: str):
+    '''
+    Returns the total size in bytes of the files under path, or 0 if it does not exist.
+    '''
+    size = 0
 
-        sankey_plots(con, min_ogt_diff)
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                # DuckDB removes temp files as soon as they are no longer needed.
+                pass
 
+    return size
+
+
+def _read_build_meta(con):
+    '''
+    Reads recorded stage fingerprints from vp_build_meta.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+
+    Returns:
+        recorded (dict): Maps stage name to a (fingerprint, status) tuple.
+    '''
+    meta = con.execute(f"""SELECT stage, fingerprint, status FROM {META_TABLE}""").fetchall()
+
+    return {stage: (fingerprint, status) for stage, fingerprint, status in meta}
+
+
+def _table_fingerprint(con, table: str, checksums: bool = True):
+    '''
+    Fingerprints a learn2therm source table by its columns, its row count and, optionally, an
+    order independent checksum of every row.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        table (str): Name of the table to fingerprint.
+        checksums (bool): Whether to hash every row in addition to counting them.
+
+    Returns:
+        fingerprint (str): Columns, row count and checksum joined as a string.
+    '''
+    columns = con.execute("""SELECT column_name
+                             FROM INFORMATION_SCHEMA.COLUMNS
+                             WHERE table_name = ?
+                             ORDER BY ordinal_position""", [table]).fetchall()
+    columns = ','.join(column[0] for column in columns)
+
+    if checksums:
+        count, checksum = con.execute(f"""SELECT COUNT(*), bit_xor(hash(t))
+                                          FROM {table} AS t""").fetchone()
     else:
-        pass
+        count, checksum = con.execute(f"""SELECT COUNT(*), NULL FROM {table}""").fetchone()
 
-    print('Finishing up...')
-    con.commit()
-    con.close()
+    return f'{table}({columns}):{count}:{checksum}'
 
-    et_final = time.time()
-    elapsed_time = et_final - e_time5
-    print(f'Finished. Total execution time: {elapsed_time} seconds')
 
+def _stage_fingerprint(stage: str, params: dict, sources: list):
+    '''
+    Combines a stage name, its parameters and the fingerprints of its inputs into one hash.
+
+    Args:
+        stage (str): Name of the stage table.
+        params (dict): Build parameters that affect the stage.
+        sources (list): Fingerprints of the tables the stage reads.
 
-def sankey_plots(con, min_ogt_diff):
+    Returns:
+        fingerprint (str): Hex digest identifying this version of the stage.
+    '''
+    payload = json.dumps({'stage': stage, 'params': params, 'sources': sources}, sort_keys=True)
+
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def sankey_plots(con, min_ogt_diff, write_images: bool = True, background: bool = False):
     '''
     Constructs Sankey plots for learn2therm to ValidProt data flow. Saves plots to new or existing
-    ./plots folder. Does not show 16S filtering yet. As long as 16S cutoff is default 1300 bp, this
-    will not affect the accuracy of Sankey plots since the original learn2therm database was
-    filtered on this value during construction.
+    ../../data/plots folder. Does not show 16S filtering yet. As long as 16S cutoff is default
+    1300 bp, this will not affect the accuracy of Sankey plots since the original learn2therm
+    database was filtered on this value during construction.
+
+    Counts are read from the vp_build_stats table written by build_validprot, so no learn2therm
+    table is scanned here.
 
     Args:
         con (duckdb.DuckDBPyConnection): DuckDB connection object. Links script to DuckDB SQL
                                          database.
         min_ogt_diff (int): Cutoff for minimum difference in optimal growth temperature between
                             thermophile and mesophile pairs. Default 20 deg C.
+        write_images (bool): Export the plots as png with kaleido.
+        background (bool): Only applies if write_images is True. Export the images in a separate
+                           process and return without waiting for it.
 
     Returns:
-        None. Plots are automatically saved as png in ./plots
+        figures (list): The four plotly.graph_objects.Figure Sankey plots. Plots are saved as png
+                        in ../../data/plots when write_images is True.
+        process (multiprocessing.Process): Only returned when background is True. The image
+                                           export process, to join() and check the exitcode
+                                           of. None if write_images is False.
 
     Raises:
+        ValueError: Optimal growth temperature difference must be positive.
+        AttributeError: vp_build_stats is missing, build_validprot has not been run.
     '''
     
     if min_ogt_diff < 0:
         raise ValueError('Optimal growth temperature difference must be positive.')
+
+    tables = con.execute("""SELECT TABLE_NAME
+                            FROM INFORMATION_SCHEMA.TABLES
+                            WHERE TABLE_TYPE='BASE TABLE'""").df()
+
+    if STATS_TABLE not in tables['table_name'].values:
+        raise AttributeError(f'{STATS_TABLE} not found. Run build_validprot first.')
+
+    stats = dict(con.execute(f"""SELECT stat, value FROM {STATS_TABLE}""").fetchall())
         
     print('Constructing plots.')
 
-    # Checks if plots directory exists and makes one if it does not.
-    newdir = 'plots'
-    exist = os.path.exists(os.path.join('.', newdir))
+    # Plotly is slow to import and only needed here, so it is not loaded with the module.
+    import plotly.graph_objects as go
 
-    if not exist:
-        os.makedirs(newdir)
+    plot_dir = os.path.join('..', '..', 'data', 'plots')
+    images = []
 
     # Color palette for Sankey plots.
     sank_blue = 'rgb(32, 159, 223)'
@@ -288,16 +1931,10 @@ def sankey_plots(con, min_ogt_diff):
     sank_purple_t = 'rgba(118, 111, 159, 0.5)'
 
     # Parameters for taxa pair Sankey
-    size_tp_l2t = int(con.execute("""SELECT COUNT(taxa_pair_index)
-                                     FROM taxa_pairs""").df().values)
-    size_tp_no_pair = int(con.execute("""SELECT COUNT(taxa_pair_index)
-                                         FROM taxa_pairs
-                                         WHERE is_pair = False""").df().values)
-    size_tp_16s_pair = int(con.execute("""SELECT COUNT(taxa_pair_index)
-                                          FROM taxa_pairs
-                                          WHERE is_pair = True""").df().values)
-    size_tp_validprot = int(con.execute("""SELECT COUNT(taxa_pair_index)
-                                           FROM vp_taxa_pairs""").df().values)
+    size_tp_l2t = stats['tp_l2t']
+    size_tp_no_pair = stats['tp_no_pair']
+    size_tp_16s_pair = stats['tp_16s_pair']
+    size_tp_validprot = stats['tp_validprot']
     size_tp_small_diff = size_tp_16s_pair - size_tp_validprot
 
     perc_tp_no_pair = np.round(100*size_tp_no_pair/size_tp_l2t, 1)
@@ -326,50 +1963,18 @@ def sankey_plots(con, min_ogt_diff):
       ))])
 
     fig1.update_layout(title_text='Taxa Pairs', font_family = 'Arial', font_size=16)
-    fig1.write_image(os.path.join('../../data', newdir, 'taxa_pair_sankey.png'), engine = 'kaleido',
-                     scale = 6, width = 1280, height = 640)
+    images.append((fig1.to_dict(), os.path.join(plot_dir, 'taxa_pair_sankey.png')))
 
     # Parameters for taxa Sankey
-    size_t_l2t = int(con.execute("""SELECT COUNT(DISTINCT taxa_index)
-                                    FROM taxa""").df().values)
-    size_t_meso = int(con.execute("""SELECT COUNT(DISTINCT meso_index)
-                                     FROM taxa_pairs""").df().values)
-    size_t_thermo = int(con.execute("""SELECT COUNT(DISTINCT thermo_index)
-                                       FROM taxa_pairs""").df().values)
-    size_tm_no_pair = int(con.execute("""SELECT COUNT(taxa_index)
-                                         FROM taxa
-                                         WHERE taxa_index IN
-                                         (SELECT meso_index
-                                         FROM taxa_pairs
-                                         WHERE is_pair = False)""").df().values)
-    size_tt_no_pair = int(con.execute("""SELECT COUNT(taxa_index)
-                                         FROM taxa
-                                         WHERE taxa_index IN
-                                         (SELECT thermo_index
-                                         FROM taxa_pairs
-                                         WHERE is_pair = False)""").df().values)
-    size_tm_16s_pair = int(con.execute("""SELECT COUNT(taxa_index)
-                                          FROM taxa
-                                          WHERE taxa_index IN
-                                          (SELECT meso_index
-                                          FROM taxa_pairs
-                                          WHERE is_pair = True)""").df().values)
-    size_tt_16s_pair = int(con.execute("""SELECT COUNT(taxa_index)
-                                          FROM taxa
-                                          WHERE taxa_index IN
-                                          (SELECT thermo_index
-                                          FROM taxa_pairs
-                                          WHERE is_pair = True)""").df().values)
-    size_tm_validprot = int(con.execute("""SELECT COUNT(DISTINCT taxa_index)
-                                           FROM vp_taxa
-                                           WHERE taxa_index IN
-                                           (SELECT DISTINCT meso_index
-                                           FROM taxa_pairs)""").df().values)
-    size_tt_validprot = int(con.execute("""SELECT COUNT(DISTINCT taxa_index)
-                                           FROM vp_taxa
-                                           WHERE taxa_index IN
-                                           (SELECT DISTINCT thermo_index
-                                           FROM taxa_pairs)""").df().values)
+    size_t_l2t = stats['t_l2t']
+    size_t_meso = stats['t_meso']
+    size_t_thermo = stats['t_thermo']
+    size_tm_no_pair = stats['tm_no_pair']
+    size_tt_no_pair = stats['tt_no_pair']
+    size_tm_16s_pair = stats['tm_16s_pair']
+    size_tt_16s_pair = stats['tt_16s_pair']
+    size_tm_validprot = stats['tm_validprot']
+    size_tt_validprot = stats['tt_validprot']
     size_tm_small_diff = size_tm_16s_pair - size_tm_validprot
     size_tt_small_diff = size_tt_16s_pair - size_tt_validprot
 
@@ -405,14 +2010,11 @@ def sankey_plots(con, min_ogt_diff):
 
     fig2.update_layout(title_text="Taxa Representation", font_size=16, font_family = 'Arial',
                        font_color = 'black')
-    fig2.write_image(os.path.join('../../data', newdir, 'taxa_sankey.png'), engine = 'kaleido',
-                     scale = 6, width = 1280, height = 640)
+    images.append((fig2.to_dict(), os.path.join(plot_dir, 'taxa_sankey.png')))
 
     # Parameters for protein pair Sankey
-    size_pp_l2t = int(con.execute("""SELECT COUNT(prot_pair_index)
-                                     FROM protein_pairs""").df().values)
-    size_pp_validprot = int(con.execute("""SELECT COUNT(prot_pair_index)
-                                           FROM vp_protein_pairs""").df().values)
+    size_pp_l2t = stats['pp_l2t']
+    size_pp_validprot = stats['pp_validprot']
     size_pp_small_diff = size_pp_l2t - size_pp_validprot
 
     perc_pp_validprot = np.round(100*size_pp_validprot/size_pp_l2t, 1)
@@ -439,56 +2041,21 @@ def sankey_plots(con, min_ogt_diff):
       ))])
 
     fig3.update_layout(title_text='Protein Pairs', font_family = 'Arial', font_size=16)
-    fig3.write_image(os.path.join('../../data', newdir, 'protein_pair_sankey.png'), engine = 'kaleido',
-                     scale = 6, width = 1280, height = 640)
+    images.append((fig3.to_dict(), os.path.join(plot_dir, 'protein_pair_sankey.png')))
 
     # Parameters for protein Sankey
-    size_p_l2t = int(con.execute("""SELECT COUNT(protein_int_index)
-                                    FROM proteins""").df().values)
-    size_p_meso = int(con.execute("""SELECT COUNT(DISTINCT meso_protein_int_index)
-                                     FROM protein_pairs""").df().values)
-    size_p_thermo = int(con.execute("""SELECT COUNT(DISTINCT thermo_protein_int_index)
-                                       FROM protein_pairs""").df().values)
-    size_pm_no_pair = int(con.execute("""SELECT COUNT(protein_int_index)
-                                         FROM proteins
-                                         WHERE taxa_index IN
-                                         (SELECT meso_index
-                                         FROM taxa_pairs
-                                         WHERE is_pair = False)""").df().values)
-    size_pt_no_pair = int(con.execute("""SELECT COUNT(protein_int_index)
-                                         FROM proteins WHERE taxa_index IN
-                                         (SELECT thermo_index
-                                         FROM taxa_pairs
-                                         WHERE is_pair = False)""").df().values)
-    size_pm_16s_pair = int(con.execute("""SELECT COUNT(protein_int_index)
-                                          FROM proteins
-                                          WHERE taxa_index IN
-                                          (SELECT meso_index FROM taxa_pairs
-                                          WHERE is_pair = True)""").df().values)
-    size_pt_16s_pair = int(con.execute("""SELECT COUNT(protein_int_index)
-                                          FROM proteins
-                                          WHERE taxa_index IN
-                                          (SELECT thermo_index
-                                          FROM taxa_pairs
-                                          WHERE is_pair = True)""").df().values)
-    size_pm_validprot = int(con.execute("""SELECT COUNT(protein_int_index)
-                                           FROM vp_proteins
-                                           WHERE taxa_index in
-                                           (SELECT DISTINCT meso_index
-                                           FROM taxa_pairs)""").df().values)
-    size_pt_validprot = int(con.execute("""SELECT COUNT(protein_int_index)
-                                           FROM vp_proteins
-                                           WHERE taxa_index IN
-                                           (SELECT DISTINCT thermo_index
-                                           FROM taxa_pairs)""").df().values)
+    size_p_l2t = stats['p_l2t']
+    size_p_meso = stats['p_meso']
+    size_p_thermo = stats['p_thermo']
+    size_pm_no_pair = stats['pm_no_pair']
+    size_pt_no_pair = stats['pt_no_pair']
+    size_pm_16s_pair = stats['pm_16s_pair']
+    size_pt_16s_pair = stats['pt_16s_pair']
+    size_pm_validprot = stats['pm_validprot']
+    size_pt_validprot = stats['pt_validprot']
     size_pm_small_diff = size_pm_16s_pair - size_pm_validprot
     size_pt_small_diff = size_pt_16s_pair - size_pt_validprot
-    size_p_null = int(con.execute("""SELECT COUNT(protein_int_index)
-                                     FROM proteins
-                                     WHERE taxa_index IN
-                                     (SELECT DISTINCT taxa_index
-                                     FROM taxa
-                                     WHERE ogt IS NULL)""").df().values)
+    size_p_null = stats['p_null']
     size_p_validprot = size_pm_validprot+size_pt_validprot
 
     perc_p_no_pair = np.round(100*(size_pt_no_pair+size_pm_no_pair)/size_p_l2t, 1)
@@ -522,5 +2089,167 @@ def sankey_plots(con, min_ogt_diff):
       ))])
 
     fig4.update_layout(title_text="Protein Representation", font_family = 'Arial', font_size=16)
-    fig4.write_image(os.path.join('../../data', newdir, 'protein_sankey.png'), engine = 'kaleido', scale = 6,
-                     width = 1280, height = 640)
+    images.append((fig4.to_dict(), os.path.join(plot_dir, 'protein_sankey.png')))
+
+    figures = [fig1, fig2, fig3, fig4]
+    process = None
+
+    if write_images:
+
+        # Checks if plots directory exists and makes one if it does not.
+        os.makedirs(plot_dir, exist_ok=True)
+
+        # A forked child would inherit DuckDB's threads mid-use, so the export is spawned.
+        if background:
+            process = multiprocessing.get_context('spawn').Process(target=_write_sankey_images,
+                                                                   args=(images,))
+            process.start()
+        else:
+            _write_sankey_images(images)
+
+    return (figures, process) if background else figures
+
+
+def _write_sankey_images(images: list):
+    '''
+    Exports Sankey plots as png with kaleido.
+
+    Args:
+        images (list): (figure dict, output path) tuples.
+
+    Returns:
+        None. Images are written to their paths.
+    '''
+    import plotly.graph_objects as go
+    import plotly.io as pio
+    pio.kaleido.scope.default_format = "png"
+
+    for figure, path in images:
+        go.Figure(figure).write_image(path, engine = 'kaleido', scale = 6, width = 1280,
+                                      height = 640)
+
+
+# Supported partitioning schemes for export_parquet and the hive column each one writes.
+PARTITION_SCHEMES = {'ogt_diff': 'ogt_bucket', 'taxa_pair_hash': 'taxa_pair_bucket'}
+
+
+def export_parquet(con, out_dir: str, partition_by: str = 'ogt_diff', bucket_width: int = 5,
+                   n_buckets: int = 16, row_group_size: int = 122880, table: str = 'vp_final',
+                   stats_columns: list = None, overwrite: bool = False):
+    '''
+    Writes a ValidProt table as a hive-partitioned, zstd compressed Parquet dataset so downstream
+    readers can prune partitions and read column subsets without opening the DuckDB file. A
+    manifest with per-file row counts and min/max statistics is written to manifest.json in
+    out_dir and returned.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object. Links script to DuckDB SQL
+                                         database.
+        out_dir (str): Directory for the dataset. Files are written to
+                       out_dir/<partition column>=<value>/data_0.parquet.
+        partition_by (str): One of ['ogt_diff', 'taxa_pair_hash']. 'ogt_diff' buckets pairs by
+                            ogt_difference, 'taxa_pair_hash' by a hash of taxa_pair_index.
+        bucket_width (int): Only applies to 'ogt_diff'. Width of each bucket in deg C.
+        n_buckets (int): Only applies to 'taxa_pair_hash'. Number of hash buckets.
+        row_group_size (int): Rows per Parquet row group.
+        table (str): ValidProt table to export. Default vp_final.
+        stats_columns (list): Numeric columns to report min/max statistics for in the manifest.
+                              Default ['prot_pair_index', 'taxa_pair_index', 'ogt_difference'].
+        overwrite (bool): Replace an existing dataset in out_dir.
+
+    Returns:
+        manifest (pandas.DataFrame): One row per file with its path, partition, row count, size
+                                     in bytes and <column>_min/<column>_max for stats_columns.
+
+    Raises:
+        ValueError: partition_by must be one of ['ogt_diff', 'taxa_pair_hash'].
+        ValueError: bucket_width, n_buckets and row_group_size must be positive.
+        ValueError: out_dir already contains files and overwrite is False.
+    '''
+
+    if partition_by not in PARTITION_SCHEMES:
+        raise ValueError(f'Invalid argument passed to partition_by. Expected one of: '
+                         f'{list(PARTITION_SCHEMES)}')
+
+    if bucket_width < 1 or n_buckets < 1 or row_group_size < 1:
+        raise ValueError('bucket_width, n_buckets and row_group_size must be positive.')
+
+    stats_columns = (['prot_pair_index', 'taxa_pair_index', 'ogt_difference']
+                     if stats_columns is None else stats_columns)
+
+    if os.path.exists(out_dir) and os.listdir(out_dir):
+
+        if not overwrite:
+            raise ValueError(f'{out_dir} is not empty. Pass overwrite = True to replace it.')
+
+        shutil.rmtree(out_dir)
+
+    s_time = time.time()
+    print(f'Exporting {table} to {out_dir}...')
+
+    column = PARTITION_SCHEMES[partition_by]
+
+    if partition_by == 'ogt_diff':
+        bucket_cmd = f'CAST(floor(ogt_difference / {bucket_width}) * {bucket_width} AS INTEGER)'
+    else:
+        bucket_cmd = _hash_bucket('taxa_pair_index', n_buckets)
+
+    buckets = con.execute(f"""SELECT DISTINCT {bucket_cmd}
+                              FROM {table}
+                              ORDER BY 1""").fetchall()
+
+    # DuckDB 0.6 has no partitioned COPY, so each partition is written by its own filtered scan.
+    files = []
+
+    for (bucket,) in buckets:
+
+        partition = f'{column}={bucket}'
+        os.makedirs(os.path.join(out_dir, partition), exist_ok=True)
+        file = os.path.join(out_dir, partition, 'data_0.parquet')
+
+        con.execute(f"""COPY (SELECT *
+                              FROM {table}
+                              WHERE {bucket_cmd} = {bucket})
+                        TO '{file}'
+                        (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE {row_group_size})""")
+        files.append((file, partition))
+
+    manifest = pd.DataFrame([_parquet_file_stats(con, file, partition, stats_columns)
+                             for file, partition in files])
+    manifest.to_json(os.path.join(out_dir, 'manifest.json'), orient='records', indent=1)
+
+    e_time = time.time()
+    elapsed_time = e_time - s_time
+    print(f'Finished exporting {len(files)} partitions. Execution time: {elapsed_time} seconds')
+
+    return manifest
+
+
+def _parquet_file_stats(con, file: str, partition: str, stats_columns: list):
+    '''
+    Reads row count and column min/max statistics from a Parquet file footer.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): DuckDB connection object.
+        file (str): Path to the Parquet file.
+        partition (str): Hive partition the file belongs to.
+        stats_columns (list): Numeric columns to report min/max statistics for.
+
+    Returns:
+        stats (dict): Manifest entry for the file.
+    '''
+    meta = con.execute(f"""SELECT row_group_id, row_group_num_rows, path_in_schema,
+                           stats_min_value, stats_max_value
+                           FROM parquet_metadata('{file}')""").df()
+
+    stats = {'path': file,
+             'partition': partition,
+             'num_rows': int(meta.drop_duplicates('row_group_id')['row_group_num_rows'].sum()),
+             'size_bytes': os.path.getsize(file)}
+
+    for column in stats_columns:
+        values = meta[meta['path_in_schema'] == column]
+        stats[f'{column}_min'] = pd.to_numeric(values['stats_min_value']).min()
+        stats[f'{column}_max'] = pd.to_numeric(values['stats_max_value']).max()
+
+    return stats
@@ -0,0 +1,296 @@
+'''
+This module writes synthetic databases in the learn2therm format and benchmarks the ValidProt
+build on them, so c0 can be developed and profiled without the full learn2therm database.
+
+Functions:
+    make_learn2therm: Writes a learn2therm-shaped DuckDB database with a chosen number of protein
+                      pairs and realistic distributions of optimal growth temperature, 16S read
+                      length, sequence length and composition and alignment statistics.
+
+    benchmark_build: Runs build_validprot on synthetic databases across a range of scales and
+                     returns the per-stage time and memory metrics for every scale.
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import duckdb
+
+import c0
+
+# Background amino acid frequencies (%) of UniProtKB/Swiss-Prot.
+AA_FREQUENCIES = {'A': 8.25, 'R': 5.53, 'N': 4.06, 'D': 5.45, 'C': 1.37, 'Q': 3.93, 'E': 6.75,
+                  'G': 7.07, 'H': 2.27, 'I': 5.96, 'L': 9.66, 'K': 5.84, 'M': 2.42, 'F': 3.86,
+                  'P': 4.70, 'S': 6.56, 'T': 5.34, 'W': 1.08, 'Y': 2.92, 'V': 6.87}
+
+# Relative change in frequency for thermophilic proteins, which carry more charged and
+# hydrophobic residues and fewer polar, uncharged ones.
+THERMO_SHIFT = {'E': 1.25, 'K': 1.25, 'R': 1.15, 'I': 1.15, 'Y': 1.1, 'V': 1.1,
+                'Q': 0.7, 'N': 0.8, 'S': 0.85, 'T': 0.85, 'H': 0.85, 'A': 0.95}
+
+# Protein annotations, drawn with a heavy tail so a few descriptions dominate.
+DESCRIPTIONS = ['hypothetical protein', 'ABC transporter ATP-binding protein',
+                'MFS transporter', 'LysR family transcriptional regulator',
+                'response regulator transcription factor', 'SDR family oxidoreductase',
+                'GNAT family N-acetyltransferase', 'TetR/AcrR family transcriptional regulator',
+                'sensor histidine kinase', 'ATP-binding protein', 'DNA-binding protein',
+                'glycosyltransferase', 'methyltransferase domain-containing protein',
+                'amino acid permease', 'aldehyde dehydrogenase', 'elongation factor Tu',
+                'DNA polymerase III subunit alpha', 'chaperonin GroEL', 'RecA recombinase',
+                '50S ribosomal protein L2']
+
+# Length of the pseudo-random sequence each protein sequence is cut from.
+POOL_LENGTH = 10 ** 6
+
+
+def make_learn2therm(path: str, n_pairs: int, seed: int = 0, pairs_per_taxa_pair: int = 250,
+                     proteins_per_taxon: int = 3000, profile: dict = None):
+    '''
+    Writes a synthetic database in the learn2therm format. Every value is a hash of its row index
+    and the seed, so the output is the same for a given seed regardless of thread count, and the
+    tables are generated inside DuckDB so 1e8 pairs fit in the resource profile.
+
+    Mesophile optimal growth temperatures (ogt) are drawn around 30 C and thermophile ogt
+    around 62 C, with 2% missing. 16S read lengths cluster around 1450 bp with 10% partial
+    reads. Protein lengths are log-normal with a median near 270 residues. Sequences are cut
+    from amino acid pools with natural residue frequencies, shifted toward charged residues
+    for thermophiles, and 3% of proteins repeat the previous protein's sequence. Protein pair
+    percent identities are centered on 0.78 with a standard deviation of 0.064, as in the
+    learn2therm sample. Every taxa pair contributes pairs_per_taxa_pair protein pairs with
+    contiguous prot_pair_index values, and 85% of taxa pairs pass the 16S pairing.
+
+    Args:
+        path (str): Path of the DuckDB database file to create. Must not exist.
+        n_pairs (int): Number of protein pairs.
+        seed (int): Seed for every generated value.
+        pairs_per_taxa_pair (int): Protein pairs per taxa pair.
+        proteins_per_taxon (int): Proteins per taxon.
+        profile (dict): Optional resource profile from c0.resource_profile().
+
+    Returns:
+        counts (dict): Row count of each table.
+
+    Raises:
+        ValueError: n_pairs, pairs_per_taxa_pair and proteins_per_taxon must be positive.
+        ValueError: path already exists.
+    '''
+    if min(n_pairs, pairs_per_taxa_pair, proteins_per_taxon) < 1:
+        raise ValueError('n_pairs, pairs_per_taxa_pair and proteins_per_taxon must be positive.')
+
+    if os.path.exists(path):
+        raise ValueError(f'{path} already exists.')
+
+    s_time = time.time()
+
+    n_pairs = int(n_pairs)
+    n_taxa_pairs = -(-n_pairs // pairs_per_taxa_pair)
+    n_meso = max(2, int(2 * np.sqrt(n_taxa_pairs)))
+    n_thermo = n_meso
+    salt = 1000 * seed
+
+    con = duckdb.connect(path)
+
+    if profile is not None:
+        c0.apply_resource_profile(con, profile)
+
+    # Uniform and standard normal draws keyed by row and field. Temporary, so nothing but the
+    # learn2therm tables is stored in the database.
+    con.execute(f"""CREATE TEMP MACRO uniform(k, field) AS
+                    (CAST(hash(k, {salt} + field) % CAST(1000000007 AS UBIGINT) AS DOUBLE)
+                     + 0.5) / 1000000007""")
+    con.execute("""CREATE TEMP MACRO normal(k, field) AS
+                   sqrt(-2 * ln(uniform(k, field))) * cos(2 * pi() * uniform(k, field + 1))""")
+    con.execute("""CREATE TEMP MACRO clamp(x, low, high) AS greatest(low, least(high, x))""")
+    con.execute("""CREATE TEMP MACRO block(i, size) AS CAST(floor(i / size) AS BIGINT)""")
+
+    # Proteins sharing a sequence key share a sequence and length.
+    con.execute("""CREATE TEMP MACRO seq_key(i) AS
+                   CASE WHEN uniform(i, 40) < 0.03 AND i > 0 THEN i - 1 ELSE i END""")
+    con.execute("""CREATE TEMP MACRO protein_len(i) AS
+                   CAST(clamp(round(exp(5.6 + 0.55 * normal(seq_key(i), 41))), 30, 3000)
+                        AS INTEGER)""")
+
+    print('Generating taxa...')
+    con.execute(f"""CREATE TABLE taxa AS
+                    SELECT range AS taxa_index,
+                    CASE WHEN uniform(range, 1) < 0.02 THEN NULL
+                         WHEN range < {n_meso}
+                         THEN round(2 * clamp(30 + 6 * normal(range, 2), 5, 44)) / 2
+                         ELSE round(2 * clamp(62 + 9 * normal(range, 2), 45, 100)) / 2
+                         END AS ogt,
+                    CAST(CASE WHEN uniform(range, 4) < 0.1 THEN 300 + 1000 * uniform(range, 5)
+                              ELSE clamp(1450 + 80 * normal(range, 6), 1300, 1600)
+                              END AS INTEGER) AS len_16s
+                    FROM range({n_meso + n_thermo})""")
+
+    print('Generating taxa pairs...')
+    con.execute(f"""CREATE TABLE taxa_pairs AS
+                    SELECT range AS taxa_pair_index,
+                    CAST(floor({n_meso} * uniform(range, 10)) AS BIGINT) AS meso_index,
+                    {n_meso} + CAST(floor({n_thermo} * uniform(range, 11)) AS BIGINT)
+                        AS thermo_index,
+                    uniform(range, 12) < 0.85 AS is_pair,
+                    clamp(0.9 + 0.03 * normal(range, 13), 0.7, 1) AS local_gap_compressed_percent_id,
+                    clamp(0.88 + 0.04 * normal(range, 15), 0.6, 1) AS scaled_local_query_percent_id,
+                    clamp(0.87 + 0.04 * normal(range, 17), 0.6, 1)
+                        AS scaled_local_symmetric_percent_id,
+                    clamp(0.95 + 0.05 * uniform(range, 19), 0, 1) AS query_align_cov,
+                    clamp(0.95 + 0.05 * uniform(range, 20), 0, 1) AS subject_align_cov,
+                    round(clamp(2300 + 300 * normal(range, 21), 500, 3000), 1) AS bit_score
+                    FROM range({n_taxa_pairs})""")
+
+    print('Generating proteins...')
+    rng = np.random.default_rng(seed)
+    residues = list(AA_FREQUENCIES)
+    pools = []
+    for role, shift in [('meso', {}), ('thermo', THERMO_SHIFT)]:
+        weights = np.array([AA_FREQUENCIES[aa] * shift.get(aa, 1) for aa in residues])
+        pool = ''.join(rng.choice(residues, size=POOL_LENGTH, p=weights / weights.sum()))
+        pools.append((role, pool))
+    con.execute("""CREATE TEMP TABLE aa_pool (role VARCHAR, pool VARCHAR)""")
+    con.executemany("""INSERT INTO aa_pool VALUES (?, ?)""", pools)
+
+    descriptions = ', '.join(f"'{description}'" for description in DESCRIPTIONS)
+    con.execute(f"""CREATE TABLE proteins AS
+                    SELECT range AS protein_int_index,
+                    block(range, {proteins_per_taxon}) AS taxa_index,
+                    'M' || substr(pool, 1 + CAST(floor(({POOL_LENGTH} - 3000)
+                                                       * uniform(seq_key(range), 42))
+                                                 AS INTEGER),
+                                  protein_len(range) - 1) AS protein_seq,
+                    list_extract([{descriptions}],
+                                 1 + CAST(floor({len(DESCRIPTIONS)}
+                                                * pow(uniform(range, 43), 3)) AS INTEGER))
+                        AS protein_desc,
+                    protein_len(range) AS protein_len
+                    FROM range({(n_meso + n_thermo) * proteins_per_taxon})
+                    JOIN aa_pool ON (aa_pool.role = CASE WHEN block(range, {proteins_per_taxon})
+                                                              < {n_meso}
+                                                         THEN 'meso' ELSE 'thermo' END)
+                    ORDER BY protein_int_index""")
+
+    print('Generating protein pairs...')
+    con.execute(f"""CREATE TABLE protein_pairs AS
+                    SELECT *, pow(10, -bit_score / 20) AS local_E_value
+                    FROM (SELECT *,
+                    CAST(round(query_align_cov * protein_len(meso_protein_int_index)) AS INTEGER)
+                        AS query_align_len,
+                    CAST(round(subject_align_cov * protein_len(thermo_protein_int_index))
+                         AS INTEGER) AS subject_align_len,
+                    scaled_local_symmetric_percent_id * query_align_cov
+                        / greatest(query_align_cov, subject_align_cov)
+                        AS scaled_local_query_percent_id,
+                    round(1.9 * local_gap_compressed_percent_id * query_align_cov
+                          * protein_len(meso_protein_int_index), 1) AS bit_score
+                    FROM (SELECT range AS prot_pair_index,
+                          block(range, {pairs_per_taxa_pair}) AS taxa_pair_index,
+                          meso_index,
+                          thermo_index,
+                          meso_index * {proteins_per_taxon}
+                              + CAST(floor({proteins_per_taxon} * uniform(range, 30)) AS BIGINT)
+                              AS meso_protein_int_index,
+                          thermo_index * {proteins_per_taxon}
+                              + CAST(floor({proteins_per_taxon} * uniform(range, 31)) AS BIGINT)
+                              AS thermo_protein_int_index,
+                          clamp(0.78 + 0.064 * normal(range, 32), 0.3, 1)
+                              AS scaled_local_symmetric_percent_id,
+                          clamp(0.8 + 0.07 * normal(range, 34), 0.3, 1)
+                              AS local_gap_compressed_percent_id,
+                          clamp(1 - abs(0.1 * normal(range, 36)), 0.3, 1) AS query_align_cov,
+                          clamp(1 - abs(0.1 * normal(range, 38)), 0.3, 1) AS subject_align_cov
+                          FROM range({n_pairs})
+                          JOIN taxa_pairs ON (block(range, {pairs_per_taxa_pair}) =
+                                              taxa_pairs.taxa_pair_index)) AS draws) AS features
+                    ORDER BY prot_pair_index""")
+
+    counts = {table: con.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in c0.L2T_TABLES}
+    con.commit()
+    con.close()
+
+    e_time = time.time()
+    elapsed_time = e_time - s_time
+    print(f'Finished. Execution time: {elapsed_time} seconds')
+
+    return counts
+
+
+def benchmark_build(scales: list = None, workdir: str = None, seed: int = 0,
+                    out_csv: str = None, **build_kwargs):
+    '''
+    Generates a synthetic learn2therm database at every scale and runs build_validprot on it.
+    The per-stage metrics of each build are stacked into one table, giving wall time, rows per
+    second and peak memory curves per stage against the number of protein pairs.
+
+    Args:
+        scales (list): Numbers of protein pairs to benchmark. Default [1e4, 1e5, 1e6].
+        workdir (str): Directory for the databases, kept afterwards. A temporary directory is
+        used and removed when None.
+        seed (int): Seed passed to make_learn2therm.
+        out_csv (str): Optional path to write the results to as CSV.
+        **build_kwargs: Passed on to build_validprot, e.g. mode='fused'.
+
+    Returns:
+        results (pandas.DataFrame): build_validprot metrics with n_pairs and generate_time_s
+        columns, one row per stage per scale.
+    '''
+    scales = [1e4, 1e5, 1e6] if scales is None else scales
+    tmpdir = tempfile.TemporaryDirectory() if workdir is None else None
+    workdir = tmpdir.name if workdir is None else workdir
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+
+    try:
+        for scale in scales:
+
+            n_pairs = int(scale)
+            path = os.path.join(workdir, f'learn2therm_{n_pairs}')
+
+            # Databases left in workdir by an earlier benchmark are reused.
+            s_time = time.perf_counter()
+            if not os.path.exists(path):
+                make_learn2therm(path, n_pairs, seed=seed)
+            generate_time = time.perf_counter() - s_time
+
+            metrics = c0.build_validprot(c0.connect_db(path), force=True,
+                                         persist_metrics=False, **build_kwargs)
+            metrics['n_pairs'] = n_pairs
+            metrics['generate_time_s'] = generate_time
+            results.append(metrics)
+
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    results = pd.concat(results, ignore_index=True)
+
+    if out_csv is not None:
+        results.to_csv(out_csv, index=False)
+
+    print(results.pivot_table(index='stage', columns='n_pairs',
+                              values=['wall_time_s', 'peak_memory_bytes'], sort=False))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark build_validprot on synthetic '
+                                                 'learn2therm databases.')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1e4, 1e5, 1e6],
+                        help='Numbers of protein pairs to benchmark.')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory to keep the generated databases in.')
+    parser.add_argument('--mode', default='staged', choices=c0.BUILD_MODES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='CSV file for the results.')
+    args = parser.parse_args()
+
+    benchmark_build(args.scales, workdir=args.workdir, seed=args.seed, out_csv=args.out,
+                    mode=args.mode)
@@ -0,0 +1,125 @@
+'''
+Unit testing script for the ValidProt synthetic learn2therm generator.
+'''
+
+import unittest
+
+import os
+import tempfile
+
+import duckdb
+
+import c0
+import c0_synthetic
+
+
+TABLES = ['taxa', 'taxa_pairs', 'proteins', 'protein_pairs']
+
+
+class TestMakeLearn2therm(unittest.TestCase):
+    '''
+    Tests for the make_learn2therm function.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make(self, name, **kwargs):
+        path = os.path.join(self.tmpdir.name, name)
+        counts = c0_synthetic.make_learn2therm(path, proteins_per_taxon = 200, **kwargs)
+        return path, counts
+
+    def fingerprints(self, path):
+        con = duckdb.connect(path, read_only = True)
+        fingerprints = [c0._table_fingerprint(con, table) for table in TABLES]
+        con.close()
+        return fingerprints
+
+    def test_shape(self):
+        '''
+        Tables have the requested size and the distributions the build filters on.
+        '''
+        path, counts = self.make('l2t', n_pairs = 5000, pairs_per_taxa_pair = 100)
+
+        self.assertEqual(counts['protein_pairs'], 5000)
+        self.assertEqual(counts['taxa_pairs'], 50)
+
+        con = duckdb.connect(path, read_only = True)
+        meso, thermo = con.execute("""SELECT AVG(taxa_m.ogt), AVG(taxa_t.ogt)
+                                      FROM taxa_pairs
+                                      JOIN taxa AS taxa_m ON (meso_index = taxa_m.taxa_index)
+                                      JOIN taxa AS taxa_t ON (thermo_index = taxa_t.taxa_index)
+                                      """).fetchone()
+        self.assertLess(meso + 20, thermo)
+
+        n_len, n_bad = con.execute("""SELECT COUNT(*) FILTER (WHERE length(protein_seq)
+                                                             != protein_len),
+                                      COUNT(*) FILTER (WHERE NOT regexp_matches(protein_seq,
+                                                                                '^M[A-Z]+$'))
+                                      FROM proteins""").fetchone()
+        self.assertEqual((n_len, n_bad), (0, 0))
+
+        # Every protein pair refers to proteins of its own taxa pair.
+        n_orphans = con.execute("""SELECT COUNT(*)
+                                   FROM protein_pairs
+                                   JOIN proteins ON (meso_protein_int_index = protein_int_index)
+                                   WHERE proteins.taxa_index != protein_pairs.meso_index
+                                   """).fetchone()[0]
+        self.assertEqual(n_orphans, 0)
+        con.close()
+
+        metrics = c0.build_validprot(c0.connect_db(path))
+        final = metrics.set_index('stage').loc['vp_final']
+        self.assertGreater(final['rows'], 0)
+
+    def test_seed(self):
+        '''
+        The same seed reproduces the database and a different seed changes it.
+        '''
+        first, _ = self.make('first', n_pairs = 2000, seed = 3)
+        second, _ = self.make('second', n_pairs = 2000, seed = 3)
+        third, _ = self.make('third', n_pairs = 2000, seed = 4)
+
+        self.assertEqual(self.fingerprints(first), self.fingerprints(second))
+        self.assertNotEqual(self.fingerprints(first), self.fingerprints(third))
+
+    def test_invalid(self):
+        '''
+        Test for non-positive sizes and existing paths.
+        '''
+        with self.assertRaises(ValueError):
+            self.make('l2t', n_pairs = 0)
+
+        path, _ = self.make('l2t', n_pairs = 100)
+        with self.assertRaises(ValueError):
+            c0_synthetic.make_learn2therm(path, n_pairs = 100)
+
+
+class TestBenchmark(unittest.TestCase):
+    '''
+    Tests for the benchmark_build function.
+    '''
+
+    def test_scales(self):
+        '''
+        One row per stage per scale, with databases kept in workdir.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            out_csv = os.path.join(tmpdir, 'bench.csv')
+            results = c0_synthetic.benchmark_build([1000, 3000], workdir = tmpdir,
+                                                   out_csv = out_csv, mode = 'fused')
+
+            self.assertEqual(sorted(results['n_pairs'].unique()), [1000, 3000])
+            stages = [stage for stage, _, _ in c0.VP_STAGES
+                      if stage not in c0.SEQUENCE_STAGES + c0.FEATURE_STAGES]
+            self.assertEqual(len(results), 2 * len(stages))
+            assert os.path.exists(os.path.join(tmpdir, 'learn2therm_3000'))
+            assert os.path.exists(out_csv)
+
+
+if __name__ == '__main__':
+    unittest.main()
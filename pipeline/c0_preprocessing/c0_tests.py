@@ -5,6 +5,13 @@ Unit testing script for ValidProt c0.
 import unittest
 
 import os
+import subprocess
+import sys
+import tempfile
+
+import duckdb
+import numpy as np
+import pandas as pd
 
 import c0
 
@@ -34,6 +41,110 @@ def get_db_path(filename = 'validprot_testing'):
     return db_path
 
 
+def make_l2t_db(path):
+    '''
+    Writes a small database in the learn2therm format for tests that need to build ValidProt
+    tables without the bundled test dataset.
+
+    Args:
+        path (str): Path of the DuckDB database file to create.
+
+    Returns:
+        None. Database file is written to path.
+    '''
+
+    # Six taxa. Taxa 0-2 are mesophiles, 3-5 thermophiles, taxon 5 has a short 16S read.
+    taxa = pd.DataFrame({'taxa_index': range(6),
+                         'ogt': [20.0, 25.0, 30.0, 55.0, 60.0, 70.0],
+                         'len_16s': [1500, 1500, 1500, 1500, 1500, 1200]})
+
+    # (meso, thermo, is_pair). Pairs 0-3, 1-4 and 1-3 pass every filter, 2-5 fails on 16S
+    # length, 0-5 is not a 16S pair and 2-3 (25 C apart) fails any ogt cutoff above 25.
+    pairs = [(0, 3, True), (1, 4, True), (2, 5, True), (1, 3, True), (0, 5, False),
+             (2, 3, True)]
+    taxa_pairs = pd.DataFrame({'taxa_pair_index': range(len(pairs)),
+                               'meso_index': [p[0] for p in pairs],
+                               'thermo_index': [p[1] for p in pairs],
+                               'is_pair': [p[2] for p in pairs],
+                               'local_gap_compressed_percent_id': 0.9,
+                               'scaled_local_query_percent_id': 0.9,
+                               'scaled_local_symmetric_percent_id': 0.9,
+                               'query_align_cov': 0.99,
+                               'subject_align_cov': 0.99,
+                               'bit_score': 1000.0})
+
+    # Four proteins per taxon. Proteins i and i + 12 share a sequence.
+    sequences = ['MK' + 'AILV'[i % 4] * (10 + i % 12) for i in range(24)]
+    proteins = pd.DataFrame({'protein_int_index': range(24),
+                             'taxa_index': [i // 4 for i in range(24)],
+                             'protein_seq': sequences,
+                             'protein_desc': [f'protein family {i % 4}' for i in range(24)],
+                             'protein_len': [len(seq) for seq in sequences]})
+
+    # Protein k of the mesophile is paired with protein k of the thermophile.
+    rows = []
+    for taxa_pair_index, (meso, thermo, _) in enumerate(pairs):
+        for k in range(4):
+            rows.append({'prot_pair_index': len(rows),
+                         'taxa_pair_index': taxa_pair_index,
+                         'meso_index': meso,
+                         'thermo_index': thermo,
+                         'meso_protein_int_index': 4 * meso + k,
+                         'thermo_protein_int_index': 4 * thermo + k,
+                         'local_gap_compressed_percent_id': 0.5 + k / 10,
+                         'scaled_local_query_percent_id': 0.4 + k / 10,
+                         'scaled_local_symmetric_percent_id': 0.45 + k / 10,
+                         'query_align_len': 100 + k,
+                         'query_align_cov': 0.9,
+                         'subject_align_len': 98 + k,
+                         'subject_align_cov': 0.85,
+                         'bit_score': 200 + 10 * k})
+    protein_pairs = pd.DataFrame(rows)
+
+    con = duckdb.connect(path)
+    for name, df in [('taxa', taxa), ('taxa_pairs', taxa_pairs), ('proteins', proteins),
+                     ('protein_pairs', protein_pairs)]:
+        con.register('df_view', df)
+        con.execute(f'CREATE TABLE {name} AS SELECT * FROM df_view')
+        con.unregister('df_view')
+    con.commit()
+    con.close()
+
+
+def read(path, cmd):
+    '''
+    Runs a query against a database file and returns the result.
+
+    Args:
+        path (str): Path of the DuckDB database file.
+        cmd (str): SQL query.
+
+    Returns:
+        df (pandas.DataFrame): Query result.
+    '''
+    con = duckdb.connect(path)
+    df = con.execute(cmd).df()
+    con.close()
+    return df
+
+
+class L2TTestCase(unittest.TestCase):
+    '''
+    Base class for tests run against fresh make_l2t_db databases in a temporary directory. Each
+    entry of databases maps the attribute the path is stored in to the database file name.
+    '''
+
+    databases = {'db_path': 'l2t'}
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for attribute, name in self.databases.items():
+            setattr(self, attribute, os.path.join(self.tmpdir.name, name))
+            make_l2t_db(getattr(self, attribute))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
 
 class TestConnection(unittest.TestCase):
     '''
@@ -60,6 +171,71 @@ class TestConnection(unittest.TestCase):
             c0.connect_db(db_path)
 
 
+class TestSharedConnection(L2TTestCase):
+    '''
+    Tests for read-only and shared connections from connect_db.
+    '''
+
+    def tearDown(self):
+        c0.close_shared()
+        super().tearDown()
+
+    def test_read_only(self):
+        '''
+        Read-only connections can query but not write.
+        '''
+        con = c0.connect_db(self.db_path, read_only = True)
+
+        self.assertEqual(con.execute("""SELECT COUNT(*) FROM taxa""").fetchone()[0], 6)
+        with self.assertRaises(duckdb.Error):
+            con.execute("""CREATE TABLE scratch (x INTEGER)""")
+        con.close()
+
+    def test_reuse(self):
+        '''
+        Shared connections are reused per path until closed.
+        '''
+        con = c0.connect_db(self.db_path, read_only = True, shared = True)
+
+        self.assertIs(c0.connect_db(self.db_path, read_only = True, shared = True), con)
+        self.assertIsNot(c0.connect_db(self.db_path, read_only = True), con)
+
+        with self.assertRaises(ValueError):
+            c0.connect_db(self.db_path, shared = True)
+
+        c0.close_shared(self.db_path)
+        self.assertIsNot(c0.connect_db(self.db_path, read_only = True, shared = True), con)
+
+    def test_skip_schema(self):
+        '''
+        The schema probe can be skipped, so empty databases open without error.
+        '''
+        empty_path = os.path.join(self.tmpdir.name, 'empty')
+        duckdb.connect(empty_path).close()
+
+        with self.assertRaises(AttributeError):
+            c0.connect_db(empty_path)
+
+        c0.connect_db(empty_path, check_schema = False).close()
+
+
+class TestImport(unittest.TestCase):
+    '''
+    Import side effects of c0.
+    '''
+
+    def test_deferred_imports(self):
+        '''
+        c0 imports in a fresh interpreter without loading plotly or kaleido.
+        '''
+        cmd = ('import sys, c0; '
+               'print("plotly" in sys.modules, "kaleido" in sys.modules)')
+        out = subprocess.run([sys.executable, '-c', cmd], capture_output = True, text = True,
+                             check = True).stdout.split()
+
+        self.assertEqual(out, ['False', 'False'])
+
+
 class TestBuildValidProt(unittest.TestCase):
     '''
     Tests for the validprot_build function.
@@ -124,6 +300,857 @@ class TestBuildValidProt(unittest.TestCase):
             c0.build_validprot(con, min_16s = 0)
 
 
+class TestResumableBuild(L2TTestCase):
+    '''
+    Tests for fingerprinted stage execution in build_validprot.
+    '''
+
+    def build(self, **kwargs):
+        c0.build_validprot(c0.connect_db(self.db_path), **kwargs)
+
+    def finished(self):
+        con = duckdb.connect(self.db_path)
+        meta = con.execute("""SELECT stage, status, finished_at
+                              FROM vp_build_meta""").fetchall()
+        con.close()
+        return {stage: (status, finished_at) for stage, status, finished_at in meta}
+
+    def test_meta_recorded(self):
+        '''
+        Every stage is recorded as complete after a build.
+        '''
+        self.build()
+        meta = self.finished()
+
+        self.assertEqual(sorted(meta), sorted(stage for stage, _, _ in c0.VP_STAGES
+                                              if stage not in c0.SEQUENCE_STAGES +
+                                              c0.FEATURE_STAGES))
+        assert all(status == 'complete' for status, _ in meta.values())
+
+    def test_rerun_skips(self):
+        '''
+        Rebuilding with unchanged inputs does not rerun any stage.
+        '''
+        self.build()
+        first = self.finished()
+        self.build()
+
+        self.assertEqual(first, self.finished())
+
+    def test_param_change(self):
+        '''
+        Changing min_ogt_diff reruns vp_ogt_taxa_pairs and everything after it only.
+        '''
+        self.build()
+        first = self.finished()
+        self.build(min_ogt_diff = 26)
+        second = self.finished()
+
+        for stage in ['vp_taxa_pairs', 'vp_taxa', 'vp_proteins']:
+            self.assertEqual(first[stage], second[stage])
+        for stage in ['vp_ogt_taxa_pairs', 'vp_protein_pairs', 'vp_final']:
+            self.assertNotEqual(first[stage], second[stage])
+
+        con = duckdb.connect(self.db_path)
+        diffs = con.execute("""SELECT DISTINCT ogt_difference FROM vp_final""").fetchall()
+        con.close()
+        assert all(diff[0] >= 26 for diff in diffs)
+
+    def test_source_change(self):
+        '''
+        Editing a learn2therm table reruns the stages that depend on it.
+        '''
+        self.build()
+        first = self.finished()
+
+        con = duckdb.connect(self.db_path)
+        con.execute("""UPDATE proteins SET protein_desc = 'renamed' WHERE protein_int_index = 0""")
+        con.close()
+        self.build()
+        second = self.finished()
+
+        self.assertEqual(first['vp_protein_pairs'], second['vp_protein_pairs'])
+        self.assertNotEqual(first['vp_proteins'], second['vp_proteins'])
+        self.assertNotEqual(first['vp_final'], second['vp_final'])
+
+    def test_failed_stage(self):
+        '''
+        A stage that raises is recorded as failed and rebuilt on the next run.
+        '''
+        con = duckdb.connect(self.db_path)
+        con.execute("""ALTER TABLE proteins RENAME COLUMN protein_seq TO seq""")
+        con.close()
+
+        with self.assertRaises(duckdb.Error):
+            self.build()
+        self.assertEqual(self.finished()['vp_final'][0], 'failed')
+
+        con = duckdb.connect(self.db_path)
+        con.execute("""ALTER TABLE proteins RENAME COLUMN seq TO protein_seq""")
+        con.close()
+        self.build()
+        self.assertEqual(self.finished()['vp_final'][0], 'complete')
+
+
+class TestFusedBuild(L2TTestCase):
+    '''
+    Tests for the fused execution mode of build_validprot.
+    '''
+
+    databases = {'staged_path': 'staged', 'fused_path': 'fused'}
+
+    def test_matches_staged(self):
+        '''
+        Fused and staged builds produce the same vp_final.
+        '''
+        c0.build_validprot(c0.connect_db(self.staged_path))
+        c0.build_validprot(c0.connect_db(self.fused_path), mode = 'fused')
+
+        cmd = """SELECT * FROM vp_final ORDER BY prot_pair_index"""
+        pd.testing.assert_frame_equal(read(self.staged_path, cmd),
+                                      read(self.fused_path, cmd))
+
+    def test_only_final(self):
+        '''
+        Fused mode writes vp_final and the requested intermediates only.
+        '''
+        c0.build_validprot(c0.connect_db(self.fused_path), mode = 'fused',
+                           keep = ['vp_protein_pairs'])
+
+        tables = read(self.fused_path, """SELECT TABLE_NAME
+                                          FROM INFORMATION_SCHEMA.TABLES
+                                          WHERE TABLE_TYPE='BASE TABLE'""")
+        tables = set(tables['table_name'])
+
+        assert 'vp_final' in tables and 'vp_protein_pairs' in tables
+        for stage in ['vp_taxa_pairs', 'vp_taxa', 'vp_ogt_taxa_pairs', 'vp_proteins']:
+            assert stage not in tables
+
+    def test_invalid_mode(self):
+        '''
+        Test for unsupported mode and keep arguments.
+        '''
+        with self.assertRaises(ValueError):
+            c0.build_validprot(c0.connect_db(self.fused_path), mode = 'parallel')
+
+        with self.assertRaises(ValueError):
+            c0.build_validprot(c0.connect_db(self.fused_path), mode = 'fused',
+                               keep = ['vp_final'])
+
+
+class TestShardedBuild(L2TTestCase):
+    '''
+    Tests for the sharded execution mode of build_validprot.
+    '''
+
+    databases = {'staged_path': 'staged', 'sharded_path': 'sharded'}
+
+    def test_matches_staged(self):
+        '''
+        Merged and unmerged sharded builds produce the same vp_final as a staged build.
+        '''
+        c0.build_validprot(c0.connect_db(self.staged_path))
+        metrics = c0.build_validprot(c0.connect_db(self.sharded_path), mode = 'sharded',
+                                     n_shards = 4, workers = 2)
+
+        cmd = """SELECT * FROM vp_final ORDER BY prot_pair_index"""
+        expected = read(self.staged_path, cmd)
+        pd.testing.assert_frame_equal(expected, read(self.sharded_path, cmd))
+
+        shards = metrics[metrics['stage'].str.startswith('vp_final_shard_')]
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(shards['rows'].sum(), 16)
+
+        c0.build_validprot(c0.connect_db(self.sharded_path), mode = 'sharded', n_shards = 4,
+                           workers = 2, merge_shards = False)
+        pd.testing.assert_frame_equal(expected, read(self.sharded_path, cmd))
+
+        views = read(self.sharded_path, """SELECT TABLE_NAME
+                                           FROM INFORMATION_SCHEMA.TABLES
+                                           WHERE TABLE_TYPE='VIEW'""")
+        assert 'vp_final' in views['table_name'].values
+
+    def test_materialized_chain(self):
+        '''
+        Shards restrict kept taxa pair and protein tables and the normalized protein tables to
+        their own pairs and still match a staged build.
+        '''
+        options = {'normalize_sequences': True, 'sequence_features': True}
+        c0.build_validprot(c0.connect_db(self.staged_path), **options)
+        metrics = c0.build_validprot(c0.connect_db(self.sharded_path), mode = 'sharded',
+                                     n_shards = 3, workers = 1,
+                                     keep = ['vp_ogt_taxa_pairs', 'vp_proteins'], **options)
+
+        cmd = """SELECT * FROM vp_final ORDER BY prot_pair_index"""
+        pd.testing.assert_frame_equal(read(self.staged_path, cmd),
+                                      read(self.sharded_path, cmd))
+
+        shards = metrics[metrics['stage'].str.startswith('vp_final_shard_')]
+        self.assertEqual(shards['rows'].sum(), 16)
+
+        setup = c0._shard_setup(['vp_ogt_taxa_pairs', 'vp_proteins'], 3, 0, 20, 1300)
+        self.assertIn('FROM main.vp_ogt_taxa_pairs', setup[0])
+        self.assertIn('TEMP TABLE vp_proteins', setup[2])
+        self.assertIn('FROM main.vp_proteins', setup[2])
+
+    def test_resume(self):
+        '''
+        Only unfinished shards are rebuilt when a build is rerun before its merge completed.
+        '''
+        c0.build_validprot(c0.connect_db(self.sharded_path), mode = 'sharded', n_shards = 4,
+                           workers = 2)
+
+        # Leaves the database as if shard 1 had been lost before the merge.
+        os.remove(os.path.join(f'{self.sharded_path}.shards', 'shard_00001.parquet'))
+        con = duckdb.connect(self.sharded_path)
+        con.execute("""DELETE FROM vp_build_meta WHERE stage = 'vp_final'""")
+        con.close()
+
+        metrics = c0.build_validprot(c0.connect_db(self.sharded_path), mode = 'sharded',
+                                     n_shards = 4, workers = 2)
+        status = dict(zip(metrics['stage'], metrics['status']))
+
+        self.assertEqual(status['vp_final_shard_1'], 'complete')
+        for shard in [0, 2, 3]:
+            self.assertEqual(status[f'vp_final_shard_{shard}'], 'skipped')
+
+        self.assertEqual(read(self.sharded_path,
+                              """SELECT COUNT(*) AS n FROM vp_final""")['n'][0], 16)
+
+    def test_failed_shard(self):
+        '''
+        Failed shards are recorded and reported.
+        '''
+        with self.assertRaises(RuntimeError):
+            c0.build_validprot(c0.connect_db(self.sharded_path), mode = 'sharded', n_shards = 2,
+                               workers = 1, stage_profiles = {'vp_final': {'threads': 0}})
+
+        meta = read(self.sharded_path, """SELECT stage, status FROM vp_build_meta
+                                          WHERE stage LIKE 'vp_final_shard_%'""")
+        self.assertEqual(set(meta['status']), {'failed'})
+
+    def test_invalid(self):
+        '''
+        Test for unsupported shard arguments and in-memory databases.
+        '''
+        with self.assertRaises(ValueError):
+            c0.build_validprot(c0.connect_db(self.sharded_path), mode = 'sharded', n_shards = 0)
+
+        con = duckdb.connect()
+        with self.assertRaises(ValueError):
+            c0.build_validprot(con, mode = 'sharded')
+
+
+class TestSortedLayout(L2TTestCase):
+    '''
+    Tests for the sorted vp_final and its lookup tables.
+    '''
+
+    def test_lookups(self):
+        '''
+        Every mode writes vp_final in key order and lookup tables consistent with it.
+        '''
+        for mode in c0.BUILD_MODES:
+
+            c0.build_validprot(c0.connect_db(self.db_path), mode = mode, force = True,
+                               n_shards = 2, workers = 1)
+            con = duckdb.connect(self.db_path)
+            keys = con.execute("""SELECT prot_pair_index FROM vp_final""").df()
+            self.assertTrue(keys['prot_pair_index'].is_monotonic_increasing, mode)
+
+            # Each pair appears once per role in the protein lookup.
+            n_lookup = con.execute("""SELECT COUNT(*) FROM vp_protein_lookup""").fetchone()[0]
+            self.assertEqual(n_lookup, 2 * len(keys))
+
+            spans = con.execute("""SELECT lookup.n_pairs, COUNT(*) AS n_final
+                                   FROM vp_taxa_pair_lookup AS lookup
+                                   JOIN vp_final ON (vp_final.prot_pair_index BETWEEN
+                                                     lookup.first_prot_pair_index AND
+                                                     lookup.last_prot_pair_index
+                                                     AND vp_final.taxa_pair_index =
+                                                     lookup.taxa_pair_index)
+                                   GROUP BY lookup.taxa_pair_index, lookup.n_pairs""").df()
+            self.assertTrue((spans['n_pairs'] == spans['n_final']).all(), mode)
+            con.close()
+
+
+class TestNormalizedSequences(L2TTestCase):
+    '''
+    Tests for the normalize_sequences option of build_validprot.
+    '''
+
+    databases = {'wide_path': 'wide', 'narrow_path': 'narrow'}
+
+    def setUp(self):
+        super().setUp()
+        c0.build_validprot(c0.connect_db(self.wide_path))
+
+    def check(self):
+        wide = read(self.wide_path, """SELECT * FROM vp_final ORDER BY prot_pair_index""")
+        view = read(self.narrow_path, """SELECT * FROM vp_final_wide
+                                         ORDER BY prot_pair_index""")
+        narrow = read(self.narrow_path, """SELECT * FROM vp_final""")
+        sequences = read(self.narrow_path, """SELECT * FROM vp_sequences""")
+
+        pd.testing.assert_frame_equal(wide, view)
+        for column in ['m_protein_seq', 't_protein_seq', 'm_protein_desc', 't_protein_desc']:
+            assert column not in narrow.columns
+        self.assertEqual(sequences['protein_seq'].nunique(), sequences.shape[0])
+
+    def test_staged(self):
+        '''
+        Normalized staged build rebuilds the wide layout exactly through vp_final_wide.
+        '''
+        c0.build_validprot(c0.connect_db(self.narrow_path), normalize_sequences = True)
+        self.check()
+
+    def test_fused(self):
+        '''
+        Normalized fused build writes the sequence store and the narrow vp_final.
+        '''
+        c0.build_validprot(c0.connect_db(self.narrow_path), mode = 'fused',
+                           normalize_sequences = True)
+        self.check()
+
+    def test_switch_back(self):
+        '''
+        Rebuilding without normalization restores the wide vp_final and drops the view.
+        '''
+        c0.build_validprot(c0.connect_db(self.narrow_path), normalize_sequences = True)
+        c0.build_validprot(c0.connect_db(self.narrow_path))
+
+        cmd = """SELECT * FROM vp_final ORDER BY prot_pair_index"""
+        pd.testing.assert_frame_equal(read(self.wide_path, cmd),
+                                      read(self.narrow_path, cmd))
+
+        views = read(self.narrow_path, """SELECT TABLE_NAME
+                                          FROM INFORMATION_SCHEMA.TABLES
+                                          WHERE TABLE_TYPE='VIEW'""")
+        assert 'vp_final_wide' not in set(views['table_name'])
+
+
+class TestSequenceFeatures(L2TTestCase):
+    '''
+    Tests for the sequence_features option of build_validprot.
+    '''
+
+    def test_values(self):
+        '''
+        Features match those computed from the sequences in Python.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path), sequence_features = True)
+        final = read(self.db_path, """SELECT * FROM vp_final ORDER BY prot_pair_index""")
+
+        for column in [f'{role}_{name}' for role in ['m', 't'] for name in c0.SEQUENCE_FEATURES]:
+            self.assertEqual(final[column].dtype, np.float32, column)
+
+        for seq, row in zip(final['m_protein_seq'], final.itertuples()):
+            count = {aa: seq.count(aa) for aa in c0.AMINO_ACIDS}
+            self.assertAlmostEqual(row.m_frac_K, count['K'] / len(seq), places = 6)
+            self.assertAlmostEqual(row.m_frac_charged,
+                                   sum(count[aa] for aa in 'DEKR') / len(seq), places = 6)
+            self.assertAlmostEqual(row.m_frac_ivywrel,
+                                   sum(count[aa] for aa in 'IVYWREL') / len(seq), places = 6)
+
+        # Fixture sequences only hold standard residues and no Q or H.
+        fractions = final[[f'm_frac_{aa}' for aa in c0.AMINO_ACIDS]].sum(axis = 1)
+        np.testing.assert_allclose(fractions, 1, rtol = 1e-5)
+        self.assertTrue(final['m_ek_qh_ratio'].isna().all())
+
+    def test_modes(self):
+        '''
+        Fused and normalized builds carry the same features as a staged build.
+        '''
+        columns = ', '.join(f'm_{name}, t_{name}' for name in c0.SEQUENCE_FEATURES)
+        cmd = f"""SELECT prot_pair_index, {columns} FROM vp_final ORDER BY prot_pair_index"""
+
+        c0.build_validprot(c0.connect_db(self.db_path), sequence_features = True)
+        staged = read(self.db_path, cmd)
+        c0.build_validprot(c0.connect_db(self.db_path), sequence_features = True,
+                           mode = 'fused', normalize_sequences = True)
+
+        pd.testing.assert_frame_equal(staged, read(self.db_path, cmd))
+
+    def test_switch_off(self):
+        '''
+        Rebuilding without features drops them from vp_final.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path), sequence_features = True)
+        c0.build_validprot(c0.connect_db(self.db_path))
+
+        assert 'm_frac_A' not in read(self.db_path, """SELECT * FROM vp_final""").columns
+
+    def test_update(self):
+        '''
+        Incremental updates compute features for new proteins.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path), sequence_features = True)
+
+        con = duckdb.connect(self.db_path)
+        con.execute("""INSERT INTO proteins VALUES (24, 0, 'MKEEQ', 'new', 5)""")
+        con.execute("""INSERT INTO protein_pairs
+                       VALUES (24, 0, 0, 3, 24, 12, 0.5, 0.4, 0.45, 100, 0.9, 98, 0.85, 200)""")
+        con.close()
+        c0.update_validprot(c0.connect_db(self.db_path), sequence_features = True)
+
+        row = read(self.db_path, """SELECT * FROM vp_final WHERE prot_pair_index = 24""").iloc[0]
+        self.assertAlmostEqual(row['m_frac_E'], 0.4, places = 6)
+        self.assertAlmostEqual(row['m_ek_qh_ratio'], 3.0, places = 6)
+
+
+class TestResourceProfile(L2TTestCase):
+    '''
+    Tests for resource profiles and their use in build_validprot.
+    '''
+
+    def test_detected_defaults(self):
+        '''
+        Detected defaults fill every setting except the temp directory.
+        '''
+        profile = c0.resource_profile()
+
+        self.assertEqual(sorted(profile), sorted(c0.PROFILE_SETTINGS))
+        assert profile['memory_limit'].endswith('GB')
+        assert 1 <= profile['threads'] <= os.cpu_count()
+        self.assertIsNone(profile['temp_directory'])
+        self.assertFalse(profile['preserve_insertion_order'])
+
+    def test_apply(self):
+        '''
+        Profiles passed to connect_db are applied to the connection.
+        '''
+        spill = os.path.join(self.tmpdir.name, 'spill')
+        profile = c0.resource_profile(memory_limit = '1GB', threads = 1, temp_directory = spill)
+        con = c0.connect_db(self.db_path, profile = profile)
+
+        settings = con.execute("""SELECT current_setting('memory_limit'),
+                                  current_setting('threads'),
+                                  current_setting('temp_directory')""").fetchone()
+        con.close()
+        self.assertEqual(settings, ('1.0GB', 1, spill))
+
+    def test_invalid_setting(self):
+        '''
+        Test for settings outside the resource profile.
+        '''
+        con = duckdb.connect()
+
+        with self.assertRaises(ValueError):
+            c0.apply_resource_profile(con, {'max_expression_depth': 10})
+
+        with self.assertRaises(ValueError):
+            c0.resource_profile(threads = 0)
+
+    def test_stage_profiles(self):
+        '''
+        Per-stage overrides are applied and resource use is recorded for every stage.
+        '''
+        profile = c0.resource_profile(memory_limit = '2GB', threads = 2)
+        c0.build_validprot(c0.connect_db(self.db_path), profile = profile,
+                           stage_profiles = {'vp_final': {'memory_limit': '1GB', 'threads': 1}})
+
+        con = duckdb.connect(self.db_path)
+        meta = con.execute("""SELECT stage, memory_limit, threads, peak_memory_bytes, spill_bytes
+                              FROM vp_build_meta""").fetchall()
+        con.close()
+
+        for stage, memory_limit, threads, peak_memory, spill in meta:
+            if stage == 'vp_final':
+                self.assertEqual((memory_limit, threads), ('1.0GB', 1))
+            else:
+                self.assertEqual((memory_limit, threads), ('2.0GB', 2))
+            assert peak_memory > 0
+            assert spill >= 0
+
+
+class TestExportParquet(L2TTestCase):
+    '''
+    Tests for the export_parquet function.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.out_dir = os.path.join(self.tmpdir.name, 'export')
+        c0.build_validprot(c0.connect_db(self.db_path))
+        self.con = duckdb.connect(self.db_path)
+
+    def tearDown(self):
+        self.con.close()
+        super().tearDown()
+
+    def test_ogt_partitions(self):
+        '''
+        Export by ogt bucket keeps every row and reports correct manifest statistics.
+        '''
+        manifest = c0.export_parquet(self.con, self.out_dir, bucket_width = 10)
+        total = self.con.execute("""SELECT COUNT(*) FROM vp_final""").fetchone()[0]
+
+        self.assertEqual(manifest['num_rows'].sum(), total)
+        self.assertEqual(sorted(manifest['partition']), ['ogt_bucket=20', 'ogt_bucket=30'])
+        assert os.path.exists(os.path.join(self.out_dir, 'manifest.json'))
+
+        for _, row in manifest.iterrows():
+            bucket = int(row['partition'].split('=')[1])
+            assert bucket <= row['ogt_difference_min'] <= row['ogt_difference_max'] < bucket + 10
+
+        pruned = self.con.execute(f"""SELECT COUNT(*)
+                                       FROM read_parquet('{self.out_dir}/*/*.parquet',
+                                                         hive_partitioning=1)
+                                       WHERE ogt_bucket = 20""").fetchone()[0]
+        self.assertEqual(pruned, manifest.set_index('partition').loc['ogt_bucket=20', 'num_rows'])
+
+    def test_hash_partitions(self):
+        '''
+        Export by taxa pair hash never splits a taxa pair across partitions.
+        '''
+        manifest = c0.export_parquet(self.con, self.out_dir, partition_by = 'taxa_pair_hash',
+                                     n_buckets = 4)
+        pairs = self.con.execute(f"""SELECT taxa_pair_index, COUNT(DISTINCT taxa_pair_bucket)
+                                      FROM read_parquet('{self.out_dir}/*/*.parquet',
+                                                        hive_partitioning=1)
+                                      GROUP BY taxa_pair_index""").fetchall()
+
+        assert len(manifest) <= 4
+        assert all(count == 1 for _, count in pairs)
+
+    def test_overwrite(self):
+        '''
+        Test for exporting into a non-empty directory.
+        '''
+        c0.export_parquet(self.con, self.out_dir)
+
+        with self.assertRaises(ValueError):
+            c0.export_parquet(self.con, self.out_dir)
+
+        c0.export_parquet(self.con, self.out_dir, overwrite = True)
+
+    def test_invalid_partition(self):
+        '''
+        Test for unsupported partitioning scheme.
+        '''
+        with self.assertRaises(ValueError):
+            c0.export_parquet(self.con, self.out_dir, partition_by = 'protein')
+
+
+class TestBuildStats(L2TTestCase):
+    '''
+    Tests for the vp_build_stats table written by build_validprot.
+    '''
+
+    def stats(self):
+        con = duckdb.connect(self.db_path)
+        stats = dict(con.execute("""SELECT stat, value FROM vp_build_stats""").fetchall())
+        con.close()
+        return stats
+
+    def test_counts(self):
+        '''
+        Aggregated counts match direct queries against the built tables.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+        stats = self.stats()
+
+        con = duckdb.connect(self.db_path)
+        expected = {'tp_l2t': """SELECT COUNT(*) FROM taxa_pairs""",
+                    'tp_validprot': """SELECT COUNT(*) FROM vp_ogt_taxa_pairs""",
+                    'tm_no_pair': """SELECT COUNT(taxa_index) FROM taxa
+                                    WHERE taxa_index IN (SELECT meso_index FROM taxa_pairs
+                                                         WHERE is_pair = False)""",
+                    'tt_validprot': """SELECT COUNT(taxa_index) FROM taxa
+                                      WHERE taxa_index IN (SELECT thermo_index
+                                                           FROM vp_ogt_taxa_pairs)""",
+                    'pp_validprot': """SELECT COUNT(*) FROM vp_protein_pairs""",
+                    'p_meso': """SELECT COUNT(DISTINCT meso_protein_int_index)
+                                FROM protein_pairs""",
+                    'pt_16s_pair': """SELECT COUNT(protein_int_index) FROM proteins
+                                     WHERE taxa_index IN (SELECT thermo_index FROM taxa_pairs
+                                                          WHERE is_pair = True)""",
+                    'p_null': """SELECT COUNT(protein_int_index) FROM proteins
+                                WHERE taxa_index IN (SELECT taxa_index FROM taxa
+                                                     WHERE ogt IS NULL)"""}
+        for stat, cmd in expected.items():
+            self.assertEqual(stats[stat], con.execute(cmd).fetchone()[0], stat)
+        con.close()
+
+    def test_fused(self):
+        '''
+        Fused builds write the same counts as staged builds.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+        staged = self.stats()
+        c0.build_validprot(c0.connect_db(self.db_path), mode = 'fused', force = True)
+
+        self.assertEqual(staged, self.stats())
+
+    def test_param_change(self):
+        '''
+        Raising the ogt cutoff refreshes counts downstream of the filter.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+        first = self.stats()
+        c0.build_validprot(c0.connect_db(self.db_path), min_ogt_diff = 26)
+        second = self.stats()
+
+        self.assertEqual(first['tp_l2t'], second['tp_l2t'])
+        self.assertEqual(first['tp_validprot'] - 1, second['tp_validprot'])
+        self.assertEqual(first['pp_validprot'] - 4, second['pp_validprot'])
+
+    def test_sankey_read_only(self):
+        '''
+        Sankey plots are built from the stats table without writing images.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+        con = duckdb.connect(self.db_path)
+        figures = c0.sankey_plots(con, 20, write_images = False)
+        con.close()
+
+        self.assertEqual(len(figures), 4)
+
+    def test_sankey_background(self):
+        '''
+        Background image export hands back a spawned process that can be joined.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+        con = duckdb.connect(self.db_path)
+
+        # Plots are written to ../../data/plots, which is kept inside the temporary directory.
+        work_dir = os.path.join(self.tmpdir.name, 'pipeline', 'c0')
+        os.makedirs(work_dir)
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            figures, process = c0.sankey_plots(con, 20, background = True)
+            process.join()
+        finally:
+            os.chdir(cwd)
+            con.close()
+
+        self.assertEqual(len(figures), 4)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir.name, 'data', 'plots'))), 4)
+
+
+class TestBuildMetrics(L2TTestCase):
+    '''
+    Tests for the per-stage metrics returned and persisted by build_validprot.
+    '''
+
+    def test_staged(self):
+        '''
+        Every built stage reports its output rows, timing and resource use.
+        '''
+        metrics = c0.build_validprot(c0.connect_db(self.db_path))
+
+        self.assertEqual(list(metrics.columns), list(c0.METRICS_COLUMNS))
+        self.assertTrue((metrics['status'] == 'complete').all())
+        self.assertEqual(metrics['build_id'].nunique(), 1)
+
+        final = metrics.set_index('stage').loc['vp_final']
+        self.assertEqual(final['rows'], 16)
+        self.assertGreater(final['wall_time_s'], 0)
+        self.assertAlmostEqual(final['rows_per_s'], final['rows'] / final['wall_time_s'])
+        self.assertGreater(final['peak_memory_bytes'], 0)
+
+    def test_skipped_and_inlined(self):
+        '''
+        Skipped and inlined stages are listed without measurements.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path), mode = 'fused', keep = ['vp_taxa_pairs'])
+        metrics = c0.build_validprot(c0.connect_db(self.db_path), min_ogt_diff = 26,
+                                     mode = 'fused', keep = ['vp_taxa_pairs'])
+        status = dict(zip(metrics['stage'], metrics['status']))
+
+        self.assertEqual(status['vp_taxa_pairs'], 'skipped')
+        self.assertEqual(status['vp_ogt_taxa_pairs'], 'inlined')
+        self.assertEqual(status['vp_final'], 'complete')
+        self.assertTrue(metrics.loc[metrics['status'] != 'complete', 'rows'].isna().all())
+
+    def test_persisted(self):
+        '''
+        Each build appends its metrics to vp_build_metrics and optionally to JSON.
+        '''
+        json_path = os.path.join(self.tmpdir.name, 'metrics.json')
+        first = c0.build_validprot(c0.connect_db(self.db_path))
+        second = c0.build_validprot(c0.connect_db(self.db_path), metrics_json = json_path)
+
+        con = duckdb.connect(self.db_path)
+        stored = con.execute("""SELECT build_id, stage, status, rows
+                                FROM vp_build_metrics""").df()
+        con.close()
+
+        self.assertEqual(set(stored['build_id']),
+                         {first['build_id'][0], second['build_id'][0]})
+        self.assertEqual(len(stored), len(first) + len(second))
+        self.assertTrue(stored.loc[stored['status'] == 'skipped', 'rows'].isna().all())
+
+        self.assertEqual(len(pd.read_json(json_path)), len(second))
+
+        c0.build_validprot(c0.connect_db(self.db_path), persist_metrics = False)
+        con = duckdb.connect(self.db_path)
+        self.assertEqual(con.execute("""SELECT COUNT(*) FROM vp_build_metrics""").fetchone()[0],
+                         len(stored))
+        con.close()
+
+
+class TestIncrementalUpdate(L2TTestCase):
+    '''
+    Tests for the update_validprot function.
+    '''
+
+    databases = {'db_path': 'l2t', 'full_path': 'full'}
+
+    def append(self, path):
+        '''
+        Adds a taxon with a new taxa pair and protein pairs, plus one more protein pair for an
+        existing taxa pair.
+        '''
+        con = duckdb.connect(path)
+        con.execute("""INSERT INTO taxa VALUES (6, 15.0, 1500)""")
+        con.execute("""INSERT INTO taxa_pairs
+                       SELECT 6, 6, 4, True, 0.9, 0.9, 0.9, 0.99, 0.99, 1000.0""")
+        con.execute("""INSERT INTO proteins
+                       SELECT 24 + k, 6, 'MKW' || repeat('A', k), 'new family', 3 + k
+                       FROM range(4) AS t(k)""")
+        con.execute("""INSERT INTO protein_pairs
+                       SELECT 24 + k, 6, 6, 4, 24 + k, 16 + k, 0.5, 0.4, 0.45, 100, 0.9, 98,
+                       0.85, 200.0
+                       FROM range(4) AS t(k)""")
+        con.execute("""INSERT INTO protein_pairs
+                       VALUES (28, 0, 0, 3, 1, 13, 0.5, 0.4, 0.45, 100, 0.9, 98, 0.85, 200.0)""")
+        con.close()
+
+    def edit(self, path):
+        '''
+        Raises the ogt of taxon 1 so its pairs fall below the ogt cutoff and renames protein 0.
+        '''
+        con = duckdb.connect(path)
+        con.execute("""UPDATE taxa SET ogt = 50.0 WHERE taxa_index = 1""")
+        con.execute("""UPDATE proteins SET protein_desc = 'renamed' WHERE protein_int_index = 0""")
+        con.close()
+
+    def assert_same_tables(self):
+        '''
+        Every ValidProt table of the updated database matches a full build over the same data.
+        '''
+        c0.build_validprot(c0.connect_db(self.full_path), force = True)
+
+        for stage in [stage for stage, _, _ in c0.VP_STAGES
+                      if stage not in c0.SEQUENCE_STAGES + c0.FEATURE_STAGES]:
+
+            frames = []
+            for path in [self.db_path, self.full_path]:
+                con = duckdb.connect(path)
+                df = con.execute(f"""SELECT * FROM {stage}""").df()
+                con.close()
+                frames.append(df.sort_values(list(df.columns)).reset_index(drop = True))
+
+            pd.testing.assert_frame_equal(frames[0], frames[1], obj = stage)
+
+    def test_append(self):
+        '''
+        Appended rows are brought in by rebuilding only the affected rows.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+        self.append(self.db_path)
+        self.append(self.full_path)
+        metrics = c0.update_validprot(c0.connect_db(self.db_path))
+
+        self.assert_same_tables()
+
+        # The new taxa pair's four protein pairs plus the one added to taxa pair 0.
+        rows = dict(zip(metrics['stage'], metrics['rows']))
+        self.assertEqual(rows['vp_final'], 5)
+        self.assertTrue((metrics['status'] == 'updated').all())
+
+        con = duckdb.connect(self.db_path)
+        keys = con.execute("""SELECT prot_pair_index FROM vp_final""").df()
+        con.close()
+        self.assertTrue(keys['prot_pair_index'].is_monotonic_increasing)
+
+    def test_changed(self):
+        '''
+        Rows edited in place are rebuilt when their keys are passed in changed.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+        self.edit(self.db_path)
+        self.edit(self.full_path)
+        c0.update_validprot(c0.connect_db(self.db_path),
+                            changed = {'taxa': [1], 'proteins': [0]})
+
+        self.assert_same_tables()
+
+    def test_unlisted_edit(self):
+        '''
+        Rows edited below the watermark without their keys in changed stop the update, and the
+        next build rebuilds the stages they feed instead of skipping them.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+
+        for path in [self.db_path, self.full_path]:
+            con = duckdb.connect(path)
+            con.execute("""UPDATE taxa SET ogt = ogt + 40 WHERE taxa_index IN (0, 1, 2, 3)""")
+            con.close()
+
+        con = c0.connect_db(self.db_path)
+        with self.assertRaises(ValueError):
+            c0.update_validprot(con)
+        con.close()
+
+        metrics = c0.build_validprot(c0.connect_db(self.db_path))
+        status = dict(zip(metrics['stage'], metrics['status']))
+        self.assertNotEqual(status['vp_ogt_taxa_pairs'], 'skipped')
+
+        self.assert_same_tables()
+
+    def test_fused(self):
+        '''
+        Only materialized stages are updated after a fused build.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path), mode = 'fused')
+        self.append(self.db_path)
+        metrics = c0.update_validprot(c0.connect_db(self.db_path))
+        status = dict(zip(metrics['stage'], metrics['status']))
+
+        self.assertEqual(status['vp_ogt_taxa_pairs'], 'inlined')
+        self.assertEqual(status['vp_final'], 'updated')
+
+        self.append(self.full_path)
+        c0.build_validprot(c0.connect_db(self.full_path), mode = 'fused')
+        cmd = """SELECT * FROM vp_final ORDER BY prot_pair_index"""
+        frames = []
+        for path in [self.db_path, self.full_path]:
+            con = duckdb.connect(path)
+            frames.append(con.execute(cmd).df())
+            con.close()
+        pd.testing.assert_frame_equal(frames[0], frames[1])
+
+    def test_rerun_skips(self):
+        '''
+        A build after an update finds every stage up to date.
+        '''
+        c0.build_validprot(c0.connect_db(self.db_path))
+        self.append(self.db_path)
+        c0.update_validprot(c0.connect_db(self.db_path))
+        metrics = c0.build_validprot(c0.connect_db(self.db_path))
+
+        self.assertTrue((metrics['status'] == 'skipped').all())
+
+    def test_invalid(self):
+        '''
+        Test for updates without a matching build and unknown tables in changed.
+        '''
+        with self.assertRaises(ValueError):
+            c0.update_validprot(c0.connect_db(self.db_path))
+
+        c0.build_validprot(c0.connect_db(self.db_path))
+
+        with self.assertRaises(ValueError):
+            c0.update_validprot(c0.connect_db(self.db_path), min_ogt_diff = 26)
+
+        with self.assertRaises(ValueError):
+            c0.update_validprot(c0.connect_db(self.db_path), changed = {'vp_final': [0]})
+
+
 class TestSankey(unittest.TestCase):
     '''
     Tests for sankey_plots function.
@@ -142,9 +1169,9 @@ class TestSankey(unittest.TestCase):
         c0.sankey_plots(con, min_ogt_diff)
 
     def test_ogt_out_of_range(self):
-    '''
-    Test for improper ogt spread.
-    '''        
+        '''
+        Test for improper ogt spread.
+        '''        
         db_path = get_db_path()
         con = c0.connect_db(db_path)
 
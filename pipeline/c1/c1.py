@@ -1,51 +1,230 @@
 '''
 This package imports data to be used in the ValidProt model. Current support for DuckDB objects
-generated from upstream component and for user-generated DataFrames with correct structure.
+generated from upstream component, Parquet datasets exported by c0.export_parquet and for
+user-generated DataFrames with correct structure.
 
 Functions:
     fetch_data: Generates input data for the ValidProt model in the form of a DataFrame with
     alignment features as columns. User can control size of sample and sampling method.
+
+    fetch_page: Reads one keyset page of vp_final in prot_pair_index order.
+
+    iter_batches: Streams vp_final as fixed-size DataFrame or Arrow RecordBatch batches.
+
+    prefetch_batches: Streams iter_batches batches from a background thread, reporting how long
+    the consumer waited for them.
+
+    csv_index: Builds or loads the sidecar index of row byte offsets for a CSV file.
+
+    cache_info: Reports hit, miss and eviction counts and the size of a fetch_data cache.
+
+    lookup_pairs: Looks up pairs by prot_pair_index range, protein or taxa pair.
+
+    connect_db: Opens a DuckDB connection through component 0, which is imported on first use.
+
+    close_shared: Closes the shared read-only connections fetches keep open, so the process can
+    write to those databases again.
+
+    parquet_view: Opens an in-memory DuckDB connection with a vp_final view over a Parquet
+    dataset exported by component 0.
+
+    csv_view: Opens an in-memory DuckDB connection with a vp_final view over a CSV export.
 '''
+import glob
+import hashlib
+import io
+import json
+import operator
 import os
+import queue
 import sys
+import threading
+import time
 
-#import time
+from concurrent.futures import ThreadPoolExecutor
 
+
+import numpy as np
 import pandas as pd
-#import numpy as np
 
-#import duckdb
+import duckdb
+
+# Component 0 is imported on first connection rather than with this module. Its location is
+# resolved from this file so imports work from any working directory.
+_C0_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'c0_preprocessing'))
+
+# Suffix of the row offset index written next to CSV inputs.
+CSV_INDEX_SUFFIX = '.offsets.npy'
+
+# File extensions of fetch_data cache entries by format.
+CACHE_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Readers fetch_data can parse CSV inputs with.
+CSV_ENGINES = ['pandas', 'duckdb']
+
+# Result types fetch_data can return.
+OUTPUTS = ['pandas', 'arrow', 'numpy']
+
+# Float columns that compacting leaves at float64, matched case-insensitively within column
+# names. E-values fall below the smallest float32 and probabilities need the digits near 1.
+COMPACT_FLOAT64 = ['e_value', 'evalue', 'p_value', 'pvalue', 'prob']
+
+# Compacting only dictionary-encodes string columns with at most this many distinct values per
+# row. Mostly unique columns such as protein sequences gain nothing from a dictionary.
+COMPACT_MAX_DISTINCT = 0.5
+
+# Cache lookups made by this process.
+_CACHE_COUNTS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def connect_db(path: str, **kwargs):
+    '''
+    Opens a DuckDB connection with c0.connect_db, importing component 0 on first use.
+
+    Args:
+        path (str): Path to DuckDB database file.
+        **kwargs: Passed on to c0.connect_db.
+
+    Returns:
+        con (duckdb.DuckDBPyConnection): Connection returned by c0.connect_db.
+    '''
+    if _C0_PATH not in sys.path:
+        sys.path.append(_C0_PATH)
+
+    from c0 import connect_db as c0_connect_db
+
+    return c0_connect_db(path, **kwargs)
+
+
+def close_shared(path: str = None):
+    '''
+    Closes shared connections with c0.close_shared. Fetches from a DuckDB database keep a shared
+    read-only connection to it open, and DuckDB will not open the same file read-write in that
+    process until it is closed.
+
+    Args:
+        path (str): Database path whose shared connection to close. Closes all of them when None.
+    '''
+    if _C0_PATH not in sys.path:
+        sys.path.append(_C0_PATH)
+
+    from c0 import close_shared as c0_close_shared
+
+    c0_close_shared(path)
 
-module_path = os.path.abspath(os.path.join('..', 'c0_preprocessing'))
-if module_path not in sys.path:
-    sys.path.append(module_path)
-from c0 import connect_db
 
 def fetch_data(path, form = 'duckdb', size: int = 1000, method = 'random', idx_range: list = [0,0],
-               chunksize: int = 10 ** 5):
+               chunksize: int = 10 ** 5, columns: list = None, where: dict = None,
+               seed: int = None, rows: list = None, row_index: bool = True,
+               strata: dict = None, per_stratum: int = None, cache: str = None,
+               cache_bytes: int = 2 ** 30, cache_format = 'parquet', output = 'pandas',
+               compact: bool = None, workers: int = 1, csv_engine = 'pandas'):
     '''
-    Pulls data from DuckDB database or pandas DataFrame for input to ValidProt model.
+    Pulls data from DuckDB database or pandas DataFrame for input to ValidProt model. DuckDB
+    databases are read through a read-only connection shared by every fetch in the process, each
+    on its own cursor, so fetch_data can be called from several threads. Call close_shared before
+    opening a fetched database read-write in the same process.
 
     Args:
-        path (str): Path to database or DataFrame input.
-        form (str): Identifies import method for either DuckDB database or DataFrame.
+        path (str): Path to database, Parquet dataset directory or DataFrame input.
+        form (str): Identifies import method for DuckDB database, Parquet dataset or DataFrame.
         size (int): Sample size to be passed to ValidProt model.
-        method (str): Specifies random, chunked, or sequential sampling.
+        method (str): Specifies random, chunked, sequential or stratified sampling.
         idx_range (list): Only applies to numeric sampling. Min and max index range for numeric
-                          sampling.
+                          sampling. For DuckDB and Parquet inputs this is an inclusive range of
+                          prot_pair_index values, read as a range scan. For CSV inputs it is an
+                          inclusive range of 0-based data row positions. Reading starts at the
+                          byte offset of the first row and stops after the last. Left at [0,0],
+                          it is [0, size - 1], so CSV inputs read the first size rows and the
+                          other inputs read prot_pair_index 0 to size - 1.
         chunksize (int): Only applies to chunk sampling for large datasets. Sets size of each chunk.
+                         Chunks of DuckDB and Parquet inputs are read with keyset pagination on
+                         prot_pair_index, so later chunks cost no more than earlier ones. Chunks
+                         are concatenated into one DataFrame; use iter_batches to consume them
+                         one at a time instead.
+        columns (list): Columns to read. prot_pair_index is always included as the row key.
+                        Reads every column if None. DuckDB and Parquet scans only read these
+                        columns and CSV files only parse them.
+        where (dict): Filters rows before sampling. Maps column names to a value the column must
+                      equal or to an inclusive (min, max) range, either end of which may be None,
+                      e.g. {'ogt_difference': (25, None), 'm_protein_len': (None, 500)}. Filters
+                      are pushed into the DuckDB or Parquet scan and applied to each CSV chunk as
+                      it is read.
+        seed (int): Only applies to random and stratified sampling. Seed that makes the sample
+                    repeatable. CSV files are sampled in a single streaming pass with a reservoir
+                    of size rows, so memory does not grow with the file.
+        rows (list): Only applies to CSV inputs read with pandas. 0-based data row positions to
+                     read, returned in the given order with their positions as index. Overrides
+                     method.
+        row_index (bool): Only applies to CSV inputs read with pandas. Uses the sidecar row
+                          offset index from csv_index, building it on first use, so rows, numeric
+                          ranges and unfiltered random samples seek straight to their rows
+                          instead of scanning the file. Chunk reads and filtered random samples
+                          still stream the file and do not build the index.
+        strata (dict): Only applies to stratified sampling of DuckDB and Parquet inputs. Maps
+                       columns to None, making each distinct value a stratum, or to ascending bin
+                       edges, making each half-open bin a stratum, e.g. {'ogt_difference':
+                       [20, 30, 40, None], 'taxa_pair_index': None}. A None first or last edge
+                       leaves that end open. Several columns stratify on every combination. Rows
+                       outside the bins or with a NULL stratum value are left out.
+        per_stratum (int): Only applies to stratified sampling. Rows drawn at random from each
+                           stratum, or every row of smaller strata. If None, size is split evenly
+                           over the strata and rows are trimmed from the fullest strata so the
+                           sample has at most size rows.
+        cache (str): Directory of an on-disk cache of results, or None for no caching. Results
+                     are keyed by the arguments and the size and modification time of the
+                     source files, so a repeated fetch from an unchanged source is read back
+                     without opening it. Unseeded random and stratified samples are not cached.
+        cache_bytes (int): Size limit of the cache directory. The least recently used results
+                           are evicted once it is exceeded.
+        cache_format (str): One of ['parquet', 'arrow'] to store results as Parquet or Arrow IPC
+                            files.
+        output (str): One of ['pandas', 'arrow', 'numpy'] for a pandas DataFrame, a pyarrow
+                      Table or a dict of NumPy arrays. DuckDB and Parquet results are fetched
+                      as Arrow for the arrow and numpy outputs and never pass through pandas.
+                      NumPy arrays share memory with the Arrow columns where the type allows.
+                      CSV row positions are only kept in the pandas index.
+        compact (bool): Casts floats to float32, narrows integers to the smallest type that holds
+                        their range and dictionary-encodes repetitive strings, which become
+                        categoricals in pandas. Columns named in COMPACT_FLOAT64 and floats
+                        outside the float32 range stay float64, and strings with more than
+                        COMPACT_MAX_DISTINCT distinct values per row stay plain. Defaults to True
+                        for the arrow and numpy outputs and False for pandas.
+        workers (int): Only applies to numeric and chunk sampling of DuckDB and Parquet inputs.
+                       With more than one worker the requested prot_pair_index span is split
+                       into disjoint ranges that are fetched concurrently, each on its own
+                       cursor, and reassembled in prot_pair_index order.
+        csv_engine (str): One of ['pandas', 'duckdb']. 'duckdb' reads CSV inputs, including
+                          compressed ones, through a vp_final view from csv_view, so they are
+                          sampled, projected and filtered by the same SQL as DuckDB inputs and
+                          idx_range is a prot_pair_index range. Every method then scans the file
+                          once in DuckDB with memory bounded by the result rather than the file.
 
     Returns:
-        validprot_df (pandas.DataFrame): DataFrame formatted for ValidProt model.
+        validprot_df (pandas.DataFrame, pyarrow.Table or dict): Data formatted for ValidProt
+            model. NumPy outputs map each column to an array, or dictionary-encoded columns to a
+            (codes, values) tuple of arrays.
 
     Raises:
-        ValueError: form must be one of ['csv', 'duckdb']. Other data types not yet supported.
-        ValueError: method must be one of ['random', 'numeric', 'chunk']
+        ValueError: form must be one of ['csv', 'duckdb', 'parquet']. Other data types not yet
+                    supported.
+        ValueError: method must be one of ['random', 'numeric', 'chunk', 'stratified']
+        ValueError: Stratified sampling needs strata and a DuckDB, Parquet or DuckDB-read CSV
+                    input.
+        ValueError: Bin edges must be ascending.
+        ValueError: cache_format must be one of ['parquet', 'arrow']
+        ValueError: output must be one of ['pandas', 'arrow', 'numpy']
+        ValueError: workers must be positive.
+        ValueError: csv_engine must be one of ['pandas', 'duckdb']
         ValueError: Index range must be positive.
+        ValueError: rows only applies to CSV inputs read with pandas and must be positions of
+                    existing rows.
+        ValueError: columns and where may only name columns of vp_final.
+        ValueError: where values must be a value or a (min, max) range.
     '''
 
-    forms = ['csv', 'duckdb']
-    methods = ['random', 'numeric', 'chunk']
+    forms = ['csv', 'duckdb', 'parquet']
+    methods = ['random', 'numeric', 'chunk', 'stratified']
 
     if form not in forms:
         raise ValueError(f'Invalid argument passed to form. Expected one of: {forms}')
@@ -58,81 +237,1558 @@ def fetch_data(path, form = 'duckdb', size: int = 1000, method = 'random', idx_r
         
     if idx_range[0] < 0:
         raise ValueError('Indices must be positive.')
-        
-    if form == 'csv':
 
-        # Uses pandas random sampling of DataFrame.
-        if method == 'random':
+    if csv_engine not in CSV_ENGINES:
+        raise ValueError(f'Invalid argument passed to csv_engine. Expected one of: {CSV_ENGINES}')
+
+    # CSV inputs read by DuckDB take the same path as databases and Parquet datasets.
+    sql = form != 'csv' or csv_engine == 'duckdb'
+
+    if rows is not None and sql:
+        raise ValueError('rows only applies to CSV inputs read with pandas.')
+
+    if method == 'stratified' and (not strata or not sql):
+        raise ValueError('Stratified sampling needs strata and a DuckDB, Parquet or '
+                         'DuckDB-read CSV input.')
+
+    if cache_format not in CACHE_FORMATS:
+        raise ValueError(f'Invalid argument passed to cache_format. Expected one of: '
+                         f'{list(CACHE_FORMATS)}')
+
+    if output not in OUTPUTS:
+        raise ValueError(f'Invalid argument passed to output. Expected one of: {OUTPUTS}')
+
+    if workers < 1:
+        raise ValueError('workers must be positive.')
+
+    compact = output != 'pandas' if compact is None else compact
+    arrow = output != 'pandas' or compact
+    terms = _where_terms(where)
+
+    # Samples drawn without a seed differ on every call and are never read from the cache.
+    cache_path = None
+    if cache is not None and (seed is not None or method not in ['random', 'stratified']
+                              or rows is not None):
+
+        arguments = {'size': size, 'method': method, 'idx_range': idx_range,
+                     'chunksize': chunksize, 'columns': columns, 'where': where, 'seed': seed,
+                     'rows': None if rows is None else np.asarray(rows).tolist(),
+                     'row_index': row_index, 'strata': strata, 'per_stratum': per_stratum,
+                     'compact': compact, 'csv_engine': csv_engine}
+        cache_path = os.path.join(cache, _cache_key(path, form, arguments)
+                                  + CACHE_FORMATS[cache_format])
 
-            validprot_df = pd.read_csv(path).sample(size)
+        cached = _cache_read(cache_path, cache_format)
+        if cached is not None:
+            return _output(cached, output, compact)
+
+    if not sql:
+
+        # Only row positions, numeric ranges and unfiltered random samples read through the
+        # index, so other methods neither build nor load it.
+        seek = rows is not None or method == 'numeric' or (method == 'random' and not terms)
+        offsets = csv_index(path) if seek and (row_index or rows is not None) else None
+
+        # Reads only the requested rows through the offset index.
+        if rows is not None:
+
+            rows = np.asarray(rows, dtype = np.int64)
+
+            if len(rows) and (rows.min() < 0 or rows.max() >= len(offsets) - 1):
+                raise ValueError(f'rows must be between 0 and {len(offsets) - 2}.')
+
+            validprot_df = _csv_rows(path, rows, offsets, columns, terms)
+
+        # Draws row positions from the offset index and reads only those rows.
+        elif method == 'random' and offsets is not None and not terms:
+
+            n_rows = len(offsets) - 1
+            positions = np.random.default_rng(seed).choice(n_rows, min(size, n_rows),
+                                                           replace = False)
+            validprot_df = _csv_rows(path, positions, offsets, columns, terms)
+
+        # Streams the file once through a reservoir of size rows.
+        elif method == 'random':
+
+            validprot_df = _csv_reservoir(_csv_chunks(path, columns, terms, chunksize), size,
+                                          seed)
 
         # Uses pandas chunking of DataFrame with final concatention.
         elif method == 'chunk':
 
-            dfs = pd.read_csv(path, chunksize=chunksize)
+            dfs = _csv_chunks(path, columns, terms, chunksize)
             validprot_df = pd.concat(dfs, ignore_index = True)
 
         # Selects only rows specified by user.
         else:
 
             if idx_range == [0,0]:
-                idx_range = [0, size]
+                idx_range = [0, size - 1]
 
-            validprot_df = pd.read_csv(path, skiprows = lambda x: x not in range(idx_range[0],
-                                                                                 idx_range[1]+1))
+            validprot_df = pd.concat(_csv_chunks(path, columns, terms, chunksize,
+                                                 rows = (idx_range[0], idx_range[1]),
+                                                 offsets = offsets))
 
-    if form == 'duckdb':
+    if sql:
 
-        con = connect_db(path)
+        con = _connect(path, form)
 
-        # Uses duckdb random sampling via SQL.
-        if method == 'random':
+        try:
 
-            sample_cmd = f"""SELECT *
-                             FROM vp_final
-                             USING SAMPLE {size}"""
-            validprot_df = con.execute(sample_cmd).df()
+            select = _select_sql(con, columns, terms, list(strata or []))
+            filters, params = _where_sql(terms)
 
-        # Performs a series of SQL queries until size is met.
-        elif method == 'chunk':
+            # Uses duckdb random sampling via SQL. Rows are filtered before they are sampled.
+            if method == 'random':
+
+                sample = f'{int(size)}' if seed is None else \
+                    f'reservoir({int(size)} ROWS) REPEATABLE ({int(seed)})'
+                sample_cmd = f"""SELECT *
+                                 FROM (SELECT {select}
+                                       FROM vp_final
+                                       WHERE {' AND '.join(filters)}) AS filtered
+                                 USING SAMPLE {sample}"""
+                validprot_df = _fetch(con.execute(sample_cmd, params), arrow)
+
+            # Ranks rows in random order within each stratum and keeps the first of each.
+            elif method == 'stratified':
+
+                validprot_df = _fetch(_stratified_sample(con, select, filters, params, strata, size,
+                                                         per_stratum, seed), arrow)
+
+            # Finds the span of the first size pairs, then fetches it in concurrent ranges.
+            elif method == 'chunk' and workers > 1 and form != 'csv':
 
-            offset = 0
-            dfs = []
+                span = con.execute(f"""SELECT MIN(prot_pair_index), MAX(prot_pair_index)
+                                       FROM (SELECT prot_pair_index
+                                             FROM vp_final
+                                             WHERE {' AND '.join(filters)}
+                                             ORDER BY prot_pair_index
+                                             LIMIT {int(size)}) AS first_pairs""",
+                                   params).fetchone()
+                validprot_df = _concat(_fetch_ranges(con, select, filters, params, span, workers,
+                                                     arrow), arrow)
 
-            while True:
-                
-                # Checks if size has been exceeded. Sets to size if it has.
-                if offset + chunksize > size:
-                    chunksize = size - offset
+            # A CSV view is rescanned by every query, so its first pairs are read by one top-N query
+            # rather than by keyset pages.
+            elif method == 'chunk' and form == 'csv':
 
-                chunk_cmd = f"""SELECT *
+                chunk_cmd = f"""SELECT {select}
                                 FROM vp_final
-                                LIMIT {chunksize}
-                                OFFSET {offset}
-                                ORDER BY prot_pair_index"""
-                dfs.append(con.execute(chunk_cmd).df())
-                offset += chunksize
+                                WHERE {' AND '.join(filters)}
+                                ORDER BY prot_pair_index
+                                LIMIT {int(size)}"""
+                validprot_df = _fetch(con.execute(chunk_cmd, params), arrow)
+
+            # Reads the first size pairs in prot_pair_index order, one keyset page per query.
+            elif method == 'chunk':
+
+                after = None
+                dfs = []
+
+                while sum(len(df) for df in dfs) < size:
+
+                    page_size = min(chunksize, size - sum(len(df) for df in dfs))
+                    dfs.append(_keyset_page(con, after, page_size, output = 'arrow' if arrow
+                                            else 'pandas', columns = columns, where = where))
+
+                    if len(dfs[-1]) < page_size:
+                        break
+
+                    if arrow:
+                        after = dfs[-1].column('prot_pair_index')[-1].as_py()
+                    else:
+                        after = dfs[-1]['prot_pair_index'].iloc[-1]
+
+                if arrow:
+                    import pyarrow as pa
+                    validprot_df = pa.Table.from_batches(dfs)
+                else:
+                    validprot_df = pd.concat(dfs, ignore_index = True)
+
+            # Selects only rows specified by the user.
+            else:
+
+                if idx_range == [0,0]:
+                    idx_range = [0, size - 1]
+
+                # Ranges are split over the pairs that exist rather than the requested bounds.
+                if workers > 1 and form != 'csv':
+
+                    span = con.execute(f"""SELECT MIN(prot_pair_index), MAX(prot_pair_index)
+                                           FROM vp_final
+                                           WHERE prot_pair_index BETWEEN {int(idx_range[0])}
+                                           AND {int(idx_range[1])}""").fetchone()
+                    validprot_df = _concat(_fetch_ranges(con, select, filters, params, span,
+                                                         workers, arrow), arrow)
+
+                else:
+
+                    num_cmd = f"""SELECT {select}
+                                 FROM vp_final
+                                 WHERE prot_pair_index BETWEEN {int(idx_range[0])}
+                                 AND {int(idx_range[1])}
+                                 AND {' AND '.join(filters)}
+                                 ORDER BY prot_pair_index"""
+
+                    validprot_df = _fetch(con.execute(num_cmd, params), arrow)
+
+        finally:
+            con.close()
+
+    # Results are cached in compacted form, with CSV row positions kept for pandas.
+    if arrow:
+        validprot_df = _output(validprot_df, 'arrow', compact, index = output == 'pandas')
+
+    if cache_path is not None:
+        _cache_write(validprot_df, cache_path, cache_format, cache_bytes)
+
+    return _output(validprot_df, output, compact)
+
+
+def fetch_page(path, after: int = None, size: int = 1000, form = 'duckdb', columns: list = None,
+               where: dict = None):
+    '''
+    Reads one page of vp_final in prot_pair_index order, starting after a given prot_pair_index.
+    Pass the last prot_pair_index of a page to get the next one. Pages are found by a range filter
+    on the key rather than an OFFSET, so deep pages cost the same as the first.
+
+    Args:
+        path (str): Path to DuckDB database or Parquet dataset directory.
+        after (int): Last prot_pair_index of the previous page. Starts from the beginning if None.
+        size (int): Maximum number of pairs in the page.
+        form (str): One of ['duckdb', 'parquet'].
+        columns (list): Columns to read, as in fetch_data.
+        where (dict): Row filters, as in fetch_data.
+
+    Returns:
+        page (pandas.DataFrame): Up to size pairs sorted by prot_pair_index. Fewer than size rows
+        means the end of vp_final was reached.
+
+    Raises:
+        ValueError: form must be one of ['duckdb', 'parquet'].
+        ValueError: size must be positive.
+        ValueError: columns and where may only name columns of vp_final.
+    '''
+    if size < 1:
+        raise ValueError('size must be positive.')
+
+    con = _connect(path, form)
+
+    try:
+        return _keyset_page(con, after, size, columns = columns, where = where)
+    finally:
+        con.close()
+
+
+def iter_batches(path, form = 'duckdb', batch_size: int = 10 ** 5, output = 'pandas',
+                 limit: int = None, columns: list = None, where: dict = None):
+    '''
+    Streams vp_final in fixed-size batches so it can be consumed without ever being held in
+    memory at once. DuckDB and Parquet inputs are read in prot_pair_index order one keyset page
+    per batch, and CSV files in file order with the pandas chunked reader. Only the batch being
+    yielded is held, so memory is bounded by batch_size rather than the size of vp_final.
+
+    Args:
+        path (str): Path to DuckDB database, Parquet dataset directory or CSV file.
+        form (str): One of ['csv', 'duckdb', 'parquet'].
+        batch_size (int): Number of pairs per batch. Only the last batch may be smaller.
+        output (str): One of ['pandas', 'arrow'] for pandas DataFrames or pyarrow RecordBatches.
+        limit (int): Stop after this many pairs. Reads everything if None.
+        columns (list): Columns to read, as in fetch_data.
+        where (dict): Row filters, as in fetch_data. Filtered CSV chunks are regrouped so
+                      batches keep their size.
+
+    Returns:
+        batches (generator): Yields pandas.DataFrame or pyarrow.RecordBatch batches.
+
+    Raises:
+        ValueError: form must be one of ['csv', 'duckdb', 'parquet'].
+        ValueError: output must be one of ['pandas', 'arrow'].
+        ValueError: batch_size must be positive.
+        ValueError: limit must not be negative.
+        ValueError: where values must be a value or a (min, max) range.
+    '''
+    forms = ['csv', 'duckdb', 'parquet']
+    outputs = ['pandas', 'arrow']
+
+    if form not in forms:
+        raise ValueError(f'Invalid argument passed to form. Expected one of: {forms}')
+
+    if output not in outputs:
+        raise ValueError(f'Invalid argument passed to output. Expected one of: {outputs}')
+
+    if batch_size < 1:
+        raise ValueError('batch_size must be positive.')
+
+    if limit is not None and limit < 0:
+        raise ValueError('limit must not be negative.')
+
+    _where_terms(where)
+
+    # Arguments are checked above rather than in the generator, which would only raise on the
+    # first batch.
+    return _iter_batches(path, form, batch_size, output, limit, columns, where)
+
+
+def _iter_batches(path, form, batch_size: int, output, limit: int, columns: list = None,
+                  where: dict = None):
+    '''
+    Generator behind iter_batches, see there for arguments.
+    '''
+    if form == 'csv':
+
+        for df in _csv_batches(path, batch_size, limit, columns, where):
+
+            if output == 'arrow':
+                import pyarrow as pa
+                yield pa.RecordBatch.from_pandas(df, preserve_index=False)
+            else:
+                yield df
+
+        return
+
+    # A stream has its own cursor, so it can be read from another thread than other fetches.
+    con = _connect(path, form)
+    after = None
+    remaining = limit
+
+    try:
+
+        while remaining is None or remaining > 0:
+
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            batch = _keyset_page(con, after, size, output, columns, where)
+            rows = batch.num_rows if output == 'arrow' else len(batch)
+
+            if rows == 0:
+                return
+
+            yield batch
+
+            if rows < size:
+                return
+
+            if output == 'arrow':
+                after = batch.column(batch.schema.get_field_index('prot_pair_index'))[-1].as_py()
+            else:
+                after = batch['prot_pair_index'].iloc[-1]
 
-                if offset > size:
-                    break
+            remaining = None if remaining is None else remaining - rows
 
-                validprot_df = pd.concat(dfs, ignore_index = True)
+    finally:
+        con.close()
 
-        # Selects only rows specified by the user.
+
+def prefetch_batches(path, form = 'duckdb', batch_size: int = 10 ** 5, output = 'pandas',
+                     limit: int = None, columns: list = None, where: dict = None,
+                     depth: int = 2, stats: dict = None):
+    '''
+    Streams the batches of iter_batches from a background thread, which reads up to depth
+    batches ahead while the consumer works on the current one. Queries, CSV parsing and
+    conversion of the next batches overlap with the consumer's work. DuckDB and pyarrow release
+    the GIL while they read, so the overlap holds for threads.
+
+    Waiting is timed on both sides. Time the consumer spends waiting for a batch is a stall, so
+    reading is the bottleneck, and time the loader spends waiting for free queue space means the
+    consumer is. A summary is printed when the stream ends.
+
+    Args:
+        path (str): Path to DuckDB database, Parquet dataset directory or CSV file.
+        form (str): One of ['csv', 'duckdb', 'parquet'].
+        batch_size (int): Number of pairs per batch.
+        output (str): One of ['pandas', 'arrow'].
+        limit (int): Stop after this many pairs. Reads everything if None.
+        columns (list): Columns to read, as in fetch_data.
+        where (dict): Row filters, as in fetch_data.
+        depth (int): Batches read ahead of the consumer. 2 double-buffers the stream.
+        stats (dict): Optional dict updated as the stream runs with 'batches', 'rows',
+                      'stall_seconds' the consumer waited, 'fetch_seconds' spent reading and
+                      'blocked_seconds' the loader waited on a full queue.
+
+    Returns:
+        batches (generator): Yields pandas.DataFrame or pyarrow.RecordBatch batches in the order
+                             of iter_batches.
+
+    Raises:
+        ValueError: depth must be positive.
+        ValueError: Invalid iter_batches arguments, see there.
+    '''
+    if depth < 1:
+        raise ValueError('depth must be positive.')
+
+    batches = iter_batches(path, form, batch_size, output, limit, columns, where)
+
+    return _prefetch(batches, depth, {} if stats is None else stats)
+
+
+def _prefetch(batches, depth: int, stats: dict):
+    '''
+    Generator behind prefetch_batches, see there for arguments. Errors raised while reading are
+    raised again in the consumer, and closing the generator early stops the loader.
+    '''
+    stats.update({'batches': 0, 'rows': 0, 'stall_seconds': 0.0, 'fetch_seconds': 0.0,
+                  'blocked_seconds': 0.0})
+    batch_queue = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+
+        start_time = time.perf_counter()
+
+        while not stopped.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+        stats['blocked_seconds'] += time.perf_counter() - start_time
+
+    def load():
+
+        try:
+            while not stopped.is_set():
+
+                start_time = time.perf_counter()
+                batch = next(batches, done)
+                stats['fetch_seconds'] += time.perf_counter() - start_time
+
+                put(batch)
+
+                if batch is done:
+                    return
+
+        except Exception as error:
+            put(error)
+
+        finally:
+            batches.close()
+
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+
+    try:
+        while True:
+
+            start_time = time.perf_counter()
+            batch = batch_queue.get()
+            stats['stall_seconds'] += time.perf_counter() - start_time
+
+            if batch is done:
+                break
+
+            if isinstance(batch, Exception):
+                raise batch
+
+            stats['batches'] += 1
+            stats['rows'] += batch.num_rows if hasattr(batch, 'num_rows') else len(batch)
+
+            yield batch
+
+        print(f"Prefetched {stats['batches']} batches of {stats['rows']} rows. Stalled "
+              f"{stats['stall_seconds']:.2f} seconds waiting for batches and blocked "
+              f"{stats['blocked_seconds']:.2f} seconds waiting for the consumer.")
+
+    finally:
+        stopped.set()
+        loader.join()
+
+
+def lookup_pairs(path, form = 'duckdb', idx_range: list = None, protein: int = None,
+                 taxa_pair: int = None):
+    '''
+    Looks up the pairs in vp_final with prot_pair_index in a range, the pairs a protein takes part
+    in as either mesophile or thermophile, or the pairs of a taxa pair. Filters given together are
+    combined. On databases built by component 0 the protein and taxa pair lookups first read the
+    prot_pair_index span from vp_protein_lookup or vp_taxa_pair_lookup, so vp_final is read as a
+    range scan rather than in full.
+
+    Args:
+        path (str): Path to DuckDB database or Parquet dataset directory.
+        form (str): One of ['duckdb', 'parquet'].
+        idx_range (list): Inclusive min and max prot_pair_index.
+        protein (int): protein_int_index of a mesophilic or thermophilic protein.
+        taxa_pair (int): taxa_pair_index of a taxa pair.
+
+    Returns:
+        validprot_df (pandas.DataFrame): Matching pairs sorted by prot_pair_index.
+
+    Raises:
+        ValueError: form must be one of ['duckdb', 'parquet'].
+        ValueError: At least one of idx_range, protein and taxa_pair is required.
+        ValueError: Index range must be positive.
+    '''
+    if idx_range is None and protein is None and taxa_pair is None:
+        raise ValueError('Specify at least one of idx_range, protein or taxa_pair.')
+
+    if idx_range is not None and idx_range[0] > idx_range[1]:
+        raise ValueError('Index range must be positive.')
+
+    con = _connect(path, form)
+
+    try:
+
+        tables = con.execute("""SELECT TABLE_NAME
+                                FROM INFORMATION_SCHEMA.TABLES""").df()['table_name'].values
+        filters = []
+
+        if idx_range is not None:
+            filters.append(f'prot_pair_index BETWEEN {int(idx_range[0])} AND {int(idx_range[1])}')
+
+        if taxa_pair is not None:
+
+            if 'vp_taxa_pair_lookup' in tables:
+                span = con.execute(f"""SELECT first_prot_pair_index, last_prot_pair_index
+                                        FROM vp_taxa_pair_lookup
+                                        WHERE taxa_pair_index = {int(taxa_pair)}""").fetchone()
+                filters.append(_span_filter(span))
+
+            filters.append(f'taxa_pair_index = {int(taxa_pair)}')
+
+        if protein is not None:
+
+            if 'vp_protein_lookup' in tables:
+                pairs_cmd = f"""SELECT prot_pair_index
+                                 FROM vp_protein_lookup
+                                 WHERE protein_int_index = {int(protein)}"""
+                span = con.execute(f"""SELECT MIN(prot_pair_index), MAX(prot_pair_index)
+                                        FROM ({pairs_cmd}) AS pairs""").fetchone()
+                filters.append(_span_filter(span))
+                filters.append(f'prot_pair_index IN ({pairs_cmd})')
+            else:
+                filters.append(f'(meso_protein_int_index = {int(protein)} OR '
+                               f'thermo_protein_int_index = {int(protein)})')
+
+        lookup_cmd = f"""SELECT *
+                          FROM vp_final
+                          WHERE {' AND '.join(filters)}
+                          ORDER BY prot_pair_index"""
+
+        return con.execute(lookup_cmd).df()
+
+    finally:
+        con.close()
+
+
+def csv_index(path, rebuild: bool = False, block_size: int = 2 ** 24):
+    '''
+    Builds or loads the row offset index of a CSV file. The index is a .npy file written next to
+    the CSV and memory-mapped when loaded, so reading it costs no more than the pages touched.
+    It records the CSV's size and modification time and is rebuilt whenever either changes.
+
+    Args:
+        path (str): Path to the CSV file.
+        rebuild (bool): Rebuilds the index even if a current one exists.
+        block_size (int): Bytes read at a time while scanning for line breaks.
+
+    Returns:
+        offsets (numpy.ndarray): int64 byte offset of each data row followed by the file size,
+                                 so the file has len(offsets) - 1 rows.
+    '''
+    index_path = path + CSV_INDEX_SUFFIX
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+
+    if not rebuild and os.path.exists(index_path):
+
+        index = np.load(index_path, mmap_mode = 'r')
+
+        # The first two entries hold the size and mtime the offsets were built from.
+        if index[:2].tolist() == stamp:
+            return index[2:]
+
+    offsets = _csv_scan(path, block_size)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+
+    try:
+        with open(tmp_path, 'wb') as file:
+            np.save(file, np.concatenate([np.array(stamp, dtype = np.int64), offsets]))
+        os.replace(tmp_path, index_path)
+    except OSError as error:
+        print(f'Could not write row index {index_path}: {error}. Using it in memory.')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return offsets
+
+
+def cache_info(cache: str):
+    '''
+    Reports how a fetch_data cache has been used by this process and what it holds.
+
+    Args:
+        cache (str): Cache directory passed to fetch_data.
+
+    Returns:
+        info (dict): Hits, misses and evictions counted by this process, and the number of
+                     entries and total bytes in the cache directory.
+    '''
+    entries = _cache_entries(cache)
+
+    return {**_CACHE_COUNTS, 'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries)}
+
+
+def _cache_key(path, form, arguments: dict):
+    '''
+    Hashes fetch_data arguments together with the size and modification time of every file
+    that backs the source, so any change to the source gives a new key.
+
+    Args:
+        path (str): Path to the source database, Parquet dataset or CSV file.
+        form (str): Form of the source.
+        arguments (dict): fetch_data arguments that change the result.
+
+    Returns:
+        key (str): Hex digest naming the cache entry.
+    '''
+    if form == 'parquet' and os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True))
+    else:
+        files = [path]
+
+    # Uncheckpointed DuckDB changes live in the write-ahead log.
+    if form == 'duckdb' and os.path.exists(path + '.wal'):
+        files.append(path + '.wal')
+
+    stamp = [(os.path.relpath(file, path), os.stat(file).st_size, os.stat(file).st_mtime_ns)
+             for file in files]
+    key = json.dumps([os.path.abspath(path), form, arguments, stamp], sort_keys=True, default=str)
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _cache_read(cache_path, cache_format):
+    '''
+    Reads a cache entry and marks it as recently used.
+
+    Args:
+        cache_path (str): Path of the entry.
+        cache_format (str): One of ['parquet', 'arrow'].
+
+    Returns:
+        table (pyarrow.Table): Cached result, or None on a miss.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    try:
+        if cache_format == 'parquet':
+            table = pq.read_table(cache_path)
         else:
+            with pa.memory_map(cache_path) as source:
+                table = pa.ipc.open_file(source).read_all()
+    except (FileNotFoundError, pa.ArrowInvalid):
+        _CACHE_COUNTS['misses'] += 1
+        return None
 
-            if idx_range == [0,0]:
-                idx_range = [0, size]
+    # Modification times order entries for eviction.
+    os.utime(cache_path)
+    _CACHE_COUNTS['hits'] += 1
+
+    return table
+
+
+def _cache_write(df, cache_path, cache_format, cache_bytes: int):
+    '''
+    Writes a cache entry, then evicts the least recently used entries until the cache fits in
+    cache_bytes. The newest entry is always kept.
+
+    Args:
+        df (pandas.DataFrame or pyarrow.Table): Result to cache, with its pandas index.
+        cache_path (str): Path of the entry.
+        cache_format (str): One of ['parquet', 'arrow'].
+        cache_bytes (int): Size limit of the cache directory.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+
+    if cache_format == 'parquet':
+        pq.write_table(table, tmp_path)
+    else:
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    os.replace(tmp_path, cache_path)
+
+    entries = _cache_entries(os.path.dirname(cache_path))
+    total = sum(size for _, size, _ in entries)
+
+    for entry, size, _ in entries[:-1]:
+
+        if total <= cache_bytes:
+            break
+
+        os.remove(entry)
+        total -= size
+        _CACHE_COUNTS['evictions'] += 1
+
+
+def _cache_entries(cache: str):
+    '''
+    Lists the entries of a cache directory from least to most recently used.
+
+    Args:
+        cache (str): Cache directory.
+
+    Returns:
+        entries (list): (path, bytes, mtime) tuples.
+    '''
+    entries = []
+
+    for extension in CACHE_FORMATS.values():
+        for entry in glob.glob(os.path.join(cache, '*' + extension)):
+            stat = os.stat(entry)
+            entries.append((entry, stat.st_size, stat.st_mtime_ns))
 
-            num_cmd = f"""SELECT *
-                         FROM vp_final
-                         LIMIT {idx_range[1] - idx_range[0]}
-                         OFFSET {idx_range[0]}
-                         ORDER BY prot_pair_index"""
+    return sorted(entries, key=lambda entry: entry[2])
 
-            validprot_df = con.execute(num_cmd)
 
-    # Feature filtering to be added.
-    #features = []
+def _fetch(cursor, arrow: bool):
+    '''
+    Fetches the result of an executed DuckDB query.
+
+    Args:
+        cursor (duckdb.DuckDBPyConnection): Connection with an executed query.
+        arrow (bool): Fetches a pyarrow Table instead of a pandas DataFrame.
+
+    Returns:
+        result (pandas.DataFrame or pyarrow.Table): Query result.
+    '''
+    return cursor.arrow() if arrow else cursor.df()
+
+
+def _output(result, output, compact: bool, index: bool = None):
+    '''
+    Converts a fetch_data result to the requested output type.
+
+    Args:
+        result (pandas.DataFrame or pyarrow.Table): Fetched rows.
+        output (str): One of ['pandas', 'arrow', 'numpy'].
+        compact (bool): Compacts column types with _compact first.
+        index (bool): Keeps the index of a DataFrame converted to Arrow. Defaults to keeping it
+                      only for pandas outputs.
+
+    Returns:
+        result (pandas.DataFrame, pyarrow.Table or dict): Rows in the requested type.
+    '''
+    if output == 'pandas' and not compact and isinstance(result, pd.DataFrame):
+        return result
+
+    import pyarrow as pa
+
+    index = output == 'pandas' if index is None else index
+    table = result if isinstance(result, pa.Table) else \
+        pa.Table.from_pandas(result, preserve_index = index)
+
+    if compact:
+        table = _compact(table)
+
+    if output == 'pandas':
+        return table.to_pandas()
+
+    if output == 'arrow':
+        return table
+
+    arrays = {}
+
+    for name, column in zip(table.column_names, table.columns):
+
+        column = column.combine_chunks()
+
+        if pa.types.is_dictionary(column.type):
+            arrays[name] = (column.indices.to_numpy(zero_copy_only = False),
+                            column.dictionary.to_numpy(zero_copy_only = False))
+        else:
+            arrays[name] = column.to_numpy(zero_copy_only = False)
+
+    return arrays
+
+
+def _compact(table):
+    '''
+    Shrinks the column types of a pyarrow Table. Floats become float32 unless their name matches
+    COMPACT_FLOAT64 or a nonzero value lies outside the normal float32 range, where it would
+    flush to zero or overflow. Integers take the smallest signed type that holds their range.
+    Strings are dictionary-encoded when they repeat enough, see COMPACT_MAX_DISTINCT.
+
+    Args:
+        table (pyarrow.Table): Table to compact.
+
+    Returns:
+        table (pyarrow.Table): Table with compacted columns and the same schema metadata.
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns = []
+    limits = np.finfo(np.float32)
+
+    for name, column in zip(table.column_names, table.columns):
+
+        if pa.types.is_floating(column.type) and column.type != pa.float32():
+
+            magnitude = pc.abs(column)
+            bounds = pc.min_max(pc.filter(magnitude, pc.greater(magnitude, 0)))
+            low, high = bounds['min'].as_py(), bounds['max'].as_py()
+
+            if not any(pattern in name.lower() for pattern in COMPACT_FLOAT64) and \
+               (low is None or (limits.tiny <= low and high <= limits.max)):
+                column = column.cast(pa.float32())
+
+        elif pa.types.is_integer(column.type):
+
+            bounds = pc.min_max(column)
+            low, high = bounds['min'].as_py(), bounds['max'].as_py()
+
+            if low is not None:
+                for int_type in [pa.int8(), pa.int16(), pa.int32(), pa.int64()]:
+                    info = np.iinfo(int_type.to_pandas_dtype())
+                    if info.min <= low and high <= info.max:
+                        column = column.cast(int_type)
+                        break
+
+        # One dictionary is shared by all chunks rather than one per chunk.
+        elif (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)) and \
+             pc.count_distinct(column).as_py() <= COMPACT_MAX_DISTINCT * len(column):
+            column = pc.dictionary_encode(column.combine_chunks())
+
+        columns.append(column)
+
+    return pa.Table.from_arrays(columns, names = table.column_names,
+                                metadata = table.schema.metadata)
+
+
+def _fetch_ranges(con, select: str, filters: list, params: list, span: tuple, workers: int,
+                  arrow: bool, ranges_per_worker: int = 4):
+    '''
+    Splits a prot_pair_index span into disjoint ranges and fetches them concurrently, each
+    thread on its own cursor of con. DuckDB releases the GIL while it scans, so the ranges are
+    read in parallel. Several ranges per worker even out ranges with fewer pairs.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection with vp_final available.
+        select (str): Select list from _select_sql.
+        filters (list): SQL conditions from _where_sql.
+        params (list): Values bound to filters.
+        span (tuple): Inclusive min and max prot_pair_index, or (None, None) for no pairs.
+        workers (int): Number of threads.
+        arrow (bool): Fetches pyarrow Tables instead of pandas DataFrames.
+        ranges_per_worker (int): Ranges the span is split into per thread.
+
+    Returns:
+        results (generator): Yields the result of each range in prot_pair_index order as soon as
+                             it and every earlier range have been fetched.
+    '''
+    if span[0] is None:
+        span = (0, -1)
+
+    bounds = np.unique(np.linspace(span[0], span[1] + 1, workers * ranges_per_worker + 1)
+                       .astype(np.int64))
+    range_cmd = f"""SELECT {select}
+                    FROM vp_final
+                    WHERE prot_pair_index BETWEEN ? AND ?
+                    AND {' AND '.join(filters)}
+                    ORDER BY prot_pair_index"""
+
+    def fetch(bound):
+
+        cursor = con.cursor()
+
+        try:
+            return _fetch(cursor.execute(range_cmd, [int(bound[0]), int(bound[1])] + params), arrow)
+        finally:
+            cursor.close()
+
+    # A span without pairs still runs one empty range, which gives the result its columns.
+    ranges = list(zip(bounds[:-1], bounds[1:] - 1)) or [(span[0], span[1])]
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        yield from executor.map(fetch, ranges)
+
+
+def _concat(results, arrow: bool):
+    '''
+    Concatenates fetched results in order.
+
+    Args:
+        results (iterable): pandas DataFrames or pyarrow Tables with the same columns.
+        arrow (bool): Whether results are pyarrow Tables.
+
+    Returns:
+        result (pandas.DataFrame or pyarrow.Table): Concatenated rows.
+    '''
+    if arrow:
+        import pyarrow as pa
+        return pa.concat_tables(results)
+
+    return pd.concat(results, ignore_index = True)
+
+
+def _connect(path, form):
+    '''
+    Opens the connection fetches read vp_final through.
+
+    Args:
+        path (str): Path to DuckDB database, Parquet dataset directory or CSV file.
+        form (str): One of ['csv', 'duckdb', 'parquet'].
+
+    Returns:
+        con (duckdb.DuckDBPyConnection): Connection with vp_final available, owned by the caller
+                                         and closed by it once the fetch is done.
+
+    Raises:
+        ValueError: form must be one of ['csv', 'duckdb', 'parquet'].
+    '''
+    # Fetches only read, so jobs share one read-only connection per database and do not
+    # contend for the write lock. Each fetch queries its own cursor of it, as a DuckDB
+    # connection must not be used from several threads at once.
+    if form == 'duckdb':
+        return connect_db(path, read_only=True, shared=True, check_schema=False).cursor()
+
+    if form == 'parquet':
+        return parquet_view(path)
+
+    if form == 'csv':
+        return csv_view(path)
+
+    raise ValueError("Invalid argument passed to form. Expected one of: "
+                     "['csv', 'duckdb', 'parquet']")
+
+
+def _keyset_page(con, after, size: int, output = 'pandas', columns: list = None,
+                 where: dict = None):
+    '''
+    Reads up to size pairs of vp_final with prot_pair_index greater than after, in order.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection with vp_final available.
+        after (int): Last prot_pair_index already read, or None to start from the beginning.
+        size (int): Maximum number of pairs to read.
+        output (str): 'pandas' for a DataFrame or 'arrow' for a single pyarrow RecordBatch.
+        columns (list): Columns to read, or None for every column.
+        where (dict): Row filters, as in fetch_data.
+
+    Returns:
+        page (pandas.DataFrame or pyarrow.RecordBatch): Pairs sorted by prot_pair_index.
+    '''
+    terms = _where_terms(where)
+    filters, params = _where_sql(terms)
+
+    if after is not None:
+        filters.append(f'prot_pair_index > {int(after)}')
+
+    result = con.execute(f"""SELECT {_select_sql(con, columns, terms)}
+                              FROM vp_final
+                              WHERE {' AND '.join(filters)}
+                              ORDER BY prot_pair_index
+                              LIMIT {int(size)}""", params)
+
+    if output == 'arrow':
+
+        import pyarrow as pa
+
+        # DuckDB returns the page as a table of many small chunks, joined into one batch.
+        table = result.arrow()
+
+        return pa.RecordBatch.from_arrays([column.combine_chunks() for column in table.columns],
+                                          schema=table.schema)
+
+    return result.df()
+
+
+def _where_terms(where: dict):
+    '''
+    Checks a where filter and splits it into (column, operator, value) comparisons.
+
+    Args:
+        where (dict): Maps column names to a value or an inclusive (min, max) range whose ends may
+                      be None. None means no filter.
+
+    Returns:
+        terms (list): (column, operator, value) tuples with operator one of '=', '>=', '<='.
+
+    Raises:
+        ValueError: where values must be a value or a (min, max) range.
+    '''
+    terms = []
+
+    for column, value in ({} if where is None else where).items():
+
+        if isinstance(value, (tuple, list)):
+
+            if len(value) != 2:
+                raise ValueError(f'where range for {column} must be (min, max).')
+
+            if value[0] is not None:
+                terms.append((column, '>=', value[0]))
+            if value[1] is not None:
+                terms.append((column, '<=', value[1]))
+
+        elif value is None:
+            raise ValueError(f'where value for {column} must not be None.')
+
+        else:
+            terms.append((column, '=', value))
+
+    # NumPy scalars are turned into Python values, which DuckDB can bind.
+    return [(column, op, value.item() if hasattr(value, 'item') else value)
+            for column, op, value in terms]
+
+
+def _where_sql(terms: list):
+    '''
+    Turns where terms into SQL conditions with bound parameters.
+
+    Args:
+        terms (list): (column, operator, value) tuples from _where_terms.
+
+    Returns:
+        filters (list): SQL conditions, ['True'] if there are none.
+        params (list): Values bound to the conditions, in order.
+    '''
+    filters = [f'"{column}" {op} ?' for column, op, _ in terms]
+
+    return filters or ['True'], [value for _, _, value in terms]
+
+
+def _select_sql(con, columns: list, terms: list, extra: list = None):
+    '''
+    Builds the select list of a vp_final query, checking that columns and where terms exist.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection with vp_final available.
+        columns (list): Columns to read, or None for every column.
+        terms (list): (column, operator, value) tuples from _where_terms.
+        extra (list): Further columns the query reads, such as strata columns.
+
+    Returns:
+        cmd (str): Quoted column list with prot_pair_index first if it was not requested, or *.
+
+    Raises:
+        ValueError: columns and where may only name columns of vp_final.
+    '''
+    if columns is None and not terms and not extra:
+        return '*'
+
+    available = [column[0] for column in con.execute("""SELECT *
+                                                         FROM vp_final
+                                                         LIMIT 0""").description]
+    unknown = [column for column in (columns or []) + [term[0] for term in terms] + (extra or [])
+               if column not in available]
+
+    if unknown:
+        raise ValueError(f'Columns {unknown} are not in vp_final.')
+
+    if columns is None:
+        return '*'
+
+    columns = list(columns) if 'prot_pair_index' in columns else ['prot_pair_index'] + columns
+
+    return ', '.join(f'"{column}"' for column in columns)
+
+
+def _stratified_sample(con, select: str, filters: list, params: list, strata: dict, size: int,
+                       per_stratum: int = None, seed: int = None):
+    '''
+    Draws a stratified sample of vp_final in one SQL query. Rows are numbered in random order
+    within their stratum with a window function and the first quota rows of each are kept, so
+    only the sample leaves DuckDB.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection with vp_final available.
+        select (str): Select list from _select_sql.
+        filters (list): SQL conditions from _where_sql.
+        params (list): Values bound to filters.
+        strata (dict): Strata definitions, as in fetch_data.
+        size (int): Total sample size, used when per_stratum is None.
+        per_stratum (int): Rows drawn from each stratum, or None.
+        seed (int): Seed for the random order, or None.
+
+    Returns:
+        cursor (duckdb.DuckDBPyConnection): Executed query over the sampled rows in
+                                            prot_pair_index order.
+    '''
+    exprs, strata_params = _strata_sql(strata)
+    names = [f'_stratum_{i}' for i in range(len(exprs))]
+    key = 'random()' if seed is None else f'hash(prot_pair_index, {int(seed)})'
+
+    strata_cmd = f"""SELECT {select}, {', '.join(f'{expr} AS {name}'
+                                               for expr, name in zip(exprs, names))},
+                            {key} AS _stratum_key
+                     FROM vp_final
+                     WHERE {' AND '.join(filters)}"""
+    not_null = ' AND '.join(f'{name} IS NOT NULL' for name in names)
+    partition = ', '.join(names)
+
+    if per_stratum is None:
+
+        n_strata = con.execute(f"""SELECT COUNT(*)
+                                   FROM (SELECT DISTINCT {partition}
+                                         FROM ({strata_cmd}) AS strata
+                                         WHERE {not_null}) AS distinct_strata""",
+                               strata_params + params).fetchone()[0]
+        quota = -(-int(size) // max(n_strata, 1))
+        limit = f'LIMIT {int(size)}'
+
+    else:
+        quota, limit = int(per_stratum), ''
+
+    # Trimming by rank takes rows from the fullest strata once smaller ones are exhausted.
+    sample_cmd = f"""SELECT * EXCLUDE ({partition}, _stratum_key, _stratum_rank)
+                     FROM (SELECT *
+                           FROM (SELECT *, row_number() OVER (PARTITION BY {partition}
+                                                              ORDER BY _stratum_key)
+                                               AS _stratum_rank
+                                 FROM ({strata_cmd}) AS strata
+                                 WHERE {not_null}) AS ranked
+                           WHERE _stratum_rank <= {quota}
+                           ORDER BY _stratum_rank, _stratum_key
+                           {limit}) AS sample
+                     ORDER BY prot_pair_index"""
+
+    return con.execute(sample_cmd, strata_params + params)
+
+
+def _strata_sql(strata: dict):
+    '''
+    Turns strata definitions into SQL expressions with one value per stratum.
+
+    Args:
+        strata (dict): Maps columns to None or to ascending bin edges, as in fetch_data.
+
+    Returns:
+        exprs (list): One SQL expression per column. Binned columns give the 0-based bin, or NULL
+                      outside the bins.
+        params (list): Bin edges bound to the expressions, in order.
+
+    Raises:
+        ValueError: Bin edges must be ascending.
+    '''
+    exprs, params = [], []
+
+    for column, edges in strata.items():
+
+        if edges is None:
+            exprs.append(f'"{column}"')
+            continue
+
+        bounds = [edge for edge in edges if edge is not None]
+
+        if len(edges) < 2 or None in edges[1:-1] or bounds != sorted(set(bounds)):
+            raise ValueError(f'Bin edges for {column} must be ascending with at least one bin.')
+
+        cases = [f'WHEN "{column}" IS NULL THEN NULL']
+
+        if edges[0] is not None:
+            cases.append(f'WHEN "{column}" < ? THEN NULL')
+            params.append(edges[0])
+
+        for i, edge in enumerate(edges[1:]):
+
+            if edge is None:
+                cases.append(f'ELSE {i}')
+            else:
+                cases.append(f'WHEN "{column}" < ? THEN {i}')
+                params.append(edge)
+
+        exprs.append(f'CASE {" ".join(cases)} END')
+
+    return exprs, [edge.item() if hasattr(edge, 'item') else edge for edge in params]
+
+
+def _csv_chunks(path, columns: list, terms: list, chunksize: int, rows: tuple = None,
+                offsets = None, **kwargs):
+    '''
+    Reads a CSV file in chunks, parsing only the requested and filtered columns and keeping only
+    rows that pass the where terms.
+
+    Args:
+        path (str): Path to the CSV file.
+        columns (list): Columns to return, or None for every column. prot_pair_index is included
+                        if the file has it.
+        terms (list): (column, operator, value) tuples from _where_terms.
+        chunksize (int): Rows parsed per chunk.
+        rows (tuple): Inclusive first and last 0-based data row to read, or None for every row.
+                      The file is opened at the first row's byte offset and read no further than
+                      the last row.
+        offsets (numpy.ndarray): Row offsets from csv_index, or None to find the first row's
+                                 offset by scanning the file.
+        **kwargs: Passed on to pandas.read_csv.
+
+    Returns:
+        chunks (generator): Yields filtered pandas.DataFrame chunks.
+
+    Raises:
+        ValueError: columns and where may only name columns of the file.
+    '''
+    header, columns, usecols = _csv_columns(path, columns, terms)
+
+    with open(path, 'rb') as file:
+
+        # Rows after the header are parsed with the header's names, from the first row's offset.
+        if rows is not None:
+
+            if offsets is None:
+                file.seek(_csv_offset(file, rows[0]))
+            else:
+                file.seek(offsets[min(rows[0], len(offsets) - 1)])
+
+            kwargs = {**kwargs, 'header': None, 'names': header, 'nrows': rows[1] - rows[0] + 1}
+
+        reader = pd.read_csv(file, usecols=usecols, chunksize=chunksize, **kwargs)
+
+        for df in reader:
+
+            if rows is not None:
+                df.index += rows[0]
+
+            yield _csv_filter(df, columns, terms)
+
+
+def _csv_columns(path, columns: list, terms: list):
+    '''
+    Reads the header of a CSV file and works out which columns to parse.
+
+    Args:
+        path (str): Path to the CSV file.
+        columns (list): Columns to return, or None for every column.
+        terms (list): (column, operator, value) tuples from _where_terms.
+
+    Returns:
+        header (list): Column names of the file.
+        columns (list): Columns to return with prot_pair_index first if the file has it, or None.
+        usecols (set): Columns to parse, or None for every column.
+
+    Raises:
+        ValueError: columns and where may only name columns of the file.
+    '''
+    filter_columns = [column for column, _, _ in terms]
+    header = list(pd.read_csv(path, nrows=0).columns)
+
+    unknown = [column for column in (columns or []) + filter_columns if column not in header]
+    if unknown:
+        raise ValueError(f'Columns {unknown} are not in {path}.')
+
+    if columns is not None and 'prot_pair_index' not in columns and 'prot_pair_index' in header:
+        columns = ['prot_pair_index'] + list(columns)
+
+    usecols = None if columns is None else set(columns + filter_columns)
+
+    return header, columns, usecols
+
+
+def _csv_filter(df, columns: list, terms: list):
+    '''
+    Keeps the rows of a parsed CSV chunk that pass the where terms.
+
+    Args:
+        df (pandas.DataFrame): Parsed rows.
+        columns (list): Columns to return, or None for every column.
+        terms (list): (column, operator, value) tuples from _where_terms.
+
+    Returns:
+        df (pandas.DataFrame): Filtered rows.
+    '''
+    operators = {'=': operator.eq, '>=': operator.ge, '<=': operator.le}
+
+    for column, op, value in terms:
+        df = df[operators[op](df[column], value)]
+
+    return df if columns is None else df[columns]
+
+
+def _csv_rows(path, positions, offsets, columns: list, terms: list):
+    '''
+    Reads arbitrary data rows of a CSV file through its row offset index. Neighbouring rows are
+    read with one seek and all rows are parsed in a single pass.
+
+    Args:
+        path (str): Path to the CSV file.
+        positions (numpy.ndarray): 0-based data row positions, which must exist in the file.
+        offsets (numpy.ndarray): Row offsets from csv_index.
+        columns (list): Columns to return, or None for every column.
+        terms (list): (column, operator, value) tuples from _where_terms.
+
+    Returns:
+        df (pandas.DataFrame): Rows that pass the where terms, in the order of positions and
+                               indexed by position.
+    '''
+    header, columns, usecols = _csv_columns(path, columns, terms)
+    unique = np.unique(positions)
+
+    if not unique.size:
+        return _csv_filter(pd.read_csv(path, nrows=0, usecols=usecols), columns, terms)
+
+    starts, ends = offsets[unique], offsets[unique + 1]
+    new_run = np.ones(len(unique), dtype = bool)
+    new_run[1:] = starts[1:] != ends[:-1]
+    run_ends = ends[np.append(new_run[1:], True)]
+
+    blocks = []
+    with open(path, 'rb') as file:
+        for start, end in zip(starts[new_run], run_ends):
+            file.seek(start)
+            blocks.append(file.read(end - start))
+
+    df = pd.read_csv(io.BytesIO(b''.join(blocks)), header=None, names=header, usecols=usecols)
+    df.index = unique
+    df = _csv_filter(df, columns, terms)
+
+    return df.loc[positions[np.isin(positions, df.index)]]
+
+
+def _csv_scan(path, block_size: int = 2 ** 24):
+    '''
+    Finds the byte offset of every data row of a CSV file by locating line breaks in large
+    blocks, without parsing any fields. Fields holding quoted line breaks are not supported.
+
+    Args:
+        path (str): Path to the CSV file.
+        block_size (int): Bytes read at a time.
+
+    Returns:
+        offsets (numpy.ndarray): int64 offset of each data row followed by the file size, so row
+                                 i spans offsets[i] to offsets[i + 1].
+    '''
+    starts = []
+
+    with open(path, 'rb') as file:
+
+        file.readline()
+        position = file.tell()
+        starts.append(np.array([position]))
+
+        while True:
+
+            block = file.read(block_size)
+
+            if not block:
+                break
+
+            breaks = np.flatnonzero(np.frombuffer(block, dtype = np.uint8) == ord('\n'))
+            starts.append(breaks + position + 1)
+            position += len(block)
+
+    offsets = np.concatenate(starts).astype(np.int64)
+
+    # The last row may not end with a line break.
+    if offsets[-1] != position:
+        offsets = np.append(offsets, position)
+
+    return offsets
+
+
+def _csv_offset(file, row: int, block_size: int = 2 ** 20):
+    '''
+    Finds the byte offset where a data row of a CSV file starts by counting line breaks in large
+    blocks, without parsing any fields. Fields holding quoted line breaks are not supported.
+
+    Args:
+        file (io.BufferedReader): CSV file opened in binary mode.
+        row (int): 0-based data row, not counting the header.
+        block_size (int): Bytes read at a time.
+
+    Returns:
+        offset (int): Byte offset of the row, or the end of the file if it has fewer rows.
+    '''
+    file.seek(0)
+    file.readline()
+    offset = file.tell()
+    remaining = row
+
+    while remaining > 0:
+
+        block = file.read(block_size)
+
+        if not block:
+            break
+
+        breaks = block.count(b'\n')
+
+        if breaks < remaining:
+            remaining -= breaks
+            offset += len(block)
+            continue
+
+        # The row starts after the remaining-th line break in this block.
+        position = -1
+        for _ in range(remaining):
+            position = block.index(b'\n', position + 1)
+
+        return offset + position + 1
+
+    return offset
+
+
+def _csv_reservoir(chunks, size: int, seed: int = None):
+    '''
+    Draws a uniform random sample of size rows from a stream of DataFrame chunks in one pass.
+    Every row gets a random key and the reservoir keeps the size rows with the smallest keys seen
+    so far, so at most one chunk and the reservoir are held at once.
+
+    Args:
+        chunks (iterable): pandas.DataFrame chunks with the same columns.
+        size (int): Number of rows to sample. Every row is returned if there are fewer.
+        seed (int): Seed for the random keys, or None for a fresh sample.
+
+    Returns:
+        sample (pandas.DataFrame): Sampled rows in random order with their original index.
+    '''
+    rng = np.random.default_rng(seed)
+    reservoir = None
+    keys = np.empty(0)
+
+    for chunk in chunks:
+
+        chunk_keys = rng.random(len(chunk))
+
+        if reservoir is None:
+            reservoir = chunk.iloc[:0]
+
+        # Only rows that can still enter the reservoir are copied.
+        if size and len(keys) >= size:
+            keep = chunk_keys < keys.max()
+            chunk, chunk_keys = chunk[keep], chunk_keys[keep]
+
+        reservoir = pd.concat([reservoir, chunk])
+        keys = np.concatenate([keys, chunk_keys])
+
+        if len(keys) > size:
+            smallest = np.argpartition(keys, size)[:size]
+            reservoir, keys = reservoir.iloc[smallest], keys[smallest]
+
+    if reservoir is None:
+        return pd.DataFrame()
+
+    return reservoir.iloc[np.argsort(keys)]
+
+
+def _csv_batches(path, batch_size: int, limit: int, columns: list, where: dict):
+    '''
+    Regroups filtered CSV chunks into batches of exactly batch_size rows, apart from the last.
+    Holds at most one chunk and one batch at a time.
+
+    Args:
+        path (str): Path to the CSV file.
+        batch_size (int): Rows per batch.
+        limit (int): Stop after this many rows, or None.
+        columns (list): Columns to return, or None for every column.
+        where (dict): Row filters, as in fetch_data.
+
+    Returns:
+        batches (generator): Yields pandas.DataFrame batches.
+    '''
+    terms = _where_terms(where)
+
+    # Without filters every chunk but the last is already full.
+    if not terms:
+        yield from _csv_chunks(path, columns, terms, batch_size, nrows=limit)
+        return
+
+    pending = []
+    n_pending = 0
+    remaining = limit
+
+    for chunk in _csv_chunks(path, columns, terms, batch_size):
+
+        pending.append(chunk)
+        n_pending += len(chunk)
+
+        while n_pending >= batch_size and (remaining is None or remaining > 0):
+
+            rows = pd.concat(pending)
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            yield rows.iloc[:size]
+
+            pending = [rows.iloc[size:]]
+            n_pending = len(pending[0])
+            remaining = None if remaining is None else remaining - size
+
+        if remaining is not None and remaining <= 0:
+            return
+
+    if n_pending and (remaining is None or remaining > 0):
+        rows = pd.concat(pending)
+        yield rows if remaining is None else rows.iloc[:remaining]
+
+
+def _span_filter(span):
+    '''
+    Turns a (min, max) prot_pair_index span from a lookup table into a range filter. A missing
+    span means there are no matching pairs.
+
+    Args:
+        span (tuple): Min and max prot_pair_index, or None or (None, None) if nothing matched.
+
+    Returns:
+        cmd (str): SQL filter on prot_pair_index.
+    '''
+    if span is None or span[0] is None:
+        return 'False'
+
+    return f'prot_pair_index BETWEEN {int(span[0])} AND {int(span[1])}'
+
+
+def parquet_view(path):
+    '''
+    Opens an in-memory DuckDB connection with a vp_final view over a Parquet dataset written by
+    c0.export_parquet. Hive partition columns are exposed so filters on them prune whole files,
+    and only the columns a query touches are read.
+
+    Args:
+        path (str): Path to a Parquet dataset directory or a single Parquet file.
+
+    Returns:
+        con (duckdb.DuckDBPyConnection): Connection with a vp_final view over the dataset.
+
+    Raises:
+        ValueError: No Parquet files found at path.
+    '''
+    if os.path.isdir(path):
+        pattern = os.path.join(path, '*', '*.parquet')
+    else:
+        pattern = path
+
+    if not glob.glob(pattern):
+        raise ValueError(f'Could not find Parquet files at {path}')
+
+    con = duckdb.connect()
+    con.execute(f"""CREATE VIEW vp_final AS
+                    SELECT *
+                    FROM read_parquet('{pattern}', hive_partitioning=1)""")
+
+    return con
+
+
+def csv_view(path):
+    '''
+    Opens an in-memory DuckDB connection with a vp_final view over a CSV export of vp_final.
+    DuckDB's CSV scanner parses the file in C++ and streams it through each query, so filters,
+    projections and samples over the view hold only their results in memory. Compressed files
+    such as .csv.gz are decompressed on the fly.
+
+    Args:
+        path (str): Path to a CSV file with a header row.
+
+    Returns:
+        con (duckdb.DuckDBPyConnection): Connection with a vp_final view over the file.
+
+    Raises:
+        ValueError: No CSV file found at path.
+    '''
+    if not os.path.isfile(path):
+        raise ValueError(f'Could not find a CSV file at {path}')
+
+    con = duckdb.connect()
+    con.execute(f"""CREATE VIEW vp_final AS
+                    SELECT *
+                    FROM read_csv_auto('{path.replace("'", "''")}', header=True)""")
 
-    return validprot_df
+    return con
@@ -6,10 +6,71 @@ import unittest
 import duckdb
 
 import os
+import subprocess
 import sys
+import tempfile
+import threading
 
 import c1
 
+# Resolved from this file so the tests run from any working directory.
+module_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'c0_preprocessing'))
+if module_path not in sys.path:
+    sys.path.append(module_path)
+import c0
+from c0_tests import make_l2t_db
+
+# ValidProt database shared by the test classes built on VPTestCase, with its vp_final as a
+# DataFrame and exported to CSV, gzipped CSV and Parquet. Built once in setUpModule.
+SHARED = {}
+
+
+def setUpModule():
+    '''
+    Builds the shared ValidProt database and its exports.
+    '''
+    tmpdir = tempfile.TemporaryDirectory()
+    db_path = os.path.join(tmpdir.name, 'validprot')
+    make_l2t_db(db_path)
+    c0.build_validprot(c0.connect_db(db_path))
+
+    con = duckdb.connect(db_path, read_only = True)
+    vp_final = con.execute("""SELECT * FROM vp_final ORDER BY prot_pair_index""").df()
+    con.execute(f"""COPY vp_final TO '{db_path}.parquet' (FORMAT PARQUET)""")
+    con.close()
+    vp_final.to_csv(f'{db_path}.csv', index = False)
+    vp_final.to_csv(f'{db_path}.csv.gz', index = False)
+
+    SHARED.update({'tmpdir': tmpdir, 'db_path': db_path, 'csv_path': f'{db_path}.csv',
+                   'parquet_path': f'{db_path}.parquet', 'vp_final': vp_final})
+
+
+def tearDownModule():
+    '''
+    Closes shared connections and removes the shared database.
+    '''
+    c0.close_shared()
+    SHARED.pop('tmpdir').cleanup()
+
+
+class VPTestCase(unittest.TestCase):
+    '''
+    Base class for tests that read the shared ValidProt database and its exports. Each class gets
+    its own copy of vp_final and closes the shared connections it opened.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = SHARED['tmpdir']
+        cls.db_path = SHARED['db_path']
+        cls.csv_path = SHARED['csv_path']
+        cls.parquet_path = SHARED['parquet_path']
+        cls.vp_final = SHARED['vp_final'].copy()
+
+    @classmethod
+    def tearDownClass(cls):
+        c0.close_shared()
+
 def get_db_path(filename = 'validprot_testing'):
     '''
     Gets path to unit test dataset for testing functions.
@@ -68,6 +129,80 @@ class TestFetch(unittest.TestCase):
         '''
         assert False
         
+    def test_parquet(self):
+        '''
+        Random sampling from a hive-partitioned Parquet dataset.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'ogt_bucket=20'))
+            con = duckdb.connect()
+            con.execute(f"""COPY (SELECT range AS prot_pair_index, 22.5 AS ogt_difference
+                                  FROM range(50))
+                            TO '{os.path.join(tmpdir, 'ogt_bucket=20', 'data_0.parquet')}'
+                            (FORMAT PARQUET)""")
+
+            df = c1.fetch_data(tmpdir, form = 'parquet', size = 10)
+
+        self.assertEqual(df.shape[0], 10)
+        assert 'ogt_bucket' in df.columns
+
+    def test_duckdb_shared(self):
+        '''
+        DuckDB fetches reuse one shared read-only connection per database.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, 'validprot')
+            con = duckdb.connect(db_path)
+            con.execute("""CREATE TABLE vp_final AS
+                            SELECT range AS prot_pair_index, 22.5 AS ogt_difference
+                            FROM range(50)""")
+            con.close()
+
+            first = c1.fetch_data(db_path, size = 10)
+            second = c1.fetch_data(db_path, size = 20)
+            shared = c1.connect_db(db_path, read_only = True, shared = True)
+            self.assertIs(shared, c1.connect_db(db_path, read_only = True, shared = True))
+            c0.close_shared(db_path)
+
+        self.assertEqual(first.shape[0], 10)
+        self.assertEqual(second.shape[0], 20)
+
+    def test_duckdb_threads(self):
+        '''
+        Threads fetch from one database concurrently, and close_shared frees it for writing.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, 'validprot')
+            con = duckdb.connect(db_path)
+            con.execute("""CREATE TABLE vp_final AS
+                            SELECT range AS prot_pair_index, 22.5 AS ogt_difference
+                            FROM range(100000)""")
+            con.close()
+
+            results = {}
+            errors = []
+
+            def fetch(i):
+                try:
+                    for _ in range(5):
+                        results[i] = c1.fetch_data(db_path, size = 1000, method = 'chunk',
+                                                   chunksize = 100)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target = fetch, args = (i,)) for i in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            c1.close_shared(db_path)
+            con = duckdb.connect(db_path)
+            con.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual([len(results[i]) for i in range(6)], [1000] * 6)
+
     def test_idx_out_of_range(self):
         '''
         Test for unusable index range.
@@ -79,3 +214,749 @@ class TestFetch(unittest.TestCase):
         
     
 
+
+
+class TestImport(unittest.TestCase):
+    '''
+    Import side effects of c1.
+    '''
+
+    def test_deferred_imports(self):
+        '''
+        c1 imports in a fresh interpreter without loading c0, plotly or kaleido.
+        '''
+        cmd = ('import sys, c1; '
+               'print(*[name in sys.modules for name in ["c0", "plotly", "kaleido"]])')
+        out = subprocess.run([sys.executable, '-c', cmd], capture_output = True, text = True,
+                             check = True).stdout.split()
+
+        self.assertEqual(out, ['False', 'False', 'False'])
+
+
+class TestLookup(VPTestCase):
+    '''
+    Tests for keyset pages and pair lookups on a database built by component 0.
+    '''
+
+    def test_sorted(self):
+        '''
+        vp_final is stored in prot_pair_index order.
+        '''
+        con = c1.connect_db(self.db_path, read_only = True, shared = True)
+        stored = con.execute("""SELECT prot_pair_index FROM vp_final""").df()
+
+        self.assertTrue(stored['prot_pair_index'].is_monotonic_increasing)
+
+    def test_pages(self):
+        '''
+        Following pages by their last key reads every pair once, in order.
+        '''
+        pages = [c1.fetch_page(self.db_path, size = 5)]
+        while len(pages[-1]) == 5:
+            pages.append(c1.fetch_page(self.db_path, pages[-1]['prot_pair_index'].iloc[-1], 5))
+
+        pd.testing.assert_frame_equal(pd.concat(pages, ignore_index = True), self.vp_final)
+
+    def test_fetch_methods(self):
+        '''
+        Chunk and numeric fetches read the expected pairs.
+        '''
+        chunked = c1.fetch_data(self.db_path, size = 11, method = 'chunk', chunksize = 4)
+        pd.testing.assert_frame_equal(chunked, self.vp_final.head(11))
+
+        low, high = self.vp_final['prot_pair_index'].iloc[[2, 9]]
+        numeric = c1.fetch_data(self.db_path, method = 'numeric', idx_range = [low, high])
+        pd.testing.assert_frame_equal(numeric, self.vp_final.iloc[2:10].reset_index(drop = True))
+
+        # The default range reads size pairs from every backend.
+        for kwargs in [{}, {'workers': 2}, {'form': 'parquet'}, {'form': 'csv'}]:
+            path = self.parquet_path if kwargs.get('form') == 'parquet' else \
+                self.csv_path if kwargs.get('form') == 'csv' else self.db_path
+            numeric = c1.fetch_data(path, method = 'numeric', size = 5, **kwargs)
+            self.assertEqual(len(numeric), 5)
+            pd.testing.assert_frame_equal(numeric.reset_index(drop = True), self.vp_final.head(5))
+
+    def test_lookup(self):
+        '''
+        Protein and taxa pair lookups match direct filters on vp_final.
+        '''
+        protein = self.vp_final['thermo_protein_int_index'].iloc[0]
+        expected = self.vp_final[(self.vp_final['meso_protein_int_index'] == protein) |
+                                 (self.vp_final['thermo_protein_int_index'] == protein)]
+        pd.testing.assert_frame_equal(c1.lookup_pairs(self.db_path, protein = protein),
+                                      expected.reset_index(drop = True))
+
+        taxa_pair = self.vp_final['taxa_pair_index'].iloc[-1]
+        expected = self.vp_final[self.vp_final['taxa_pair_index'] == taxa_pair]
+        pd.testing.assert_frame_equal(c1.lookup_pairs(self.db_path, taxa_pair = taxa_pair),
+                                      expected.reset_index(drop = True))
+
+        self.assertEqual(len(c1.lookup_pairs(self.db_path, protein = -1)), 0)
+
+        with self.assertRaises(ValueError):
+            c1.lookup_pairs(self.db_path)
+
+
+class TestBatches(VPTestCase):
+    '''
+    Tests for the iter_batches streaming reader.
+    '''
+
+    def test_duckdb(self):
+        '''
+        DuckDB batches have the requested size and together hold vp_final in order.
+        '''
+        batches = list(c1.iter_batches(self.db_path, batch_size = 5))
+
+        self.assertEqual([len(batch) for batch in batches], [5, 5, 5, 1])
+        pd.testing.assert_frame_equal(pd.concat(batches, ignore_index = True), self.vp_final)
+
+    def test_arrow(self):
+        '''
+        Arrow output yields RecordBatches with the same rows.
+        '''
+        import pyarrow as pa
+
+        for form, path in [('duckdb', self.db_path), ('csv', self.csv_path)]:
+
+            batches = list(c1.iter_batches(path, form = form, batch_size = 6, output = 'arrow'))
+
+            self.assertTrue(all(isinstance(batch, pa.RecordBatch) for batch in batches), form)
+            self.assertEqual([batch.num_rows for batch in batches], [6, 6, 4], form)
+            keys = pa.Table.from_batches(batches).column('prot_pair_index').to_pylist()
+            self.assertEqual(keys, self.vp_final['prot_pair_index'].tolist(), form)
+
+    def test_csv(self):
+        '''
+        CSV batches are read in file order.
+        '''
+        batches = list(c1.iter_batches(self.csv_path, form = 'csv', batch_size = 5))
+
+        self.assertEqual([len(batch) for batch in batches], [5, 5, 5, 1])
+        self.assertEqual(pd.concat(batches)['prot_pair_index'].tolist(),
+                         self.vp_final['prot_pair_index'].tolist())
+
+    def test_limit(self):
+        '''
+        Streams stop after limit pairs.
+        '''
+        for form, path in [('duckdb', self.db_path), ('csv', self.csv_path)]:
+            batches = list(c1.iter_batches(path, form = form, batch_size = 5, limit = 7))
+            self.assertEqual([len(batch) for batch in batches], [5, 2], form)
+
+        self.assertEqual(list(c1.iter_batches(self.db_path, limit = 0)), [])
+
+    def test_invalid(self):
+        '''
+        Invalid arguments raise before the first batch is requested.
+        '''
+        with self.assertRaises(ValueError):
+            c1.iter_batches(self.db_path, form = 'excel')
+
+        with self.assertRaises(ValueError):
+            c1.iter_batches(self.db_path, output = 'polars')
+
+        with self.assertRaises(ValueError):
+            c1.iter_batches(self.db_path, batch_size = 0)
+
+
+class TestPushdown(VPTestCase):
+    '''
+    Tests for column projection and row filters in fetch_data, fetch_page and iter_batches.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.columns = ['bit_score', 'ogt_difference']
+        cls.where = {'ogt_difference': (30, None), 'bit_score': (None, 210),
+                     'meso_index': 0}
+        cls.expected = cls.vp_final[(cls.vp_final['ogt_difference'] >= 30) &
+                                    (cls.vp_final['bit_score'] <= 210) &
+                                    (cls.vp_final['meso_index'] == 0)]
+
+    def check(self, df, keys = None):
+        self.assertEqual(list(df.columns), ['prot_pair_index'] + self.columns)
+        keys = self.expected['prot_pair_index'].tolist() if keys is None else keys
+        self.assertEqual(sorted(df['prot_pair_index'].tolist()), keys)
+
+    def test_fetch_methods(self):
+        '''
+        Every fetch method returns only the requested columns of the matching rows.
+        '''
+        assert 0 < len(self.expected) < len(self.vp_final)
+
+        for form, path in [('duckdb', self.db_path), ('csv', self.csv_path)]:
+
+            for method in ['random', 'chunk']:
+                df = c1.fetch_data(path, form = form, method = method, columns = self.columns,
+                                   where = self.where, size = len(self.expected),
+                                   chunksize = 3)
+                self.check(df)
+
+        numeric = c1.fetch_data(self.db_path, method = 'numeric', idx_range = [0, 2],
+                                columns = self.columns, where = self.where)
+        self.check(numeric, [key for key in self.expected['prot_pair_index'] if key <= 2])
+
+    def test_streams(self):
+        '''
+        Pages and batches apply the same projection and filters.
+        '''
+        page = c1.fetch_page(self.db_path, size = 100, columns = self.columns,
+                             where = self.where)
+        self.check(page)
+
+        for form, path in [('duckdb', self.db_path), ('csv', self.csv_path)]:
+
+            batches = list(c1.iter_batches(path, form = form, batch_size = 1,
+                                           columns = self.columns, where = self.where))
+            self.assertTrue(all(len(batch) == 1 for batch in batches), form)
+            self.check(pd.concat(batches))
+
+    def test_no_projection(self):
+        '''
+        Filters alone keep every column.
+        '''
+        df = c1.fetch_data(self.db_path, method = 'chunk', where = {'meso_index': 0})
+
+        self.assertEqual(list(df.columns), list(self.vp_final.columns))
+        self.assertTrue((df['meso_index'] == 0).all())
+
+    def test_invalid(self):
+        '''
+        Test for unknown columns and malformed filters.
+        '''
+        for form, path in [('duckdb', self.db_path), ('csv', self.csv_path)]:
+
+            with self.assertRaises(ValueError):
+                c1.fetch_data(path, form = form, columns = ['not_a_column'])
+
+            with self.assertRaises(ValueError):
+                c1.fetch_data(path, form = form, where = {'not_a_column': 1})
+
+        with self.assertRaises(ValueError):
+            c1.fetch_data(self.db_path, where = {'bit_score': (1, 2, 3)})
+
+        with self.assertRaises(ValueError):
+            c1.iter_batches(self.db_path, where = {'bit_score': None})
+
+
+class TestCsvSampling(unittest.TestCase):
+    '''
+    Tests for streaming random and row range reads of CSV inputs.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmpdir.name, 'validprot.csv')
+        self.df = pd.DataFrame({'prot_pair_index': range(1000),
+                                'bit_score': np.arange(1000) % 7 * 10.0,
+                                'm_protein_desc': ['kinase, putative'] * 1000})
+        self.df.to_csv(self.csv_path, index = False)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reservoir(self):
+        '''
+        Seeded samples are repeatable, independent of chunk size and without repeats.
+        '''
+        first = c1.fetch_data(self.csv_path, form = 'csv', size = 100, seed = 3, chunksize = 64,
+                              row_index = False)
+        second = c1.fetch_data(self.csv_path, form = 'csv', size = 100, seed = 3,
+                               row_index = False)
+        other = c1.fetch_data(self.csv_path, form = 'csv', size = 100, seed = 4,
+                              row_index = False)
+
+        pd.testing.assert_frame_equal(first, second)
+        self.assertNotEqual(set(first.index), set(other.index))
+        self.assertEqual(first['prot_pair_index'].nunique(), 100)
+        pd.testing.assert_frame_equal(first, self.df.loc[first.index])
+
+        everything = c1.fetch_data(self.csv_path, form = 'csv', size = 5000, chunksize = 64,
+                                   row_index = False)
+        self.assertEqual(sorted(everything['prot_pair_index']), list(range(1000)))
+        self.assertFalse(os.path.exists(self.csv_path + c1.CSV_INDEX_SUFFIX))
+
+    def test_reservoir_filtered(self):
+        '''
+        Filters are applied before rows enter the reservoir.
+        '''
+        sample = c1.fetch_data(self.csv_path, form = 'csv', size = 50, seed = 0, chunksize = 64,
+                               where = {'bit_score': 0.0}, columns = ['bit_score'])
+
+        self.assertEqual(len(sample), 50)
+        self.assertTrue((sample['bit_score'] == 0).all())
+        self.assertEqual(list(sample.columns), ['prot_pair_index', 'bit_score'])
+
+        # Neither filtered samples nor chunk reads use the row offset index.
+        c1.fetch_data(self.csv_path, form = 'csv', method = 'chunk', chunksize = 64)
+        self.assertFalse(os.path.exists(self.csv_path + c1.CSV_INDEX_SUFFIX))
+
+    def test_row_range(self):
+        '''
+        Row ranges start at the first row's offset and stop reading after the last row, and the
+        default range reads size rows.
+        '''
+        # A malformed line after the range would fail to parse if it were read.
+        with open(self.csv_path, 'a') as file:
+            file.write('1,2,3,4,5\n')
+
+        df = c1.fetch_data(self.csv_path, form = 'csv', method = 'numeric',
+                           idx_range = [990, 999], chunksize = 3)
+        pd.testing.assert_frame_equal(df, self.df.iloc[990:1000])
+
+        for row_index in [True, False]:
+            df = c1.fetch_data(self.csv_path, form = 'csv', method = 'numeric', size = 10,
+                               row_index = row_index)
+            self.assertEqual(len(df), 10)
+            pd.testing.assert_frame_equal(df, self.df.iloc[:10])
+
+        with open(self.csv_path, 'rb') as file:
+            for row in [0, 1, 517]:
+                file.seek(c1._csv_offset(file, row, block_size = 7))
+                self.assertEqual(file.readline().split(b',')[0], str(row).encode())
+
+
+class TestCsvIndex(unittest.TestCase):
+    '''
+    Tests for the sidecar row offset index of CSV inputs.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmpdir.name, 'validprot.csv')
+        self.df = pd.DataFrame({'prot_pair_index': range(1000),
+                                'bit_score': np.arange(1000) % 7 * 10.0,
+                                'm_protein_desc': ['kinase, putative'] * 1000})
+        self.df.to_csv(self.csv_path, index = False)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_index(self):
+        '''
+        The index is written once, reused memory-mapped and rebuilt when the CSV changes.
+        '''
+        offsets = c1.csv_index(self.csv_path, block_size = 100)
+        index_path = self.csv_path + c1.CSV_INDEX_SUFFIX
+
+        self.assertEqual(len(offsets), 1001)
+        self.assertEqual(offsets[-1], os.path.getsize(self.csv_path))
+        with open(self.csv_path, 'rb') as file:
+            for row in [0, 1, 517, 999]:
+                file.seek(offsets[row])
+                self.assertEqual(file.readline().split(b',')[0], str(row).encode())
+
+        reused = c1.csv_index(self.csv_path)
+        self.assertIsInstance(reused, np.memmap)
+        np.testing.assert_array_equal(reused, offsets)
+
+        # A final row without a line break still gets an end offset.
+        with open(self.csv_path, 'a') as file:
+            file.write('1000,0.0,ligase')
+        offsets = c1.csv_index(self.csv_path)
+        self.assertEqual(len(offsets), 1002)
+        self.assertEqual(offsets[-1], os.path.getsize(self.csv_path))
+        assert os.path.exists(index_path)
+
+    def test_rows(self):
+        '''
+        Arbitrary rows are returned in the requested order, filtered and indexed by position.
+        '''
+        df = c1.fetch_data(self.csv_path, form = 'csv', rows = [999, 3, 500, 3, 4])
+        pd.testing.assert_frame_equal(df, self.df.loc[[999, 3, 500, 3, 4]])
+
+        df = c1.fetch_data(self.csv_path, form = 'csv', rows = [999, 3, 500, 6],
+                           columns = ['bit_score'], where = {'bit_score': (50, None)})
+        pd.testing.assert_frame_equal(df, self.df.loc[[999, 6], ['prot_pair_index', 'bit_score']])
+
+        self.assertEqual(len(c1.fetch_data(self.csv_path, form = 'csv', rows = [])), 0)
+
+        with self.assertRaises(ValueError):
+            c1.fetch_data(self.csv_path, form = 'csv', rows = [1000])
+        with self.assertRaises(ValueError):
+            c1.fetch_data(self.csv_path, form = 'duckdb', rows = [0])
+
+    def test_random(self):
+        '''
+        Unfiltered random samples draw positions from the index and match the file's rows.
+        '''
+        first = c1.fetch_data(self.csv_path, form = 'csv', size = 100, seed = 3)
+        second = c1.fetch_data(self.csv_path, form = 'csv', size = 100, seed = 3)
+
+        pd.testing.assert_frame_equal(first, second)
+        self.assertEqual(first.index.nunique(), 100)
+        pd.testing.assert_frame_equal(first, self.df.loc[first.index])
+
+        df = c1.fetch_data(self.csv_path, form = 'csv', method = 'numeric', idx_range = [10, 19])
+        pd.testing.assert_frame_equal(df, self.df.iloc[10:20])
+
+
+class TestStratified(VPTestCase):
+    '''
+    Tests for stratified sampling in fetch_data.
+    '''
+
+    def sample(self, **kwargs):
+        return c1.fetch_data(self.db_path, method = 'stratified', **kwargs)
+
+    def test_balanced(self):
+        '''
+        size is split evenly over the strata and seeded samples are repeatable.
+        '''
+        first = self.sample(size = 8, strata = {'taxa_pair_index': None}, seed = 1)
+        second = self.sample(size = 8, strata = {'taxa_pair_index': None}, seed = 1)
+
+        pd.testing.assert_frame_equal(first, second)
+        self.assertEqual(first['taxa_pair_index'].value_counts().tolist(), [2, 2, 2, 2])
+        pd.testing.assert_frame_equal(
+            first, self.vp_final.set_index('prot_pair_index', drop = False)
+                                .loc[first['prot_pair_index']].reset_index(drop = True))
+
+        # Smaller strata give every row and the rest is trimmed to size.
+        uneven = self.sample(size = 10, strata = {'ogt_difference': [None, 30, None]})
+        self.assertEqual(len(uneven), 9)
+        self.assertEqual((uneven['ogt_difference'] < 30).sum(), 4)
+
+    def test_per_stratum(self):
+        '''
+        per_stratum caps every combination of strata, leaving out rows outside the bins.
+        '''
+        df = self.sample(per_stratum = 3, columns = ['bit_score'],
+                         strata = {'taxa_pair_index': None, 'm_protein_len': [16, 20]},
+                         where = {'bit_score': (None, 220)})
+
+        self.assertEqual(list(df.columns), ['prot_pair_index', 'bit_score'])
+        expected = self.vp_final[(self.vp_final['m_protein_len'].between(16, 19)) &
+                                 (self.vp_final['bit_score'] <= 220)]
+        self.assertEqual(set(df['prot_pair_index']), set(expected['prot_pair_index']))
+
+    def test_invalid(self):
+        '''
+        Test for missing strata, CSV inputs and bad bin edges.
+        '''
+        with self.assertRaises(ValueError):
+            self.sample()
+
+        with self.assertRaises(ValueError):
+            c1.fetch_data(self.db_path, form = 'csv', method = 'stratified',
+                          strata = {'taxa_pair_index': None})
+
+        with self.assertRaises(ValueError):
+            self.sample(strata = {'ogt_difference': [40, 30]})
+
+        with self.assertRaises(ValueError):
+            self.sample(strata = {'not_a_column': None})
+
+
+class TestCache(VPTestCase):
+    '''
+    Tests for the on-disk fetch_data cache.
+    '''
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp(dir = self.tmpdir.name)
+
+    def fetch(self, **kwargs):
+        before = dict(c1._CACHE_COUNTS)
+        df = c1.fetch_data(self.db_path, cache = self.cache, **kwargs)
+        counts = {key: c1._CACHE_COUNTS[key] - before[key] for key in before}
+        return df, counts
+
+    def test_hit(self):
+        '''
+        A repeated fetch is read back from the cache in either format.
+        '''
+        for cache_format in ['parquet', 'arrow']:
+
+            kwargs = {'method': 'numeric', 'idx_range': [2, 13], 'columns': ['bit_score'],
+                      'cache_format': cache_format}
+            first, counts = self.fetch(**kwargs)
+            self.assertEqual(counts['misses'], 1)
+
+            second, counts = self.fetch(**kwargs)
+            self.assertEqual(counts['hits'], 1)
+            pd.testing.assert_frame_equal(first, second)
+
+        # Different arguments and unseeded samples miss.
+        _, counts = self.fetch(method = 'numeric', idx_range = [2, 14], columns = ['bit_score'])
+        self.assertEqual(counts['misses'], 1)
+
+        self.fetch(size = 5)
+        _, counts = self.fetch(size = 5)
+        self.assertEqual(counts, {'hits': 0, 'misses': 0, 'evictions': 0})
+
+        info = c1.cache_info(self.cache)
+        self.assertEqual(info['entries'], 3)
+
+    def test_source_changed(self):
+        '''
+        Changing the source file invalidates its entries.
+        '''
+        csv_path = os.path.join(self.cache, 'validprot.csv')
+        pd.DataFrame({'prot_pair_index': range(10)}).to_csv(csv_path, index = False)
+
+        first = c1.fetch_data(csv_path, form = 'csv', size = 4, seed = 0, cache = self.cache)
+
+        pd.DataFrame({'prot_pair_index': range(100, 120)}).to_csv(csv_path, index = False)
+        second = c1.fetch_data(csv_path, form = 'csv', size = 4, seed = 0, cache = self.cache)
+
+        self.assertTrue((second['prot_pair_index'] >= 100).all())
+        self.assertFalse(first.equals(second))
+
+    def test_eviction(self):
+        '''
+        Least recently used entries are evicted once the cache outgrows cache_bytes.
+        '''
+        for low in [0, 4, 12]:
+            self.fetch(method = 'numeric', idx_range = [low, low + 3])
+        entry_bytes = c1.cache_info(self.cache)['bytes'] // 3
+
+        # Reading the first entry again makes the second the least recently used.
+        _, counts = self.fetch(method = 'numeric', idx_range = [0, 3])
+        self.assertEqual(counts['hits'], 1)
+
+        _, counts = self.fetch(method = 'numeric', idx_range = [20, 23],
+                               cache_bytes = int(entry_bytes * 3.5))
+        self.assertEqual(counts['evictions'], 1)
+
+        _, counts = self.fetch(method = 'numeric', idx_range = [0, 3])
+        self.assertEqual(counts['hits'], 1)
+        _, counts = self.fetch(method = 'numeric', idx_range = [4, 7])
+        self.assertEqual(counts['misses'], 1)
+
+        with self.assertRaises(ValueError):
+            self.fetch(cache_format = 'feather')
+
+
+class TestOutput(VPTestCase):
+    '''
+    Tests for Arrow, NumPy and compacted outputs of fetch_data.
+    '''
+
+    def test_arrow(self):
+        '''
+        Arrow tables are compacted by default and hold the same values.
+        '''
+        import pyarrow as pa
+
+        for method in ['numeric', 'chunk']:
+
+            table = c1.fetch_data(self.db_path, method = method, idx_range = [0, 100],
+                                  chunksize = 5, output = 'arrow')
+
+            self.assertIsInstance(table, pa.Table)
+            self.assertEqual(table.schema.field('prot_pair_index').type, pa.int8())
+            self.assertEqual(table.schema.field('ogt_difference').type, pa.float32())
+            assert pa.types.is_dictionary(table.schema.field('m_protein_desc').type)
+
+            df = table.to_pandas()
+            self.assertEqual(df['m_protein_desc'].astype(str).tolist(),
+                             self.vp_final['m_protein_desc'].tolist())
+            np.testing.assert_allclose(df['ogt_difference'], self.vp_final['ogt_difference'])
+
+        table = c1.fetch_data(self.db_path, method = 'numeric', idx_range = [0, 100],
+                              output = 'arrow', compact = False)
+        self.assertEqual(table.schema.field('prot_pair_index').type, pa.int64())
+
+    def test_numpy(self):
+        '''
+        NumPy outputs map columns to arrays and dictionary columns to codes and values.
+        '''
+        arrays = c1.fetch_data(self.db_path, method = 'numeric', idx_range = [0, 100],
+                               columns = ['ogt_difference', 'm_protein_desc'], output = 'numpy')
+
+        self.assertEqual(list(arrays), ['prot_pair_index', 'ogt_difference', 'm_protein_desc'])
+        self.assertEqual(arrays['ogt_difference'].dtype, np.float32)
+        np.testing.assert_array_equal(arrays['prot_pair_index'],
+                                      self.vp_final['prot_pair_index'])
+
+        codes, values = arrays['m_protein_desc']
+        self.assertEqual(values[codes].tolist(), self.vp_final['m_protein_desc'].tolist())
+
+    def test_compact_pandas(self):
+        '''
+        Compacted DataFrames use categoricals and narrow types, and keep CSV row positions.
+        '''
+        df = c1.fetch_data(self.csv_path, form = 'csv', rows = [3, 1, 7, 5], compact = True)
+
+        self.assertEqual(df.index.tolist(), [3, 1, 7, 5])
+        self.assertEqual(df['ogt_difference'].dtype, np.float32)
+        self.assertEqual(df['m_protein_desc'].dtype, 'category')
+
+        cache = os.path.join(self.tmpdir.name, 'cache')
+        first = c1.fetch_data(self.db_path, method = 'numeric', idx_range = [0, 5],
+                              compact = True, cache = cache)
+        second = c1.fetch_data(self.db_path, method = 'numeric', idx_range = [0, 5],
+                               compact = True, cache = cache)
+        pd.testing.assert_frame_equal(first, second)
+        self.assertEqual(first['prot_pair_index'].dtype, np.int8)
+
+        with self.assertRaises(ValueError):
+            c1.fetch_data(self.db_path, output = 'polars')
+
+    def test_compact_precision(self):
+        '''
+        Compacting keeps E-values and tiny floats at float64 and leaves unique strings plain.
+        '''
+        import pyarrow as pa
+
+        table = c1._compact(pa.table({'local_E_value': [1e-50, 1e-3, 0.5, 0.5],
+                                      'score': [1e-60, 1.0, 2.0, 3.0],
+                                      'bit_score': [200.0, 210.0, 220.0, 230.0],
+                                      'm_protein_seq': ['MKA', 'MKI', 'MKL', 'MKV'],
+                                      'm_protein_desc': ['kinase', 'kinase', 'ligase',
+                                                         'kinase']}))
+
+        self.assertEqual(table.schema.field('local_E_value').type, pa.float64())
+        self.assertEqual(table.column('local_E_value')[0].as_py(), 1e-50)
+        self.assertEqual(table.schema.field('score').type, pa.float64())
+        self.assertEqual(table.schema.field('bit_score').type, pa.float32())
+        self.assertEqual(table.schema.field('m_protein_seq').type, pa.string())
+        assert pa.types.is_dictionary(table.schema.field('m_protein_desc').type)
+
+
+class TestParallel(VPTestCase):
+    '''
+    Tests for concurrent range fetches in fetch_data.
+    '''
+
+    def test_same_result(self):
+        '''
+        Concurrent ranges reassemble into the single cursor result.
+        '''
+        cases = [{'method': 'numeric', 'idx_range': [2, 21]},
+                 {'method': 'numeric', 'idx_range': [0, 10 ** 9], 'output': 'arrow'},
+                 {'method': 'chunk', 'size': 9, 'chunksize': 4},
+                 {'method': 'chunk', 'size': 100, 'columns': ['bit_score'],
+                  'where': {'bit_score': (210, 220)}}]
+
+        for form, path in [('duckdb', self.db_path), ('parquet', self.parquet_path)]:
+            for kwargs in cases:
+
+                expected = c1.fetch_data(path, form = form, **kwargs)
+                result = c1.fetch_data(path, form = form, workers = 3, **kwargs)
+
+                if isinstance(expected, pd.DataFrame):
+                    pd.testing.assert_frame_equal(result, expected)
+                else:
+                    assert result.equals(expected)
+
+    def test_empty(self):
+        '''
+        Spans without pairs give an empty result with every column.
+        '''
+        df = c1.fetch_data(self.db_path, method = 'numeric', idx_range = [8, 11], workers = 2)
+
+        self.assertEqual(len(df), 0)
+        self.assertIn('ogt_difference', df.columns)
+
+        with self.assertRaises(ValueError):
+            c1.fetch_data(self.db_path, method = 'numeric', workers = 0)
+
+
+class TestPrefetch(VPTestCase):
+    '''
+    Tests for the prefetch_batches background loader.
+    '''
+
+    def test_same_batches(self):
+        '''
+        Prefetched batches match iter_batches and are counted in stats.
+        '''
+        for form, path in [('duckdb', self.db_path), ('csv', self.csv_path)]:
+
+            stats = {}
+            expected = list(c1.iter_batches(path, form = form, batch_size = 5))
+            batches = list(c1.prefetch_batches(path, form = form, batch_size = 5, depth = 1,
+                                               stats = stats))
+
+            self.assertEqual(len(batches), len(expected))
+            for batch, expected_batch in zip(batches, expected):
+                pd.testing.assert_frame_equal(batch, expected_batch)
+
+            self.assertEqual((stats['batches'], stats['rows']), (4, 16))
+
+        with self.assertRaises(ValueError):
+            c1.prefetch_batches(self.db_path, depth = 0)
+
+    def test_stalls(self):
+        '''
+        Slow reads show up as consumer stalls and slow consumers as loader blocking.
+        '''
+        def slow_batches():
+            for i in range(4):
+                time.sleep(0.05)
+                yield pd.DataFrame({'prot_pair_index': [i]})
+
+        stats = {}
+        list(c1._prefetch(slow_batches(), 2, stats))
+        self.assertGreater(stats['stall_seconds'], 0.1)
+        self.assertGreater(stats['fetch_seconds'], 0.15)
+
+        stats = {}
+        for _ in c1.prefetch_batches(self.db_path, batch_size = 2, depth = 1, stats = stats):
+            time.sleep(0.05)
+        self.assertGreater(stats['blocked_seconds'], 0.1)
+
+    def test_errors_and_close(self):
+        '''
+        Read errors reach the consumer and closing the stream early stops the loader.
+        '''
+        def failing_batches():
+            yield pd.DataFrame({'prot_pair_index': [0]})
+            raise RuntimeError('read failed')
+
+        with self.assertRaises(RuntimeError):
+            list(c1._prefetch(failing_batches(), 2, {}))
+
+        threads = threading.active_count()
+        batches = c1.prefetch_batches(self.db_path, batch_size = 1, depth = 2)
+        next(batches)
+        batches.close()
+        self.assertEqual(threading.active_count(), threads)
+
+
+class TestCsvDuckDB(VPTestCase):
+    '''
+    Tests for reading CSV inputs through DuckDB in fetch_data.
+    '''
+
+    def test_same_result(self):
+        '''
+        Plain and compressed CSV inputs give the same rows as the database.
+        '''
+        cases = [{'method': 'numeric', 'idx_range': [3, 14]},
+                 {'method': 'chunk', 'size': 9, 'columns': ['bit_score'],
+                  'where': {'bit_score': (210, None)}},
+                 {'method': 'stratified', 'strata': {'taxa_pair_index': None}, 'size': 8,
+                  'seed': 2}]
+
+        for kwargs in cases:
+
+            expected = c1.fetch_data(self.db_path, **kwargs)
+
+            for path in [self.csv_path, self.csv_path + '.gz']:
+                df = c1.fetch_data(path, form = 'csv', csv_engine = 'duckdb', **kwargs)
+                pd.testing.assert_frame_equal(df, expected, check_dtype = False)
+
+    def test_random(self):
+        '''
+        Random samples are drawn from the filtered rows in DuckDB.
+        '''
+        df = c1.fetch_data(self.csv_path, form = 'csv', csv_engine = 'duckdb', size = 5,
+                           seed = 1, where = {'ogt_difference': 35})
+
+        self.assertEqual(len(df), 5)
+        self.assertTrue((df['ogt_difference'] == 35).all())
+
+        with self.assertRaises(ValueError):
+            c1.fetch_data(self.csv_path, form = 'csv', csv_engine = 'duckdb', rows = [0])
+
+        with self.assertRaises(ValueError):
+            c1.fetch_data(self.csv_path, form = 'csv', csv_engine = 'polars')
+
+        with self.assertRaises(ValueError):
+            c1.csv_view(os.path.join(self.tmpdir.name, 'missing.csv'))
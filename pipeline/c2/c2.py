@@ -43,91 +43,99 @@ def validprot_sample(df, size, stat_samp = 'random', exclude = None, tol = 1e-04
                                                
     return sample_df, fw_idx
 
-def FrankWolfe(X: np.ndarray, tol: float):
+def FrankWolfe(X: np.ndarray, tol: float, refresh: int = 1000):
     '''
     Calculates probability distribution uing Frank Wolfe method to achieve D-optimal sampling of dataset.
+
+    A = sum_i lamb_i x_i x_i^T is never built from an n x d x d tensor. Each step moves lamb towards one row, which is a rank one
+    update of A, so the inverse of A, the log determinant and the quadratic forms x_i^T A^-1 x_i of all rows are updated in O(n d)
+    with the Sherman-Morrison formula and the matrix determinant lemma instead of being recomputed.
     
     Args:
         X (np.array): Feature array. Must be numeric.
         tol (float): Convergence condition for D_lamb step. Saved as dd_lamb.
+        refresh (int): Steps between exact recomputations of A, its inverse and the quadratic forms, which bounds rounding drift.
+
+    Returns:
+        lamb (np.array): Probability distribution over the rows of X, shape (n, 1).
+        D_lamb_list (list): Saved list of D_lamb values per step.
+        dd_lamb (list): Saved list of D_lamb changes per step.
     '''
-    D_lamb_list = []
-    
-    d = X.shape[1]
-    n = X.shape[0]
-    
-    pulls = np.random.choice(list(range(n)), size=(2*d))
-    values, counts_ = np.unique(pulls, return_counts=True)
-    counts = []
-    
-    for i in range(n):
-        
-        if i in values:
-            counts.append(counts_[np.argwhere(values==i)][0][0])
-        else:
-            counts.append(0)
-            
-    lamb = (np.array(counts)/(2*d)).reshape(-1,1)
-    
+    X = np.asarray(X, dtype=np.float64)
+    n, d = X.shape
+
+    pulls = np.random.choice(n, size=(2*d))
+    lamb = (np.bincount(pulls, minlength=n)/(2*d)).reshape(-1,1)
+
     # start time after startup
     t = 2*d
-    # the raw XXT matrix
-    xs = []
-    
-    for x in X:
-        xs.append(np.matmul(x.reshape(-1,1), x.reshape(1,-1)))
-    XXT = np.array(xs)
-    
-    A = np.sum(lamb.reshape(-1,1,1)*XXT, axis=0)
-    D_lamb = -np.log(np.linalg.det(A))
-    D_lamb_list.append(D_lamb)
-        
-    while len(D_lamb_list) == 1:
-        
-        g_prime = np.concatenate([g_prime_i(X, A, i) for i in range(n)])
-        It = np.argmin(g_prime)
 
-        indicator = np.zeros((n,1))
-        indicator[It] = 1
-        
+    A_inv, log_det, quad = _fw_state(X, lamb)
+    D_lamb_list = [-log_det]
+
+    # quad is kept up to the factor c, which does not change its argmax and saves rescaling all n values each step
+    c = 1.0
+
+    # the first step is always taken, then steps continue until D_lamb changes by less than tol
+    while len(D_lamb_list) == 1 or tol < abs(D_lamb_list[-1] - D_lamb_list[-2]):
+
+        # g_prime of every row is -c*quad, so its argmin is the argmax of quad
+        It = np.argmax(quad)
+        u = A_inv @ X[It]
+        q = c*quad[It]
+
         # at this lambda and t are both at their end of previous iteration state, eg t has not been updated
-        lamb = (lamb*t + indicator)/(t+1)
-        t += 1
-        
-        A = np.sum(lamb.reshape(-1,1,1)*XXT, axis=0)
-        D_lamb = -np.log(np.linalg.det(A))
-        D_lamb_list.append(D_lamb)
-        
-    if len(D_lamb_list) > 1:
-        while tol < abs(D_lamb-D_lamb_list[-2]):
+        lamb *= t/(t+1)
+        lamb[It] += 1/(t+1)
 
-            g_prime = np.concatenate([g_prime_i(X, A, i) for i in range(n)])
-            It = np.argmin(g_prime)
+        # A becomes (t A + x x^T)/(t+1), so A^-1 becomes (t+1)/t (A^-1 - u u^T/(t + q))
+        Xu = X @ u
+        np.square(Xu, out=Xu)
+        Xu /= (t + q)*c
+        quad -= Xu
+        A_inv = (t+1)/t*(A_inv - np.outer(u, u)/(t + q))
+        c *= (t+1)/t
+        log_det += d*np.log(t/(t+1)) + np.log1p(q/t)
+        t += 1
 
-            indicator = np.zeros((n,1))
-            indicator[It] = 1
+        if (t - 2*d) % refresh == 0:
+            A_inv, log_det, quad = _fw_state(X, lamb)
+            c = 1.0
 
-            # at this lambda and t are both at their end of previous iteration state, eg t has not been updated
-            lamb = (lamb*t + indicator)/(t+1)
-            t += 1
+        D_lamb_list.append(-log_det)
 
-            A = np.sum(lamb.reshape(-1,1,1)*XXT, axis=0)
-            D_lamb = -np.log(np.linalg.det(A))
-            D_lamb_list.append(D_lamb)
-    
     dd_lamb = [abs(D_lamb_list[i] - D_lamb_list[i-1]) for i in range(len(D_lamb_list)) if i > 0]
     return lamb, D_lamb_list, dd_lamb
+
+def _fw_state(X, lamb):
+    '''
+    Computes the Frank Wolfe state for lamb from scratch.
+
+    Args:
+        X (np.array): Feature array, shape (n, d).
+        lamb (np.array): Probability distribution over the rows of X, shape (n, 1).
+    Returns:
+        A_inv (np.array): Inverse of A = X^T diag(lamb) X.
+        log_det (float): Log determinant of A, -inf if A is singular.
+        quad (np.array): x_i^T A^-1 x_i for every row of X.
+    '''
+    A = X.T @ (lamb*X)
+    sign, log_det = np.linalg.slogdet(A)
+    A_inv = np.linalg.inv(A)
+    quad = np.sum((X @ A_inv)*X, axis=1)
+    return A_inv, log_det if sign > 0 else -np.inf, quad
     
 def g_prime_i(X, A, i):
     '''
     Calculates g_prime for FrankWolfe function.
     
     Args:
-        X (np.array): 
-        A (float): 
-        i (int): Index value of X
+        X (np.array): Feature array.
+        A (np.array): Current A matrix.
+        i (int or np.array): Index value or values of X
     Returns:
-        g_prime (np.array): Calculated g_prime value for give i.  
+        g_prime (np.array): Calculated g_prime value for given i.  
     '''
-    g_prime = -np.matmul(np.matmul(X[i].reshape(1,-1), np.linalg.inv(A)),  X[i].reshape(-1,1))
+    Xi = np.atleast_2d(X[i])
+    g_prime = -np.einsum('ij,ji->i', Xi, np.linalg.solve(A, Xi.T)).reshape(-1,1)
     return g_prime
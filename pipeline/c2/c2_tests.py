@@ -1 +1,78 @@
 import unittest
+
+import numpy as np
+
+import c2
+
+
+def naive_frank_wolfe(X, tol, lamb, t):
+    '''
+    Reference Frank Wolfe loop that recomputes A, its inverse and every g_prime on each step.
+    '''
+    D_lamb_list = [-np.log(np.linalg.det(X.T @ (lamb*X)))]
+
+    while len(D_lamb_list) == 1 or tol < abs(D_lamb_list[-1] - D_lamb_list[-2]):
+        A_inv = np.linalg.inv(X.T @ (lamb*X))
+        g_prime = [-X[i] @ A_inv @ X[i] for i in range(X.shape[0])]
+        indicator = np.zeros((X.shape[0], 1))
+        indicator[np.argmin(g_prime)] = 1
+        lamb = (lamb*t + indicator)/(t+1)
+        t += 1
+        D_lamb_list.append(-np.log(np.linalg.det(X.T @ (lamb*X))))
+
+    return lamb, D_lamb_list
+
+
+class TestFrankWolfe(unittest.TestCase):
+    '''
+    Tests for the FrankWolfe D-optimal sampling function.
+    '''
+
+    def setUp(self):
+        self.X = np.random.default_rng(0).normal(size=(300, 4)) + 1
+
+    def test_matches_naive(self):
+        '''
+        Rank one updates follow the same path as recomputing every step, with and without refreshes.
+        '''
+        for refresh in [1000, 5]:
+
+            np.random.seed(3)
+            lamb, D_lamb_list, dd_lamb = c2.FrankWolfe(self.X, tol=1e-3, refresh=refresh)
+
+            np.random.seed(3)
+            pulls = np.random.choice(300, size=8)
+            start = (np.bincount(pulls, minlength=300)/8).reshape(-1,1)
+            expected_lamb, expected_D = naive_frank_wolfe(self.X, 1e-3, start, 8)
+
+            np.testing.assert_allclose(lamb, expected_lamb, atol=1e-12)
+            np.testing.assert_allclose(D_lamb_list, expected_D, atol=1e-9)
+            self.assertEqual(len(dd_lamb), len(D_lamb_list) - 1)
+
+    def test_converged(self):
+        '''
+        lamb is a distribution and the last step is within tol.
+        '''
+        lamb, D_lamb_list, dd_lamb = c2.FrankWolfe(self.X, tol=1e-4)
+
+        self.assertEqual(lamb.shape, (300, 1))
+        self.assertAlmostEqual(lamb.sum(), 1)
+        self.assertLessEqual(dd_lamb[-1], 1e-4)
+        self.assertAlmostEqual(D_lamb_list[-1], -np.linalg.slogdet(self.X.T @ (lamb*self.X))[1])
+
+    def test_g_prime_i(self):
+        '''
+        g_prime of several rows at once matches one row at a time.
+        '''
+        A = self.X.T @ self.X
+        rows = np.arange(5)
+
+        batched = c2.g_prime_i(self.X, A, rows)
+        single = np.concatenate([c2.g_prime_i(self.X, A, i) for i in rows])
+
+        np.testing.assert_allclose(batched, single)
+        np.testing.assert_allclose(single[0], -self.X[0] @ np.linalg.inv(A) @ self.X[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
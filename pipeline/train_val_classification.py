@@ -3,17 +3,11 @@ This module takes in a pandas dataframe from
 c5_input_cleaning and runs it through a
 RandomForestClassifier model from scitkit learn.
 Returns a Boolean prediction for protein pair
-functionality.
+functionality. scikit-learn and matplotlib are
+imported by the functions that use them, so
+importing this module stays fast.
 """
 
-import matplotlib.pyplot as plt
-import sklearn.preprocessing
-import sklearn.model_selection
-import sklearn.neighbors
-import sklearn.ensemble
-import sklearn.feature_selection
-import sklearn.metrics
-
 
 def train_model(dataframe, columns=[], target=[]):
     """
@@ -36,6 +30,10 @@ def train_model(dataframe, columns=[], target=[]):
     -validation data (features)
     -validation data (target)
     """
+    import sklearn.ensemble
+    import sklearn.model_selection
+    import sklearn.preprocessing
+
     # split data
     train, val = sklearn.model_selection.train_test_split(
         dataframe, test_size=0.15, random_state=1)
@@ -92,6 +90,8 @@ def evaluate_model(model, val_X, val_y):
     assert "numpy.ndarray" in str(type(val_X))
     assert "numpy.ndarray" in str(type(val_y))
 
+    import sklearn.metrics
+
     preds = model.predict(val_X)
 
     # not printed during model validation step
@@ -121,6 +121,9 @@ def plot_model(model, val_X, val_y):
     assert "numpy.ndarray" in str(type(val_X))
     assert "numpy.ndarray" in str(type(val_y))
 
+    import matplotlib.pyplot as plt
+    import sklearn.metrics
+
     score = model.score(val_X, val_y)
     preds = model.predict(val_X)
 
@@ -0,0 +1,23 @@
+"""
+Import tests for the ML modules. Kept apart from train_val_tests, which
+reads the sample CSV when it is imported.
+"""
+import subprocess
+import sys
+import unittest
+
+
+class TestImportTime(unittest.TestCase):
+    """
+    Guards against slow imports and import side effects.
+    """
+
+    def test_wrapper_import(self):
+        # importing the wrapper should not read the sample or load sklearn
+        cmd = ('import sys, train_val_wrapper, train_val_input_cleaning; '
+               'print(train_val_input_cleaning.load_sample.cache_info().currsize, '
+               '"sklearn" in sys.modules, "matplotlib" in sys.modules)')
+        out = subprocess.run([sys.executable, '-c', cmd], capture_output=True,
+                             text=True, check=True).stdout.split()
+
+        self.assertEqual(out, ['0', 'False', 'False'])
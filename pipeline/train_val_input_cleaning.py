@@ -4,16 +4,16 @@ and cleans it so that it can be passed through a machine
 learning algorithm.
 In this training/validation stage of the project, we will
 load a sample CSV (n=50,000) with protein pairs from our large
-database to demonstrate functionality.
+database to demonstrate functionality. The sample is read on first
+use with load_sample(), not at import.
 """
 
-import pandas as pd
+import functools
 
-# sample dataframe can be passed into wrapper for training
-df = pd.read_csv('learn2therm_sample_50k.csv')
+import pandas as pd
 
-# create target that describes whether protein pair is functional
-df['protein_match'] = df['t_protein_desc'] == df['m_protein_desc']
+# sample CSV that can be passed into wrapper for training
+SAMPLE_PATH = 'learn2therm_sample_50k.csv'
 
 # keep columns that can be used as features
 columns_to_keep = [
@@ -30,6 +30,35 @@ columns_to_keep = [
     'protein_match']
 
 
+@functools.lru_cache(maxsize=None)
+def load_sample(path=SAMPLE_PATH):
+    """
+    Reads the sample CSV and adds the protein_match target. The file is read
+    on first call rather than at import, and the result is cached.
+
+    Input: Path to sample CSV.
+    Output: Pandas dataframe.
+    """
+    dataframe = pd.read_csv(path)
+
+    # create target that describes whether protein pair is functional
+    dataframe['protein_match'] = (dataframe['t_protein_desc'] ==
+                                  dataframe['m_protein_desc'])
+
+    return dataframe
+
+
+def __getattr__(name):
+    """
+    Keeps `from train_val_input_cleaning import df` working by loading the
+    sample on first access.
+    """
+    if name == 'df':
+        return load_sample()
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 def check_input_type(dataframe):
     """
     Takes in input dataframe and asserts that it is the correct data type.
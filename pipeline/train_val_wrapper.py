@@ -4,7 +4,7 @@ Wrapper functions for all of the machine learning component.
 
 from train_val_classification import rf_wrapper
 from train_val_input_cleaning import input_cleaning_wrapper
-from train_val_input_cleaning import df
+from train_val_input_cleaning import load_sample
 
 
 def train_val_wrapper(dataframe):
@@ -30,4 +30,6 @@ def train_val_wrapper(dataframe):
 
     return classifier
 
-print(train_val_wrapper(df))
+
+if __name__ == '__main__':
+    print(train_val_wrapper(load_sample()))